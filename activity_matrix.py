@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Sparse user x room activity matrix (message count and last activity per user and room) in CSR layout:
+# one row per user, the non-zero entries of all rows stored in flat typed arrays. Membership heuristics are
+# evaluated as thresholds over these arrays instead of over sets of migrated posts. Given a window of days,
+# messages are also counted per day, so thresholds can be applied to the messages of the last days of the export.
+
+from array import array
+from itertools import compress
+
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+
+class ActivityMatrixBuilder:
+    def __init__(self, window_days=None):
+        # window_days: the messages of the last days of the export are counted as well (in calendar days, UTC)
+        self.window_days = window_days
+        self._entries = {}  # (user id, room id) -> [message count, last activity in ms, {day: message count}]
+        self._latest_day = None
+
+    def _entry(self, user_id, room_id):
+        entry = self._entries.get((user_id, room_id))
+        if entry is None:
+            entry = self._entries[(user_id, room_id)] = [0, 0, {}]
+        return entry
+
+    def _add_day(self, entry, day, count):
+        # days before the window of the latest day seen so far can never be within the window
+        self._latest_day = day if self._latest_day is None else max(self._latest_day, day)
+        if day > self._latest_day - self.window_days:
+            entry[2][day] = entry[2].get(day, 0) + count
+
+    def add(self, user_id, room_id, timestamp_ms, count=1):
+        # count messages written at timestamp_ms, or on the same day (e.g. aggregated by day)
+        entry = self._entry(user_id, room_id)
+        entry[0] += count
+        entry[1] = max(entry[1], int(timestamp_ms))
+        if self.window_days is not None:
+            self._add_day(entry, int(timestamp_ms) // MS_PER_DAY, count)
+
+    def add_entry(self, user_id, room_id, count, last_activity, day_counts):
+        # merges an entry of another builder (see entries())
+        entry = self._entry(user_id, room_id)
+        entry[0] += count
+        entry[1] = max(entry[1], int(last_activity))
+        if self.window_days is not None:
+            for day, day_count in day_counts:
+                self._add_day(entry, day, day_count)
+
+    def entries(self):
+        # (user id, room id, message count, last activity in ms, [(day, message count)]), e.g. to merge the activity
+        # of several builders
+        return [(user_id, room_id, count, last, sorted(days.items()))
+                for (user_id, room_id), (count, last, days) in self._entries.items()]
+
+    def build(self):
+        user_ids = array('q')
+        row_offsets = array('q', [0])
+        room_ids = array('q')
+        counts = array('q')
+        last_activity = array('q')
+        recent_counts = array('q') if self.window_days is not None else None
+        for (user_id, room_id) in sorted(self._entries):
+            if not user_ids or user_ids[-1] != user_id:
+                if user_ids:
+                    row_offsets.append(len(room_ids))
+                user_ids.append(user_id)
+            count, last, days = self._entries[(user_id, room_id)]
+            room_ids.append(room_id)
+            counts.append(count)
+            last_activity.append(last)
+            if recent_counts is not None:
+                recent_counts.append(sum(c for d, c in days.items() if d > self._latest_day - self.window_days))
+        if user_ids:
+            row_offsets.append(len(room_ids))
+        return ActivityMatrix(user_ids, row_offsets, room_ids, counts, last_activity, recent_counts,
+                              self.window_days)
+
+
+class ActivityMatrix:
+    def __init__(self, user_ids, row_offsets, room_ids, counts, last_activity, recent_counts=None, window_days=None):
+        self.user_ids = user_ids
+        self.row_offsets = row_offsets
+        self.room_ids = room_ids
+        self.counts = counts
+        self.last_activity = last_activity
+        self.recent_counts = recent_counts  # messages within the last window_days days of the export
+        self.window_days = window_days
+        self._row_by_user_id = dict((user_id, row) for row, user_id in enumerate(user_ids))
+
+    def __len__(self):
+        return len(self.room_ids)  # number of non-zero entries
+
+    def latest_activity(self):
+        return max(self.last_activity) if self.last_activity else None
+
+    def members_by_room(self, min_messages=1, active_days=None):
+        # users with at least min_messages messages in a room, (optionally) within the last active_days days of
+        # the export, which must be the window the activity was collected for
+        counts = self.counts
+        if active_days is not None:
+            if active_days != self.window_days:
+                raise ValueError('Activity was collected for a window of %s days, not %s days' % (
+                    self.window_days, active_days))
+            counts = self.recent_counts
+        mask = array('b', (c >= min_messages for c in counts))
+        row_of_entry = array('q')
+        for row in range(len(self.user_ids)):
+            row_of_entry.extend([row] * (self.row_offsets[row + 1] - self.row_offsets[row]))
+        members = {}
+        for row, room_id in zip(compress(row_of_entry, mask), compress(self.room_ids, mask)):
+            members.setdefault(room_id, set()).add(self.user_ids[row])
+        return members
+
+    def activity_of_user(self, user_id):
+        # room id -> (message count, last activity in ms) of all rooms the user wrote in
+        row = self._row_by_user_id.get(user_id)
+        if row is None:
+            return {}
+        start, end = self.row_offsets[row], self.row_offsets[row + 1]
+        return dict(zip(self.room_ids[start:end], zip(self.counts[start:end], self.last_activity[start:end])))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Writes the base64 encoded avatars of the Hipchat export as image files, in a thread pool. Images in a format
+# recognized by their magic bytes are written as decoded, without decoding the image itself. Files are named by
+# the hash of their content, so avatars written by an earlier run (or shared by several users) are written once.
+
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+DEFAULT_WORKERS = 8
+PENDING_AVATARS_PER_WORKER = 4  # limits the avatars held in memory while the export is read faster than written
+IMAGE_MAGIC_BYTES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+]
+
+
+def sniff_image_format(data):
+    for magic, image_format in IMAGE_MAGIC_BYTES:
+        if data.startswith(magic):
+            return image_format
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class AvatarWriter:
+    def __init__(self, output_path, workers=DEFAULT_WORKERS):
+        self.output_path = output_path
+        self.written = 0
+        self.existing = 0
+        self.converted = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(workers * PENDING_AVATARS_PER_WORKER)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='avatar')
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def submit(self, base64_data, description):
+        # returns a future of the path of the written image, '' if the avatar is invalid.
+        # Blocks while too many avatars are pending.
+        self._pending.acquire()
+        future = self._executor.submit(self._store, base64_data, description)
+        future.add_done_callback(lambda f: self._pending.release())
+        return future
+
+    def _store(self, base64_data, description):
+        try:
+            decoded = base64.b64decode(base64_data)
+        except (TypeError, binascii.Error) as e:
+            logger.error('Failed to decode base 64 avatar of %s: %s' % (description, str(e)))
+            self._count('failed')
+            return ''
+
+        image_format = sniff_image_format(decoded)
+        if image_format is None:
+            # unusual format, convert it to PNG if PIL can read it at all
+            try:
+                with Image.open(BytesIO(decoded)) as image:
+                    converted = BytesIO()
+                    image.save(converted, 'png')
+            except Exception as e:
+                logger.error('Failed to read avatar of %s: %s' % (description, str(e)))
+                self._count('failed')
+                return ''
+            decoded = converted.getvalue()
+            image_format = 'png'
+            self._count('converted')
+
+        path = '%s/avatar_%s.%s' % (self.output_path, hashlib.sha256(decoded).hexdigest(), image_format)
+        if os.path.exists(path):
+            self._count('existing')
+            return path
+        tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp_path, 'wb') as image_file:
+            image_file.write(decoded)
+        os.replace(tmp_path, path)
+        self._count('written')
+        return path
+
+    def close(self):
+        self._executor.shutdown(wait=True)
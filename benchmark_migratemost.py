@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# Times the stages of migratemost on an export (e.g. one created by generate_hipchat_export.py) and reports
+# throughput and peak memory per stage, so that performance changes can be compared between runs.
+
+import glob
+import json
+import logging
+import os
+import resource
+import time
+import tracemalloc
+from optparse import OptionParser
+
+import export_source
+import migratemost
+import migrate_hipchat_emoticons
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+option_input_path = '.'
+option_output_path = '.'
+option_report_file = None
+option_trace_memory = True
+
+
+class StageTimer:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.records = 0
+        self.input_bytes = 0
+        self.peak_traced_bytes = 0
+
+    def run(self, func, *args):
+        if option_trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = func(*args)
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+        if option_trace_memory:
+            self.peak_traced_bytes = max(self.peak_traced_bytes, tracemalloc.get_traced_memory()[1])
+        return result
+
+    def report(self):
+        seconds = max(self.seconds, 1e-9)
+        return {'stage': self.name,
+                'calls': self.calls,
+                'seconds': round(self.seconds, 3),
+                'records': self.records,
+                'records_per_second': round(self.records / seconds, 1),
+                'input_mb_per_second': round(self.input_bytes / seconds / (1024 * 1024), 2),
+                'peak_traced_mb': round(self.peak_traced_bytes / (1024 * 1024), 1) if option_trace_memory else None}
+
+
+def _history_size(relative_path):
+    path = '%s/%s' % (option_input_path, relative_path)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _configure_migratemost():
+    migratemost.logger.setLevel(logging.WARNING)
+    migratemost.default_team_name = 'benchmark'
+    migratemost.default_team_display_name = 'Benchmark'
+    migratemost.migration_input_path = option_input_path
+    migratemost.hc_export_source = export_source.DirectorySource(option_input_path)
+    migratemost.migration_output_path = option_output_path
+    migratemost.option_migrate_direct_posts = True
+    migratemost.option_migrate_channels = True
+    migratemost.option_migrate_channel_posts = True
+    migratemost.option_migrate_avatars = True
+    migratemost.option_join_public_channels = True
+    migratemost.option_public_membership_based_on_messages = True
+
+
+def run_benchmark():
+    _configure_migratemost()
+    emoji_mapping = dict(migrate_hipchat_emoticons.emoji_mapping)
+    timers = []
+
+    def timer(name):
+        t = StageTimer(name)
+        timers.append(t)
+        return t
+
+    if option_trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+
+    users_timer = timer('migrate_users')
+    mm_users = users_timer.run(migratemost.migrate_users)
+    users_timer.records = len(mm_users)
+    users_timer.input_bytes = _history_size('users.json')
+    mm_username_by_hc_id = dict([(u.get_hc_id(), u.username) for u in mm_users])
+    mm_username_by_mention_name = dict([(u.get_hc_mention_name().lower(), u.username) for u in mm_users])
+
+    direct_posts_timer = timer('migrate_direct_posts')
+    write_timer = timer('write_mm_json')
+    for mm_user in mm_users:
+        posts = direct_posts_timer.run(migratemost.migrate_direct_posts, mm_username_by_hc_id, mm_user, emoji_mapping,
+                                       mm_username_by_mention_name)
+        direct_posts_timer.records += len(posts)
+        direct_posts_timer.input_bytes += _history_size('users/%d/history.json' % mm_user.get_hc_id())
+        write_timer.run(migratemost.write_mm_json, posts,
+                        '%s_%d' % (migratemost.OUTPUT_DIRECT_POSTS_FILENAME, mm_user.get_hc_id()))
+        write_timer.records += len(posts)
+
+    channels_timer = timer('migrate_channels')
+    mm_channels = channels_timer.run(migratemost.migrate_channels)
+    channels_timer.records = len(mm_channels)
+    channels_timer.input_bytes = _history_size('rooms.json')
+    write_timer.run(migratemost.write_mm_json, mm_channels, migratemost.OUTPUT_CHANNELS_FILENAME)
+    write_timer.records += len(mm_channels)
+
+    channel_posts_timer = timer('migrate_channel_posts')
+    for channel in mm_channels:
+        posts = channel_posts_timer.run(migratemost.migrate_channel_posts, mm_username_by_hc_id, channel, emoji_mapping,
+                                        mm_username_by_mention_name)
+        channel_posts_timer.records += len(posts)
+        channel_posts_timer.input_bytes += _history_size('rooms/%d/history.json' % channel.get_hc_id())
+        write_timer.run(migratemost.write_mm_json, posts,
+                        '%s_%d' % (migratemost.OUTPUT_CHANNEL_POSTS_FILENAME, channel.get_hc_id()))
+        write_timer.records += len(posts)
+        channel.add_channel_participants(set(map(lambda p: p.get_user_hc_id(), posts)))
+
+    membership_timer = timer('migrate_user_channel_membership')
+    for mm_user in mm_users:
+        memberships = membership_timer.run(migratemost.migrate_user_channel_membership, mm_channels, mm_user)
+        membership_timer.records += len(memberships)
+        mm_user.teams[0].channels = memberships[0:migratemost.MM_MAX_CHANNEL_MEMBERSHIPS_PER_USER - 1]
+
+    write_timer.run(migratemost.write_mm_json, mm_users, migratemost.OUTPUT_USERS_FILENAME)
+    write_timer.records += len(mm_users)
+
+    concat_timer = timer('concat_files')
+    input_files = sorted(glob.glob('%s/%s*.jsonl' % (option_output_path, migratemost.OUTPUT_FILENAME_PREFIX)))
+    input_files = [f for f in input_files if not f.endswith('/%s.jsonl' % migratemost.OUTPUT_ALL_IN_ONE_FILENAME)]
+    concat_timer.input_bytes = sum(os.path.getsize(f) for f in input_files)
+    concat_timer.run(migratemost.concat_files, input_files, migratemost.OUTPUT_ALL_IN_ONE_FILENAME)
+    concat_timer.records = len(input_files)
+
+    total_seconds = time.perf_counter() - start
+    if option_trace_memory:
+        tracemalloc.stop()
+
+    return {'input_path': option_input_path,
+            'total_seconds': round(total_seconds, 3),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+            'stages': [t.report() for t in timers]}
+
+
+def parse_arguments():
+    global option_input_path
+    global option_output_path
+    global option_report_file
+    global option_trace_memory
+
+    parser = OptionParser(usage='''
+        usage: %prog [options]
+        Runs the migratemost stages on a Hipchat export and reports time, throughput and peak memory per stage.
+        Use generate_hipchat_export.py to create a reproducible export.
+    ''')
+    parser.add_option('-i', '--input-path', dest='input_path', action='store', type='string',
+                      help='Path to the Hipchat export (mandatory)')
+    parser.add_option('-o', '--output-path', dest='output_path', action='store', type='string',
+                      help='Path where the migration files will be written (mandatory, must exist)')
+    parser.add_option('-r', '--report-file', dest='report_file', action='store', type='string',
+                      help='Write the results as JSON to this file')
+    parser.add_option('--no-trace-memory', dest='trace_memory', action='store_false', default=True,
+                      help='Do not measure peak memory per stage with tracemalloc, which slows down the stages')
+
+    (options, args) = parser.parse_args()
+
+    if not options.input_path or not os.path.isdir(options.input_path):
+        parser.error("Existing input path is mandatory")
+    if not options.output_path or not os.path.isdir(options.output_path):
+        parser.error("Existing output path is mandatory")
+
+    option_input_path = os.path.abspath(options.input_path)
+    option_output_path = os.path.abspath(options.output_path)
+    option_report_file = options.report_file
+    option_trace_memory = options.trace_memory
+
+
+def main():
+    parse_arguments()
+    results = run_benchmark()
+
+    logger.info('%-32s %8s %12s %12s %10s %10s' % ('stage', 'seconds', 'records', 'records/s', 'MB/s in',
+                                                   'peak MB'))
+    for s in results['stages']:
+        logger.info('%-32s %8.2f %12d %12.1f %10.2f %10s' % (s['stage'], s['seconds'], s['records'],
+                                                             s['records_per_second'], s['input_mb_per_second'],
+                                                             s['peak_traced_mb']))
+    logger.info('Total: %.2f s, peak RSS: %.1f MB' % (results['total_seconds'], results['peak_rss_mb']))
+
+    if option_report_file:
+        with open(option_report_file, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
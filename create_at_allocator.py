@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+# Allocates unique create_at timestamps (in ms) for the posts of a channel or conversation. Mattermost treats posts
+# with the same channel, user and create_at as duplicates, which happens with split messages and bursty bots.
+# A timestamp already taken is moved to the next free millisecond, so for posts in time order the allocated
+# timestamps are strictly increasing.
+
+
+class CreateAtAllocator:
+    def __init__(self):
+        self.allocated = 0
+        self.adjusted = 0  # timestamps which had to be moved
+        self._next_candidate = {}  # stream -> {taken timestamp -> candidate for the next free timestamp}
+
+    def allocate(self, timestamp, stream=None):
+        # stream: e.g. the receiver of a direct post, timestamps are unique within each stream
+        next_candidate = self._next_candidate.setdefault(stream, {})
+        allocated = timestamp
+        path = []
+        while allocated in next_candidate:
+            path.append(allocated)
+            allocated = next_candidate[allocated]
+        for taken in path:
+            next_candidate[taken] = allocated + 1  # path compression, bursts are skipped in one step next time
+        next_candidate[allocated] = allocated + 1
+        self.allocated += 1
+        if allocated != timestamp:
+            self.adjusted += 1
+        return allocated
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# Census of a Hipchat export for capacity planning: counts messages, attachments, oversized images, messages to
+# be split and emoticon usage without converting anything. History files are parsed as a stream in parallel.
+
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from json_stream import iter_json_array_file
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+EMOTICON_RE = re.compile(r'\(([a-zA-Z0-9]+)\)')
+POST_LINE_OVERHEAD_BYTES = 150  # JSONL structure, team, channel, user and create_at of a post
+DIRECT_POST_LINE_OVERHEAD_BYTES = 120
+ATTACHMENT_OVERHEAD_BYTES = 40
+DEFAULT_IMPORT_POSTS_PER_SECOND = 1000  # assumed bulk import rate, adjust to measurements of your installation
+LARGEST_UNITS_IN_REPORT = 25
+EMOTICONS_IN_REPORT = 100
+
+
+class CensusLimits:
+    def __init__(self, max_message_length, max_file_size, max_image_pixels):
+        self.max_message_length = max_message_length
+        self.max_file_size = max_file_size
+        self.max_image_pixels = max_image_pixels
+
+
+def _attachment_census(full_path, limits, result):
+    result['attachments'] += 1
+    try:
+        size = os.path.getsize(full_path)
+    except OSError:
+        result['attachments_missing'] += 1
+        return
+    result['attachment_bytes'] += size
+    if size >= limits.max_file_size:
+        result['attachments_too_large'] += 1
+        return
+    try:
+        with Image.open(full_path) as image:  # only reads the header
+            pixels = image.width * image.height
+    except Exception:
+        return  # not an image
+    if pixels >= limits.max_image_pixels:
+        result['oversized_images'] += 1
+
+
+def history_census(job):
+    input_path, history_type, hc_id, limits = job
+    history_path = '%s/%s/%d/history.json' % (input_path, history_type, hc_id)
+    files_path = '%s/rooms/%d/files' % (input_path, hc_id) if history_type == 'rooms' else '%s/users/files' % input_path
+    result = {'type': history_type, 'id': hc_id, 'file_bytes': os.path.getsize(history_path), 'messages': 0,
+              'skipped_messages': 0, 'message_chars': 0, 'split_messages': 0, 'posts': 0, 'attachments': 0,
+              'attachments_missing': 0, 'attachments_too_large': 0, 'attachment_bytes': 0, 'oversized_images': 0,
+              'output_bytes': 0, 'senders': set(), 'emoticons': Counter()}
+    line_overhead = POST_LINE_OVERHEAD_BYTES if history_type == 'rooms' else DIRECT_POST_LINE_OVERHEAD_BYTES
+
+    for element in iter_json_array_file(history_path):
+        if history_type == 'rooms':
+            message = element.get('UserMessage')
+        else:
+            # direct messages are contained in the histories of both users, but only migrated from the sender's
+            message = element.get('PrivateUserMessage')
+            if message is not None and message['sender']['id'] != hc_id:
+                message = None
+        if message is None:
+            result['skipped_messages'] += 1
+            continue
+
+        text = message['message']
+        result['messages'] += 1
+        result['message_chars'] += len(text)
+        result['senders'].add(message['sender']['id'])
+        parts = max(int(math.ceil(len(text) / float(limits.max_message_length))), 1)
+        if parts > 1:
+            result['split_messages'] += 1
+        result['posts'] += parts
+        # non-ASCII characters are written as escape sequences
+        result['output_bytes'] += len(text.encode('ascii', 'backslashreplace')) + parts * line_overhead
+        for emoticon in EMOTICON_RE.findall(text):
+            result['emoticons'][emoticon] += 1
+        attachment = message.get('attachment')
+        if attachment is not None:
+            _attachment_census('%s/%s' % (files_path, attachment['path']), limits, result)
+            result['output_bytes'] += len(files_path) + len(attachment['path']) + ATTACHMENT_OVERHEAD_BYTES
+
+    result['senders'] = len(result['senders'])
+    return result
+
+
+def _history_ids(input_path, history_type):
+    directory = '%s/%s' % (input_path, history_type)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(e.name) for e in os.scandir(directory)
+                  if e.name.isdigit() and os.path.exists('%s/%s/history.json' % (directory, e.name)))
+
+
+def _count_entries(path, key):
+    count = 0
+    with_avatar = 0
+    for element in iter_json_array_file(path):
+        count += 1
+        if key == 'User' and element[key].get('avatar'):
+            with_avatar += 1
+    return count, with_avatar
+
+
+def run_census(input_path, report_path, limits, workers=None, import_posts_per_second=DEFAULT_IMPORT_POSTS_PER_SECOND):
+    start_time = time.time()
+    user_count, avatar_count = _count_entries('%s/users.json' % input_path, 'User')
+    room_count, _ = _count_entries('%s/rooms.json' % input_path, 'Room')
+
+    jobs = [(input_path, t, hc_id, limits) for t in ('rooms', 'users') for hc_id in _history_ids(input_path, t)]
+    # largest files first, so a huge room does not end up as the last job of a worker
+    jobs.sort(key=lambda j: -os.path.getsize('%s/%s/%d/history.json' % (j[0], j[1], j[2])))
+    logger.info('Census of %d history files' % len(jobs))
+
+    totals = dict((t, Counter()) for t in ('rooms', 'users'))
+    emoticons = Counter()
+    units = dict((t, []) for t in ('rooms', 'users'))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(history_census, jobs, chunksize=4):
+            emoticons.update(result.pop('emoticons'))
+            history_type = result.pop('type')
+            units[history_type].append(result)
+            totals[history_type].update(dict((k, v) for k, v in result.items() if k not in ('id', 'senders')))
+
+    total_posts = totals['rooms']['posts'] + totals['users']['posts']
+    predicted_output_bytes = totals['rooms']['output_bytes'] + totals['users']['output_bytes']
+    report = {
+        'input_path': input_path,
+        'users': user_count,
+        'users_with_avatar': avatar_count,
+        'rooms': room_count,
+        'room_histories': dict(totals['rooms'], files=len(units['rooms'])),
+        'user_histories': dict(totals['users'], files=len(units['users'])),
+        'largest_rooms': sorted(units['rooms'], key=lambda u: -u['messages'])[:LARGEST_UNITS_IN_REPORT],
+        'largest_user_histories': sorted(units['users'], key=lambda u: -u['messages'])[:LARGEST_UNITS_IN_REPORT],
+        'room_messages': dict((u['id'], u['messages']) for u in units['rooms']),
+        'user_messages': dict((u['id'], u['messages']) for u in units['users']),
+        'emoticons': dict(emoticons.most_common(EMOTICONS_IN_REPORT)),
+        'distinct_emoticons': len(emoticons),
+        'prediction': {
+            'posts': total_posts,
+            'output_bytes': predicted_output_bytes,
+            'import_posts_per_second': import_posts_per_second,
+            'import_seconds': int(total_posts / float(import_posts_per_second)) if import_posts_per_second else None,
+        },
+        'census_seconds': round(time.time() - start_time, 1),
+    }
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    logger.info('Census: %d users, %d rooms, %d room messages, %d direct messages, %d attachments (%.1f MB), '
+                '%d oversized images, %d messages to split' % (
+                    user_count, room_count, totals['rooms']['messages'], totals['users']['messages'],
+                    totals['rooms']['attachments'] + totals['users']['attachments'],
+                    (totals['rooms']['attachment_bytes'] + totals['users']['attachment_bytes']) / (1024.0 * 1024.0),
+                    totals['rooms']['oversized_images'] + totals['users']['oversized_images'],
+                    totals['rooms']['split_messages'] + totals['users']['split_messages']))
+    logger.info('Predicted output: %d posts, %.1f MB, import time about %.1f hours at %d posts/s' % (
+        total_posts, predicted_output_bytes / (1024.0 * 1024.0),
+        total_posts / float(import_posts_per_second) / 3600.0 if import_posts_per_second else 0,
+        import_posts_per_second))
+    return report
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+# Access to the files of a Hipchat export, either extracted to a directory or directly from the decrypted tar archive.
+# For an uncompressed archive an index of member offsets is built on the first pass (and kept next to the output),
+# so history files are read and attachments extracted on demand. Compressed archives and streams (e.g. the output
+# of openssl on stdin) can only be read once: history files are ingested into the staging database, all other
+# members (e.g. attachments) are extracted while passing.
+
+import codecs
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tarfile
+import threading
+
+from json_stream import iter_json_array
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+STDIN_ARCHIVE = '-'
+EXPORT_ROOT_ENTRIES = ('users.json', 'rooms.json', 'users', 'rooms', 'metadata.json')
+HISTORY_FILE_RE = re.compile(r'^(rooms|users)/(\d+)/history\.json$')
+COMPRESSION_MAGIC_BYTES = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00')  # gzip, bzip2, xz
+TAR_INDEX_VERSION = 1
+COPY_BUFFER_SIZE = 1024 * 1024
+INDEX_PROGRESS_MEMBERS = 100000
+
+
+def export_relative_name(member_name):
+    # archives may contain the export below some directory, e.g. "./data/rooms/1/history.json"
+    parts = member_name.split('/')
+    for i, part in enumerate(parts):
+        if part in EXPORT_ROOT_ENTRIES:
+            return '/'.join(parts[i:])
+    return None
+
+
+def is_single_pass_archive(archive_path):
+    if archive_path == STDIN_ARCHIVE:
+        return True
+    with open(archive_path, 'rb') as archive_file:
+        head = archive_file.read(6)
+    return any(head.startswith(magic) for magic in COMPRESSION_MAGIC_BYTES)
+
+
+class ExportSource:
+    # names are relative to the root of the export, e.g. "rooms/1/history.json"
+
+    def iter_json_members(self):
+        # yields (name, file) of users.json, rooms.json and all history files, each file must be read before the next
+        for name in ['users.json', 'rooms.json'] + self.history_names('rooms') + self.history_names('users'):
+            if self.exists(name):
+                with self.open(name) as json_file:
+                    yield name, json_file
+
+    def history_names(self, history_type):
+        return ['%s/%d/history.json' % (history_type, history_id) for history_id in self.history_ids(history_type)]
+
+    def load_json(self, name):
+        with self.open(name) as json_file:
+            return json.load(json_file)
+
+    def iter_json_array(self, name):
+        with self.open(name) as json_file:
+            yield from iter_json_array(json_file)
+
+
+class DirectorySource(ExportSource):
+    def __init__(self, path):
+        self.path = path
+
+    def description(self):
+        return self.path
+
+    def file_path(self, name):
+        return '%s/%s' % (self.path, name)
+
+    def exists(self, name):
+        return os.path.exists(self.file_path(name))
+
+    def size(self, name):
+        try:
+            return os.path.getsize(self.file_path(name))
+        except OSError:
+            return None
+
+    def version(self, name):
+        stat = os.stat(self.file_path(name))
+        return stat.st_size, stat.st_mtime_ns
+
+    def open(self, name):
+        return open(self.file_path(name), 'r', encoding='utf-8')
+
+    def history_ids(self, history_type):
+        directory = '%s/%s' % (self.path, history_type)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(int(e.name) for e in os.scandir(directory)
+                      if e.name.isdigit() and os.path.exists('%s/%s/history.json' % (directory, e.name)))
+
+
+class _MemberFile(io.RawIOBase):
+    # data of one member of an uncompressed tar archive, read through a file handle of its own
+    def __init__(self, archive_path, offset, size):
+        self._file = open(archive_path, 'rb')
+        self._file.seek(offset)
+        self._remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._remaining <= 0:
+            return 0
+        data = self._file.read(min(len(buffer), self._remaining))
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class TarSource(ExportSource):
+    def __init__(self, archive_path, extract_path, index_path):
+        self.archive_path = archive_path
+        self.extract_path = extract_path  # attachments and other files needed on disk are extracted to here
+        self.index_path = index_path
+        self.single_pass = is_single_pass_archive(archive_path)
+        self._index = {}  # name -> [offset of data (None if read as stream), size, mtime]
+        self._lock = threading.Lock()
+        if self.single_pass:
+            self._load_index(check_archive=False)  # from an earlier pass, names and sizes only
+        elif not self._load_index(check_archive=True):
+            self._build_index()
+
+    def description(self):
+        return 'stdin' if self.archive_path == STDIN_ARCHIVE else self.archive_path
+
+    def _archive_version(self):
+        if self.archive_path == STDIN_ARCHIVE:
+            return None
+        stat = os.stat(self.archive_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _load_index(self, check_archive):
+        if not os.path.exists(self.index_path):
+            return False
+        with open(self.index_path, 'r') as index_file:
+            index = json.load(index_file)
+        if index['version'] != TAR_INDEX_VERSION or (check_archive and index['archive'] != self._archive_version()):
+            logger.info('Archive changed since index %s was built' % self.index_path)
+            return False
+        self._index = index['members']
+        return True
+
+    def _store_index(self):
+        tmp_index_path = self.index_path + '.tmp'
+        with open(tmp_index_path, 'w') as index_file:
+            json.dump({'version': TAR_INDEX_VERSION, 'archive': self._archive_version(), 'members': self._index},
+                      index_file)
+        os.replace(tmp_index_path, self.index_path)
+
+    def _build_index(self):
+        logger.info('Indexing members of %s' % self.archive_path)
+        with tarfile.open(self.archive_path, 'r:') as tar:
+            while True:
+                info = tar.next()
+                if info is None:
+                    break
+                tar.members = []  # not needed, would grow with every member of huge archives
+                name = export_relative_name(info.name)
+                if info.isfile() and name:
+                    self._index[name] = [info.offset_data, info.size, int(info.mtime)]
+                    if len(self._index) % INDEX_PROGRESS_MEMBERS == 0:
+                        logger.info('\tIndexed %d members' % len(self._index))
+        self._store_index()
+        logger.info('Indexed %d members of %s' % (len(self._index), self.archive_path))
+
+    def exists(self, name):
+        return name in self._index
+
+    def size(self, name):
+        member = self._index.get(name)
+        return member[1] if member else None
+
+    def version(self, name):
+        _, size, mtime = self._index[name]
+        return size, mtime
+
+    def open(self, name):
+        offset, size, _ = self._index[name]
+        if offset is None:
+            # read as a stream before, only the extracted members are available
+            return open(self.file_path(name), 'r', encoding='utf-8')
+        return io.TextIOWrapper(io.BufferedReader(_MemberFile(self.archive_path, offset, size), COPY_BUFFER_SIZE),
+                                encoding='utf-8')
+
+    def file_path(self, name):
+        # path of the member on disk, extracted on first access
+        path = '%s/%s' % (self.extract_path, name)
+        member = self._index.get(name)
+        if member is None or member[0] is None or (os.path.exists(path) and os.path.getsize(path) == member[1]):
+            return path
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())  # partitions may share the path
+        with _MemberFile(self.archive_path, member[0], member[1]) as member_file, open(tmp_path, 'wb') as output_file:
+            shutil.copyfileobj(member_file, output_file, COPY_BUFFER_SIZE)
+        os.replace(tmp_path, path)
+        return path
+
+    def history_ids(self, history_type):
+        return sorted(int(m.group(2)) for m in map(HISTORY_FILE_RE.match, self._index)
+                      if m and m.group(1) == history_type)
+
+    def iter_json_members(self):
+        if not self.single_pass:
+            yield from super().iter_json_members()
+            return
+
+        logger.info('Reading %s in a single pass' % self.description())
+        self._index = {}
+        archive_file = sys.stdin.buffer if self.archive_path == STDIN_ARCHIVE else open(self.archive_path, 'rb')
+        try:
+            with tarfile.open(fileobj=archive_file, mode='r|*') as tar:
+                for info in tar:
+                    tar.members = []
+                    name = export_relative_name(info.name)
+                    if not info.isfile() or not name:
+                        continue
+                    self._index[name] = [None, info.size, int(info.mtime)]
+                    member_file = tar.extractfile(info)
+                    if HISTORY_FILE_RE.match(name):
+                        # history files are only needed once, they are not written to disk.
+                        # Members of a stream are not seekable, as required by io.TextIOWrapper.
+                        yield name, codecs.getreader('utf-8')(member_file)
+                        continue
+                    path = '%s/%s' % (self.extract_path, name)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'wb') as output_file:
+                        shutil.copyfileobj(member_file, output_file, COPY_BUFFER_SIZE)
+                    if name in ('users.json', 'rooms.json'):
+                        with open(path, 'r', encoding='utf-8') as json_file:
+                            yield name, json_file
+        finally:
+            if archive_file is not sys.stdin.buffer:
+                archive_file.close()
+        self._store_index()
+
+
+def open_source(input_path, extract_path, index_path):
+    # the extracted export directory, or the tar archive of the export ('-' for stdin)
+    if input_path != STDIN_ARCHIVE and os.path.isdir(input_path):
+        return DirectorySource(input_path)
+    return TarSource(input_path, extract_path, index_path)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# Sorts the lines of import files by a key (e.g. the create_at of posts) within a memory budget. Lines are collected
+# until the budget is exhausted, then sorted and spilled as a run to a temporary file, finally all runs are merged.
+# The sort is stable: lines with equal keys stay in the order of the input. Files already in order are not rewritten.
+# Sorted files (e.g. of several partitions) can be merged into one.
+
+import heapq
+import json
+import os
+
+DEFAULT_MEMORY_BUDGET_MB = 256
+LINE_OVERHEAD_BYTES = 120  # rough size of the Python objects holding a line and its key besides the line itself
+MAX_MERGE_FAN_IN = 64  # runs merged at once, limits the number of open files
+BUFFER_SIZE = 1024 * 1024
+
+
+class ExternalSorter:
+    def __init__(self, spill_path, memory_budget_bytes=DEFAULT_MEMORY_BUDGET_MB * 1024 * 1024):
+        self.spill_path = spill_path
+        self.memory_budget_bytes = memory_budget_bytes
+        self.files_sorted = 0
+        self.files_in_order = 0
+        self.runs_spilled = 0
+        self._run_counter = 0
+
+    def _run_file_path(self):
+        self._run_counter += 1
+        return '%s/run_%d_%d.tmp' % (self.spill_path, os.getpid(), self._run_counter)
+
+    def _spill(self, entries):
+        # entries are sorted, keys are written in front of the lines to not parse the lines again when merging
+        if not os.path.exists(self.spill_path):
+            os.makedirs(self.spill_path, exist_ok=True)
+        path = self._run_file_path()
+        with open(path, 'w', buffering=BUFFER_SIZE) as run_file:
+            for key, line in entries:
+                run_file.write('%s\t%s' % (json.dumps(key), line))
+        self.runs_spilled += 1
+        return path
+
+    @staticmethod
+    def _read_run(path):
+        with open(path, 'r', buffering=BUFFER_SIZE) as run_file:
+            for run_line in run_file:
+                key, _, line = run_line.partition('\t')
+                yield json.loads(key), line
+
+    def _merge_runs(self, run_paths):
+        # consecutive runs are merged first, so lines with equal keys keep their order
+        while len(run_paths) > MAX_MERGE_FAN_IN:
+            merged_path = self._spill(heapq.merge(*map(self._read_run, run_paths[:MAX_MERGE_FAN_IN]),
+                                                  key=lambda e: e[0]))
+            for path in run_paths[:MAX_MERGE_FAN_IN]:
+                os.unlink(path)
+            run_paths = [merged_path] + run_paths[MAX_MERGE_FAN_IN:]
+        return run_paths
+
+    def _is_in_order(self, path, key, header_lines):
+        with open(path, 'r', buffering=BUFFER_SIZE) as input_file:
+            for _ in range(header_lines):
+                next(input_file, None)
+            previous_key = None
+            for line in input_file:
+                line_key = key(line)
+                if previous_key is not None and line_key < previous_key:
+                    return False
+                previous_key = line_key
+        return True
+
+    def sort_file(self, path, key, header_lines=1):
+        # sorts the file in place, the header lines (e.g. the version line) are kept on top.
+        # Returns whether the file had to be rewritten.
+        if self._is_in_order(path, key, header_lines):
+            self.files_in_order += 1
+            return False
+
+        run_paths = []
+        entries = []
+        used_bytes = 0
+        with open(path, 'r', buffering=BUFFER_SIZE) as input_file:
+            header = [next(input_file, '') for _ in range(header_lines)]
+            for line in input_file:
+                if not line.endswith('\n'):
+                    line += '\n'  # last line of the file, may end up anywhere
+                entries.append((key(line), line))
+                used_bytes += len(line) + LINE_OVERHEAD_BYTES
+                if used_bytes >= self.memory_budget_bytes:
+                    entries.sort(key=lambda e: e[0])
+                    run_paths.append(self._spill(entries))
+                    entries = []
+                    used_bytes = 0
+        entries.sort(key=lambda e: e[0])
+
+        run_paths = self._merge_runs(run_paths)
+        try:
+            # the last run is still in memory and merged from there
+            runs = [self._read_run(p) for p in run_paths] + [iter(entries)]
+            tmp_path = '%s.%d.sorting' % (path, os.getpid())
+            with open(tmp_path, 'w', buffering=BUFFER_SIZE) as output_file:
+                output_file.writelines(header)
+                for _, line in heapq.merge(*runs, key=lambda e: e[0]):
+                    output_file.write(line)
+            os.replace(tmp_path, path)
+        finally:
+            for run_path in run_paths:
+                os.unlink(run_path)
+        self.files_sorted += 1
+        return True
+
+    def merge_files(self, paths, output_path, key, header_lines=1):
+        # merges files sorted by key (e.g. by sort_file) into one, the header lines are taken from the first file
+        input_files = [open(p, 'r', buffering=BUFFER_SIZE) for p in paths]
+        try:
+            header = [next(input_files[0], '') for _ in range(header_lines)] if input_files else []
+            for input_file in input_files[1:]:
+                for _ in range(header_lines):
+                    next(input_file, None)
+            tmp_path = '%s.%d.merging' % (output_path, os.getpid())
+            with open(tmp_path, 'w', buffering=BUFFER_SIZE) as output_file:
+                output_file.writelines(header)
+                for line in heapq.merge(*input_files, key=key):
+                    output_file.write(line if line.endswith('\n') else line + '\n')
+            os.replace(tmp_path, output_path)
+        finally:
+            for input_file in input_files:
+                input_file.close()
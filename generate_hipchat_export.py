@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+# Generates a synthetic Hipchat export to measure migratemost without real customer data.
+# The output is deterministic for a given seed and scale, so runs on different machines or commits are comparable.
+
+import base64
+import datetime
+import json
+import logging
+import os
+import random
+import struct
+import zlib
+from optparse import OptionParser
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+START_DATE = datetime.datetime(2014, 1, 1)
+HISTORY_DAYS = 5 * 365
+OVERSIZED_IMAGE_SIZE = (6000, 4100)  # more pixels than MM_MAX_IMAGE_PIXELS of migratemost
+LONG_MESSAGE_LENGTH_RANGE = (16384, 60000)  # longer than MM_MAX_MESSAGE_LENGTH, will be split
+
+ASCII_WORDS = ['deploy', 'build', 'merge', 'review', 'coffee', 'meeting', 'release', 'ticket', 'server', 'lunch',
+               'the', 'is', 'on', 'and', 'a', 'please', 'check', 'done', 'broken', 'fixed', 'why', 'today']
+UNICODE_WORDS = [u'Grüße', u'naïve', u'日本語', u'中文', u'Ελληνικά', u'русский', u'עברית', u'العربية', u'😀', u'🚀',
+                 u'crème brûlée', u'Zürich', u'ß', u'ﬁ', u'​']
+EMOTICONS = ['(thumbsup)', '(thumbsdown)', '(oops)', '(embarrassed)', '(party)', '(shipit)', '(facepalm)', '(coffee)']
+
+option_output_path = '.'
+option_seed = 42
+option_user_count = 200
+option_room_count = 50
+option_room_message_count = 50000
+option_direct_message_count = 20000
+option_skew = 1.2
+option_attachment_ratio = 0.01
+option_oversized_image_ratio = 0.1
+option_long_message_ratio = 0.001
+option_unicode_ratio = 0.2
+option_emoticon_ratio = 0.1
+option_avatar_ratio = 0.8
+
+
+def _png(width, height, seed=0):
+    # minimal grayscale PNG, rows are constant so even huge images compress to a few kB
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    row = b'\x00' + bytes([seed % 256]) * width
+    raw = zlib.compress(row * height, 9)
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', raw) + chunk(b'IEND', b'')
+
+
+def _zipf_counts(total, n, skew, rnd):
+    # distributes total over n buckets following a zipf distribution, the bucket order is shuffled
+    weights = [1.0 / (i + 1) ** skew for i in range(n)]
+    weight_sum = sum(weights)
+    counts = [int(total * w / weight_sum) for w in weights]
+    for i in range(total - sum(counts)):
+        counts[i % n] += 1
+    rnd.shuffle(counts)
+    return counts
+
+
+def _timestamp(milliseconds):
+    d = START_DATE + datetime.timedelta(milliseconds=milliseconds)
+    return d.strftime('%Y-%m-%dT%H:%M:%SZ %f')
+
+
+def _timestamps(count, rnd):
+    # bursty: messages come in conversations of several messages only seconds apart, some in the same millisecond
+    timestamps = []
+    current = rnd.randint(0, HISTORY_DAYS * 86400000 // 10)
+    remaining_span = HISTORY_DAYS * 86400000 - current
+    average_gap = max(remaining_span // max(count, 1), 1)
+    for _ in range(count):
+        if rnd.random() < 0.7:
+            current += rnd.choice([0, 0, 1, rnd.randint(1000, 60000)])
+        else:
+            current += rnd.randint(1, 2 * average_gap)
+        timestamps.append(current)
+    return timestamps
+
+
+class _Generator:
+    def __init__(self, output_path, seed):
+        self.output_path = output_path
+        self.rnd = random.Random(seed)
+        self.message_id = 0
+        self.attachment_id = 0
+        self.oversized_image = None
+        self.file_count = 0
+        self.file_bytes = 0
+
+    def _write_json(self, relative_path, obj):
+        path = os.path.join(self.output_path, relative_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, ensure_ascii=False)
+
+    def _write_history(self, relative_path, messages):
+        path = os.path.join(self.output_path, relative_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('[')
+            for i, m in enumerate(messages):
+                f.write(',\n' if i > 0 else '\n')
+                f.write(json.dumps(m, ensure_ascii=False))
+            f.write('\n]\n')
+
+    def _text(self):
+        rnd = self.rnd
+        if rnd.random() < option_long_message_ratio:
+            length = rnd.randint(*LONG_MESSAGE_LENGTH_RANGE)
+            words = []
+            current_length = 0
+            while current_length < length:
+                words.append(rnd.choice(ASCII_WORDS))
+                current_length += len(words[-1]) + 1
+            return ' '.join(words)
+        words = [rnd.choice(ASCII_WORDS) for _ in range(rnd.randint(1, 25))]
+        if rnd.random() < option_unicode_ratio:
+            for _ in range(rnd.randint(1, 5)):
+                words.insert(rnd.randint(0, len(words)), rnd.choice(UNICODE_WORDS))
+        if rnd.random() < option_emoticon_ratio:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(EMOTICONS))
+        message = ' '.join(words)
+        prefix = rnd.random()
+        if prefix < 0.02:
+            return '/code def %s():\n    return 42' % words[0]
+        if prefix < 0.04:
+            return '/quote %s' % message
+        return message
+
+    def _attachment(self, files_path):
+        rnd = self.rnd
+        self.attachment_id += 1
+        if rnd.random() < option_oversized_image_ratio:
+            if self.oversized_image is None:
+                self.oversized_image = _png(*OVERSIZED_IMAGE_SIZE)
+            name = 'screenshot_%d.png' % self.attachment_id
+            data = self.oversized_image
+        elif rnd.random() < 0.5:
+            name = 'image_%d.png' % self.attachment_id
+            data = _png(rnd.randint(16, 640), rnd.randint(16, 480), self.attachment_id)
+        else:
+            name = u'dokument_%d_übersicht.txt' % self.attachment_id
+            data = (u'%s\n' % self._text()).encode('utf-8') * rnd.randint(1, 200)
+        relative_path = '%d/%s' % (self.attachment_id, name)
+        full_path = os.path.join(self.output_path, files_path, relative_path)
+        os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'wb') as f:
+            f.write(data)
+        self.file_count += 1
+        self.file_bytes += len(data)
+        return {'name': name, 'path': relative_path, 'size': len(data)}
+
+    def _message(self, message_type, milliseconds, sender, files_path, receiver=None):
+        self.message_id += 1
+        message = {'id': 'msg-%08d' % self.message_id,
+                   'timestamp': _timestamp(milliseconds),
+                   'sender': {'id': sender['id'], 'name': sender['name'], 'mention_name': sender['mention_name']},
+                   'message': self._text(),
+                   'attachment': self._attachment(files_path) if self.rnd.random() < option_attachment_ratio else None}
+        if receiver is not None:
+            message['receiver'] = {'id': receiver['id'], 'name': receiver['name'],
+                                   'mention_name': receiver['mention_name']}
+        return {message_type: message}
+
+    def users(self, count):
+        rnd = self.rnd
+        users = []
+        for i in range(count):
+            user_id = i + 1
+            unicode_name = rnd.random() < option_unicode_ratio
+            first_name = rnd.choice([u'Jürg', u'Zoë', u'Łukasz', u'Søren']) if unicode_name else 'User'
+            mention_name = '%s%d' % (first_name.replace(' ', ''), user_id)
+            user = {'id': user_id,
+                    'name': u'%s Number%d' % (first_name, user_id),
+                    'mention_name': mention_name,
+                    'email': 'user%d@example.com' % user_id if rnd.random() > 0.02 else None,
+                    'title': rnd.choice(['', 'Developer', 'Manager', u'Ingénieur']),
+                    'roles': ['admin', 'user'] if rnd.random() < 0.02 else ['user'],
+                    'is_deleted': rnd.random() < 0.05,
+                    'avatar': base64.b64encode(_png(48, 48, user_id)).decode('ascii')
+                    if rnd.random() < option_avatar_ratio else None}
+            users.append(user)
+        return users
+
+    def rooms(self, count, users):
+        rnd = self.rnd
+        rooms = []
+        for i in range(count):
+            room_id = i + 1
+            private = rnd.random() < 0.3
+            members = [u['id'] for u in rnd.sample(users, min(len(users), rnd.randint(2, 30)))] if private else []
+            owner = rnd.choice(users)['id']
+            room = {'id': room_id,
+                    'name': rnd.choice([u'Team %d', u'Projekt Überflieger %d', u'dev-ops %d', u'日本 %d']) % room_id,
+                    'privacy': 'private' if private else 'public',
+                    'is_archived': rnd.random() < 0.1,
+                    'room_admins': [owner],
+                    'owner': owner,
+                    'members': members,
+                    'participants': [],
+                    'topic': self._text()[:250] if rnd.random() < 0.5 else ''}
+            rooms.append(room)
+        return rooms
+
+    def room_history(self, room, message_count, users):
+        rnd = self.rnd
+        sender_weights = [1.0 / (i + 1) ** option_skew for i in range(len(users))]
+        senders = rnd.choices(users, weights=sender_weights, k=message_count) if message_count > 0 else []
+        files_path = 'rooms/%d/files' % room['id']
+        for milliseconds, sender in zip(_timestamps(message_count, rnd), senders):
+            if rnd.random() < 0.01:
+                yield {'NotificationMessage': {'id': 'n-%d' % milliseconds, 'timestamp': _timestamp(milliseconds),
+                                               'sender': 'JIRA', 'message': 'Issue updated', 'attachment': None}}
+            yield self._message('UserMessage', milliseconds, sender, files_path)
+
+    def direct_histories(self, message_count, users):
+        rnd = self.rnd
+        histories = dict((u['id'], []) for u in users)
+        pair_count = max(min(len(users) * 5, message_count // 5), 1)
+        pairs = [tuple(rnd.sample(users, 2)) if len(users) > 1 else (users[0], users[0]) for _ in range(pair_count)]
+        for pair, count in zip(pairs, _zipf_counts(message_count, pair_count, option_skew, rnd)):
+            for milliseconds in _timestamps(count, rnd):
+                sender, receiver = pair if rnd.random() < 0.5 else (pair[1], pair[0])
+                message = self._message('PrivateUserMessage', milliseconds, sender, 'users/files', receiver)
+                histories[sender['id']].append((milliseconds, message))
+                if receiver['id'] != sender['id']:
+                    histories[receiver['id']].append((milliseconds, message))
+        return histories
+
+    def generate(self):
+        logger.info('Generating %d users' % option_user_count)
+        users = self.users(option_user_count)
+        self._write_json('users.json', [{'User': u} for u in users])
+
+        logger.info('Generating %d rooms with %d messages' % (option_room_count, option_room_message_count))
+        rooms = self.rooms(option_room_count, users)
+        self._write_json('rooms.json', [{'Room': r} for r in rooms])
+        room_message_counts = _zipf_counts(option_room_message_count, option_room_count, option_skew, self.rnd)
+        for room, message_count in zip(rooms, room_message_counts):
+            self._write_history('rooms/%d/history.json' % room['id'], self.room_history(room, message_count, users))
+
+        logger.info('Generating %d direct messages' % option_direct_message_count)
+        histories = self.direct_histories(option_direct_message_count, users)
+        for user_id, history in histories.items():
+            if len(history) > 0 or self.rnd.random() < 0.5:  # some users have no history file at all
+                history.sort(key=lambda m: m[0])
+                self._write_history('users/%d/history.json' % user_id, (m for _, m in history))
+
+        logger.info('Generated export at %s (%d messages, %d attachments with %d MB)' % (
+            self.output_path, self.message_id, self.file_count, self.file_bytes // (1024 * 1024)))
+
+
+def generate_export(output_path, seed=option_seed):
+    _Generator(output_path, seed).generate()
+
+
+def parse_arguments():
+    global option_output_path
+    global option_seed
+    global option_user_count
+    global option_room_count
+    global option_room_message_count
+    global option_direct_message_count
+    global option_skew
+    global option_attachment_ratio
+    global option_oversized_image_ratio
+    global option_long_message_ratio
+    global option_unicode_ratio
+    global option_emoticon_ratio
+
+    parser = OptionParser(usage='''
+        usage: %prog [options]
+        Generates a synthetic Hipchat export (users.json, rooms.json, histories and attachments) to benchmark migratemost.
+        The same seed and options always produce the same export.
+    ''')
+    parser.add_option('-o', '--output-path', dest='output_path', action='store', type='string',
+                      help='Directory where the export will be generated (mandatory, must not exist yet)')
+    parser.add_option('--seed', dest='seed', action='store', type='int', default=option_seed,
+                      help='Seed of the random generator (default: %default)')
+    parser.add_option('--users', dest='users', action='store', type='int', default=option_user_count,
+                      help='Number of users (default: %default)')
+    parser.add_option('--rooms', dest='rooms', action='store', type='int', default=option_room_count,
+                      help='Number of rooms (default: %default)')
+    parser.add_option('--room-messages', dest='room_messages', action='store', type='int',
+                      default=option_room_message_count,
+                      help='Total number of messages in all rooms (default: %default)')
+    parser.add_option('--direct-messages', dest='direct_messages', action='store', type='int',
+                      default=option_direct_message_count,
+                      help='Total number of 1:1 messages (default: %default)')
+    parser.add_option('--skew', dest='skew', action='store', type='float', default=option_skew,
+                      help='Zipf exponent of the distribution of messages over rooms, conversations and senders. '
+                           '0 distributes evenly, higher values produce a few huge rooms (default: %default)')
+    parser.add_option('--attachment-ratio', dest='attachment_ratio', action='store', type='float',
+                      default=option_attachment_ratio,
+                      help='Share of messages with an attachment (default: %default)')
+    parser.add_option('--oversized-image-ratio', dest='oversized_image_ratio', action='store', type='float',
+                      default=option_oversized_image_ratio,
+                      help='Share of attachments that are images exceeding the Mattermost pixel limit (default: %default)')
+    parser.add_option('--long-message-ratio', dest='long_message_ratio', action='store', type='float',
+                      default=option_long_message_ratio,
+                      help='Share of messages exceeding the Mattermost message length (default: %default)')
+    parser.add_option('--unicode-ratio', dest='unicode_ratio', action='store', type='float',
+                      default=option_unicode_ratio,
+                      help='Share of messages and names containing non-ASCII text (default: %default)')
+    parser.add_option('--emoticon-ratio', dest='emoticon_ratio', action='store', type='float',
+                      default=option_emoticon_ratio,
+                      help='Share of messages containing emoticons (default: %default)')
+
+    (options, args) = parser.parse_args()
+
+    if not options.output_path:
+        parser.error("Output path is mandatory")
+    if os.path.exists(options.output_path):
+        parser.error("Output path already exists: %s" % options.output_path)
+    if options.users < 1 or options.rooms < 1:
+        parser.error("At least one user and one room are required")
+
+    option_output_path = os.path.abspath(options.output_path)
+    option_seed = options.seed
+    option_user_count = options.users
+    option_room_count = options.rooms
+    option_room_message_count = options.room_messages
+    option_direct_message_count = options.direct_messages
+    option_skew = options.skew
+    option_attachment_ratio = options.attachment_ratio
+    option_oversized_image_ratio = options.oversized_image_ratio
+    option_long_message_ratio = options.long_message_ratio
+    option_unicode_ratio = options.unicode_ratio
+    option_emoticon_ratio = options.emoticon_ratio
+
+
+def main():
+    parse_arguments()
+    os.makedirs(option_output_path)
+    generate_export(option_output_path, option_seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Incremental parsing of the large JSON arrays of the Hipchat export (users.json, rooms.json, history.json),
+# so that only one element at a time has to be held in memory.
+
+import json
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARACTERS = set('0123456789.eE+-')
+_decoder = json.JSONDecoder()
+
+
+class _ChunkReader:
+    def __init__(self, json_file, chunk_size):
+        self._file = json_file
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        data = self._file.read(self._chunk_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._position:] + data
+        self._position = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in _WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer) or not self._fill():
+                break
+        return self._buffer[self._position] if self._position < len(self._buffer) else ''
+
+    def consume(self, expected):
+        found = self.peek()
+        if not found or found not in expected:
+            raise ValueError('Expected one of %r but found %r' % (expected, found or 'end of file'))
+        self._position += 1
+        return found
+
+    def _is_truncated_number(self, value, end):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+        return all(c in _NUMBER_CHARACTERS for c in self._buffer[end:])
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue  # element continues in the next chunk
+                raise
+            # a number at the end of the buffer could still continue in the next chunk
+            if self._is_truncated_number(value, end) and self._fill():
+                continue
+            self._position = end
+            return value
+
+
+def iter_json_array(json_file, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Yields the elements of the top level array of an opened (text mode) JSON file one by one
+    reader = _ChunkReader(json_file, chunk_size)
+    reader.consume('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.decode()
+        if reader.consume(',]') == ']':
+            return
+
+
+def iter_json_array_file(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    with open(path, 'r', encoding='utf-8') as json_file:
+        for element in iter_json_array(json_file, chunk_size):
+            yield element
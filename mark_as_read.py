@@ -1,47 +1,94 @@
 #!/usr/bin/env python3
 
 from __future__ import print_function
-from urllib.parse import urlparse
-import urllib3, base64, json, urllib, sys
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json, os, sys, threading, time
+import urllib3
 from optparse import OptionParser
 import getpass
 
-def _create_request(url, params='', is_post=False):
-    if is_post:
-        request = urllib3.Request(url=url, data=params)
-    else:
-        request = urllib3.Request(url + params)
-
-    request.add_header("Authorization", "Bearer %s" % (access_token))
-    request.add_header("Content-Type", "application/json")
-    request.add_header("Accept", "application/json")
-    return request
-
-def fetch_and_parse(request):
-    response = fetch(request)
-    return json.loads(response.read())
-
-def fetch(request):
-    try:
-        response = urllib3.urlopen(request)
-        return response
-    except urllib3.HTTPError as e:
-        print(e.code)
-        print(e.read())
-        exit(1)
-    except urllib3.URLError as e:
-        print(e.args)
-        print(e.read())
-        exit(1)
+DEFAULT_WORKERS = 8
+DEFAULT_CHECKPOINT_FILE = './mark_as_read.checkpoint'
+DEFAULT_MAX_REQUESTS_PER_SECOND = 50.0
+MAX_RETRIES = 6
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+http = None
+rate_limiter = None
+
+
+class MattermostApiError(Exception):
+    pass
+
+
+class RateLimiter:
+    # Spaces requests of all workers evenly, so the server sees at most the given number of requests per second
+    def __init__(self, max_requests_per_second):
+        self._interval = 1.0 / max_requests_per_second if max_requests_per_second > 0 else 0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self._interval == 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _headers():
+    return {"Authorization": "Bearer %s" % (access_token),
+            "Content-Type": "application/json",
+            "Accept": "application/json"}
+
+def _retry_delay(response, attempt):
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return min(2 ** attempt, 60)
+
+def fetch(url, params=None, is_post=False):
+    method = 'POST' if is_post else 'GET'
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.wait()
+        response = None
+        try:
+            response = http.request(method, url, body=params, headers=_headers(), retries=False)
+        except urllib3.exceptions.HTTPError as e:
+            error = str(e)  # connection problems are retried as well
+        else:
+            if response.status < 300:
+                return response
+            error = 'HTTP %d: %s' % (response.status, response.data[:200])
+            if response.status not in RETRY_STATUS_CODES:
+                raise MattermostApiError('%s %s failed with %s' % (method, url, error))
+        if attempt < MAX_RETRIES:
+            time.sleep(_retry_delay(response, attempt))
+    raise MattermostApiError('%s %s failed after %d retries with %s' % (method, url, MAX_RETRIES, error))
+
+def fetch_and_parse(url):
+    response = fetch(url)
+    return json.loads(response.data)
 
 def channels_of_member(user_id, team_id):
-    return fetch_and_parse(_create_request("%s/users/%s/teams/%s/channels/members" % (base_url, user_id, team_id)))
+    return fetch_and_parse("%s/users/%s/teams/%s/channels/members" % (base_url, user_id, team_id))
+
+def channels_of_user(user_id, team_id):
+    return fetch_and_parse("%s/users/%s/teams/%s/channels" % (base_url, user_id, team_id))
 
 def find_team(name):
-    return fetch_and_parse(_create_request("%s/teams/name/%s" % (base_url, name)))
+    return fetch_and_parse("%s/teams/name/%s" % (base_url, name))
 
 def get_users_for_team(team_id, page):
-    return fetch_and_parse(_create_request("%s/teams/%s/members?per_page=200&page=%d" % (base_url, team_id, page)))
+    return fetch_and_parse("%s/teams/%s/members?per_page=200&page=%d" % (base_url, team_id, page))
 
 def all_users_of_team(team_id):
     members = []
@@ -62,21 +109,62 @@ def mark_channel_as_read(user_id, channel_id):
     channel[u'channel_id'] = channel_id
     channel[u'prev_channel_id'] = ''
     channel_json = json.dumps(channel)
-    fetch(_create_request("%s/channels/members/%s/view" % (base_url, user_id), params=channel_json, is_post=True))
+    fetch("%s/channels/members/%s/view" % (base_url, user_id), params=channel_json, is_post=True)
 
 def mark_all_channels_of_member_as_read(user_id, team_id):
-    print("Marking all channels as read for user %s:" % (user_id))
+    last_post_at_by_channel_id = dict((c[u'id'], c[u'last_post_at']) for c in channels_of_user(user_id, team_id))
     channels = channels_of_member(user_id, team_id)
+    marked_count = 0
     for c in channels:
-        print('.', end='')
-        sys.stdout.flush()
+        # channels without posts since the user last viewed them are already read
+        last_post_at = last_post_at_by_channel_id.get(c[u'channel_id'])
+        if last_post_at is not None and c[u'last_viewed_at'] >= last_post_at:
+            continue
         mark_channel_as_read(user_id, c[u'channel_id'])
-    print("")
+        marked_count += 1
+    return marked_count, len(channels) - marked_count
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as checkpoint_file:
+        return set(line.strip() for line in checkpoint_file if line.strip())
+
+def mark_all_members_as_read(members, team_id, checkpoint_path):
+    completed_members = load_checkpoint(checkpoint_path)
+    pending_members = [m for m in members if m[u'user_id'] not in completed_members]
+    if len(pending_members) < len(members):
+        print("Skipping %d users already completed according to checkpoint file %s" % (
+            len(members) - len(pending_members), checkpoint_path))
+
+    failed_members = []
+    # one worker per user keeps the requests of a user in order, the pool is shared by all workers
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(checkpoint_path, 'a') as checkpoint_file:
+        futures = dict((executor.submit(mark_all_channels_of_member_as_read, m[u'user_id'], team_id), m[u'user_id'])
+                       for m in pending_members)
+        for i, future in enumerate(as_completed(futures)):
+            member_id = futures[future]
+            try:
+                marked_count, skipped_count = future.result()
+            except MattermostApiError as e:
+                print("Failed to mark channels as read for user %s: %s" % (member_id, e))
+                failed_members.append(member_id)
+                continue
+            checkpoint_file.write(member_id + '\n')
+            checkpoint_file.flush()
+            print("Marked %d channels as read for user %s, %d were already read (%d/%d)" % (
+                marked_count, member_id, skipped_count, i + 1, len(pending_members)))
+            sys.stdout.flush()
+    return failed_members
 
 def get_arguments():
     global base_url
     global team_name
     global access_token
+    global workers
+    global checkpoint_path
+    global http
+    global rate_limiter
 
     parser = OptionParser(usage =
         '''usage: %prog [options]
@@ -98,6 +186,24 @@ def get_arguments():
                       action="store",
                       type="string",
                       help="A valid Mattermost API access token (optional, can be entered interactively)")
+    parser.add_option("-w", "--workers",
+                      dest="workers",
+                      action="store",
+                      type="int",
+                      default=DEFAULT_WORKERS,
+                      help="Number of users processed in parallel (default: %default)")
+    parser.add_option("-r", "--max-requests-per-second",
+                      dest="max_requests_per_second",
+                      action="store",
+                      type="float",
+                      default=DEFAULT_MAX_REQUESTS_PER_SECOND,
+                      help="Upper limit of requests per second sent to Mattermost by all workers together, 0 disables the limit (default: %default)")
+    parser.add_option("-c", "--checkpoint-file",
+                      dest="checkpoint_file",
+                      action="store",
+                      type="string",
+                      default=DEFAULT_CHECKPOINT_FILE,
+                      help="File recording the users that are completely marked as read. Users listed there are skipped, so an interrupted run can be restarted. Delete it to start over (default: %default)")
     (options, args) = parser.parse_args()
 
     if options.base_url is None:
@@ -107,13 +213,23 @@ def get_arguments():
     if options.team is None:
         parser.error("Team parameter is mandatory")
 
+    if options.workers < 1:
+        parser.error("Number of workers must be at least 1")
+
+    if options.max_requests_per_second < 0:
+        parser.error("Maximum requests per second must not be negative")
+
     if options.token is None:
         access_token = getpass.getpass('Mattermost API access token:')
     else:
         access_token = options.token
 
-    base_url = urlparse.urljoin(options.base_url, '/api/v4')
+    base_url = urljoin(options.base_url, '/api/v4')
     team_name = options.team
+    workers = options.workers
+    checkpoint_path = options.checkpoint_file
+    http = urllib3.PoolManager(maxsize=workers, block=True, timeout=urllib3.Timeout(connect=10, read=60))
+    rate_limiter = RateLimiter(options.max_requests_per_second)
     print("team_name", team_name)
     print("base_url = ", base_url)
     print("options.base_url", options.base_url)
@@ -121,11 +237,16 @@ def get_arguments():
 def main():
     get_arguments()
 
-    team = find_team(team_name)
-    members = all_users_of_team(team[u'id'])
-    for m in members:
-        member_id = m[u'user_id']
-        mark_all_channels_of_member_as_read(member_id, team[u'id'])
+    try:
+        team = find_team(team_name)
+        members = all_users_of_team(team[u'id'])
+    except MattermostApiError as e:
+        print(e)
+        exit(1)
+    failed_members = mark_all_members_as_read(members, team[u'id'], checkpoint_path)
+    if len(failed_members) > 0:
+        print("Failed to mark channels as read for %d users: %s" % (len(failed_members), ' '.join(failed_members)))
+        exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Merges several (e.g. yearly) Hipchat exports into one export directory. Replacement for concat_partial_export.sh:
+# the room and user histories are merged as a stream ordered by timestamp and deduplicated by message id,
+# attachments and metadata are hard linked instead of copied.
+
+import errno
+import heapq
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+
+import external_sort
+from json_stream import iter_json_array_file
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+HISTORY_FILENAME = 'history.json'
+HISTORY_TYPES = ['rooms', 'users']
+
+option_source_paths = []
+option_target_path = ''
+option_workers = os.cpu_count()
+option_sort_memory_mb = external_sort.DEFAULT_MEMORY_BUDGET_MB
+
+
+def _message_of(element):
+    # history elements are wrapped by their type, e.g. {"UserMessage": {...}}
+    return next(iter(element.values()))
+
+
+def _message_sort_key(element):
+    # timestamps look like "2017-05-16T12:09:26Z 851418", the fraction is padded to compare the strings
+    date, _, fraction = _message_of(element)['timestamp'].partition(' ')
+    return '%s %s' % (date, fraction.ljust(6, '0'))
+
+
+class UnorderedHistoryError(Exception):
+    def __init__(self, history_file_path):
+        Exception.__init__(self, 'History %s is not ordered by timestamp' % history_file_path)
+        self.history_file_path = history_file_path
+
+
+def _is_history_file(relative_path):
+    parts = relative_path.split(os.sep)
+    return len(parts) == 3 and parts[0] in HISTORY_TYPES and parts[2] == HISTORY_FILENAME
+
+
+def _link_file(source_file_path, target_file_path):
+    if os.path.exists(target_file_path):
+        if os.path.samefile(source_file_path, target_file_path):
+            return False
+        os.unlink(target_file_path)  # file of a newer export replaces the older one
+    try:
+        os.link(source_file_path, target_file_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(source_file_path, target_file_path)  # hard links are not possible across file systems
+    return True
+
+
+def sync_structure(source_paths, target_path):
+    # Links everything but the histories into the target, files of later sources replace the ones of earlier sources.
+    # Returns the history files of all sources by (type, id), in the order of the sources.
+    history_files = {}
+    for source_path in source_paths:
+        linked_count = 0
+        for directory, _, filenames in os.walk(source_path):
+            relative_directory = os.path.relpath(directory, source_path)
+            target_directory = os.path.normpath(os.path.join(target_path, relative_directory))
+            if not os.path.exists(target_directory):
+                os.makedirs(target_directory)
+            for filename in filenames:
+                relative_path = os.path.normpath(os.path.join(relative_directory, filename))
+                source_file_path = os.path.join(directory, filename)
+                if _is_history_file(relative_path):
+                    history_type, history_id, _ = relative_path.split(os.sep)
+                    history_files.setdefault((history_type, history_id), []).append(source_file_path)
+                elif _link_file(source_file_path, os.path.join(target_path, relative_path)):
+                    linked_count += 1
+        logger.info('Linked %d files from %s' % (linked_count, source_path))
+    return history_files
+
+
+def _ordered_stream(history_file_path):
+    # histories are usually in chronological order, which is checked while they are merged
+    previous_sort_key = None
+    for element in iter_json_array_file(history_file_path):
+        sort_key = _message_sort_key(element)
+        if previous_sort_key is not None and sort_key < previous_sort_key:
+            raise UnorderedHistoryError(history_file_path)
+        previous_sort_key = sort_key
+        yield element
+
+
+def _sort_history(history_file_path, sorted_file_path, sort_memory_bytes):
+    # writes the messages as lines prefixed by their sort key and sorts them within the memory budget
+    with open(sorted_file_path, 'w', encoding='utf-8') as sorted_file:
+        for element in iter_json_array_file(history_file_path):
+            sorted_file.write('%s\t%s\n' % (_message_sort_key(element), json.dumps(element, ensure_ascii=False)))
+    sorter = external_sort.ExternalSorter(os.path.dirname(sorted_file_path), sort_memory_bytes)
+    sorter.sort_file(sorted_file_path, lambda line: line.partition('\t')[0], header_lines=0)
+
+
+def _sorted_stream(sorted_file_path):
+    with open(sorted_file_path, 'r', encoding='utf-8') as sorted_file:
+        for line in sorted_file:
+            yield json.loads(line.partition('\t')[2])
+
+
+def _write_history(message_streams, target_file_path):
+    in_count = 0
+    out_count = 0
+    seen_ids = set()
+
+    tmp_file_path = target_file_path + '.tmp'
+    with open(tmp_file_path, 'w', encoding='utf-8') as target_file:
+        target_file.write('[')
+        for element in heapq.merge(*message_streams, key=_message_sort_key):
+            in_count += 1
+            message_id = _message_of(element).get('id')
+            if message_id is not None:
+                if message_id in seen_ids:
+                    continue
+                seen_ids.add(message_id)
+            target_file.write(',\n' if out_count > 0 else '\n')
+            target_file.write(json.dumps(element, ensure_ascii=False))
+            out_count += 1
+        target_file.write('\n]\n')
+    os.replace(tmp_file_path, target_file_path)
+    return in_count, out_count
+
+
+def merge_history(history_file_paths, target_file_path,
+                  sort_memory_bytes=external_sort.DEFAULT_MEMORY_BUDGET_MB * 1024 * 1024):
+    # k-way merge of the history files by timestamp. Overlapping exports may contain the same message with different
+    # timestamps, so duplicates are detected by the ids of all messages of the history, the earliest copy is kept.
+    # A history found out of order is sorted externally and the merge starts over.
+    sorted_file_paths = {}
+    try:
+        while True:
+            message_streams = [_sorted_stream(sorted_file_paths[p]) if p in sorted_file_paths else _ordered_stream(p)
+                               for p in history_file_paths]
+            try:
+                return _write_history(message_streams, target_file_path)
+            except UnorderedHistoryError as e:
+                logger.warning('%s, sorting it' % e)
+                sorted_file_path = '%s.%d.sorted' % (target_file_path, len(sorted_file_paths))
+                _sort_history(e.history_file_path, sorted_file_path, sort_memory_bytes)
+                sorted_file_paths[e.history_file_path] = sorted_file_path
+    finally:
+        for sorted_file_path in sorted_file_paths.values():
+            os.unlink(sorted_file_path)
+        if os.path.exists(target_file_path + '.tmp'):
+            os.unlink(target_file_path + '.tmp')
+
+
+def _merge_history_job(job):
+    history_file_paths, target_file_path, sort_memory_bytes = job
+    return merge_history(history_file_paths, target_file_path, sort_memory_bytes)
+
+
+def merge_exports(source_paths, target_path, workers=option_workers, sort_memory_mb=option_sort_memory_mb):
+    if not os.path.exists(target_path):
+        os.makedirs(target_path)
+
+    logger.info('Syncing structure and attachments into %s' % target_path)
+    history_files = sync_structure(source_paths, target_path)
+
+    logger.info('Merging %d room and user histories' % len(history_files))
+    units = sorted(history_files.keys())
+    jobs = [(history_files[u], os.path.join(target_path, u[0], u[1], HISTORY_FILENAME), sort_memory_mb * 1024 * 1024)
+            for u in units]
+    total_in_count = 0
+    total_out_count = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for unit, (in_count, out_count) in zip(units, executor.map(_merge_history_job, jobs)):
+            logger.debug('Merged history of %s/%s: %d messages, %d duplicates' % (
+                unit[0], unit[1], out_count, in_count - out_count))
+            total_in_count += in_count
+            total_out_count += out_count
+
+    logger.info('Merge finished: %d messages, %d duplicates removed' % (
+        total_out_count, total_in_count - total_out_count))
+
+
+def parse_arguments():
+    global option_source_paths
+    global option_target_path
+    global option_workers
+    global option_sort_memory_mb
+
+    parser = OptionParser(usage='''
+        usage: %prog [options] SOURCE_DIR [SOURCE_DIR ...]
+        Merges several Hipchat exports (the 'data' directories of the extracted exports) into one.
+        Source directories must be given from oldest to newest, newer exports take precedence for users.json,
+        rooms.json and attachments.
+        Files are hard linked into the target directory where possible, so do not modify them in place
+        (e.g. with --shrink-image-to-limit of migratemost.py) if the sources need to stay untouched.
+    ''')
+    parser.add_option('-o', '--target-path',
+                      type='string',
+                      action='store',
+                      dest='target_path',
+                      help='Directory that will hold the merged export (mandatory)')
+    parser.add_option('-w', '--workers',
+                      type='int',
+                      action='store',
+                      dest='workers',
+                      default=option_workers,
+                      help='Number of histories merged in parallel (default: %default)')
+    parser.add_option('--sort-memory',
+                      type='int',
+                      action='store',
+                      dest='sort_memory',
+                      default=option_sort_memory_mb,
+                      help='Memory in MB per worker to sort a history which is not ordered by timestamp, larger '
+                           'histories are sorted in runs spilled to disk (default: %default)')
+    parser.add_option('-v', '--verbose',
+                      dest='verbose',
+                      action='store_true',
+                      default=False,
+                      help='Enable verbose logging')
+
+    (options, args) = parser.parse_args()
+
+    if not options.target_path:
+        parser.error("Target path is mandatory")
+
+    if len(args) == 0:
+        parser.error("At least one source directory is required")
+
+    for source_path in args:
+        if not os.path.isdir(source_path):
+            parser.error("Source directory does not exist: %s" % source_path)
+
+    if options.workers < 1:
+        parser.error("Number of workers must be at least 1")
+
+    if options.sort_memory < 1:
+        parser.error("Sort memory must be at least 1 MB")
+
+    if options.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    option_source_paths = [os.path.abspath(p) for p in args]
+    option_target_path = os.path.abspath(options.target_path)
+    option_workers = options.workers
+    option_sort_memory_mb = options.sort_memory
+
+
+def main():
+    parse_arguments()
+    merge_exports(option_source_paths, option_target_path, option_workers, option_sort_memory_mb)
+
+
+if __name__ == "__main__":
+    main()
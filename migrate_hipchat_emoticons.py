@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 import logging
 import os
+import threading
 import urllib3
-from functools import reduce
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from optparse import OptionParser
 
 import hipchat_api
@@ -20,6 +23,10 @@ option_tokens = ''
 option_base_url = ''
 option_output_path = '.'
 option_migrate_global_emoticons = False
+option_download_workers = 8
+
+EMOJI_DOWNLOAD_DIRNAME = 'emojis'
+EMOJI_CACHE_FILENAME = 'emoji_cache.json'
 
 emoji_mapping = {
     "(thumbsup)": ":+1:",
@@ -28,11 +35,83 @@ emoji_mapping = {
     "(embarrassed)": ":flushed:",
 }
 
-def _download_file(url, output_path):
-    data = urllib3.urlopen(url)
-
-    with open(output_path, 'wb') as output_file:
-        output_file.write(data.read())
+def _load_download_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r') as cache_file:
+            return json.load(cache_file)
+    except ValueError as e:
+        logger.warning('Ignoring corrupt emoticon cache %s: %s' % (cache_path, str(e)))
+        return {}
+
+
+def _store_download_cache(cache, cache_path):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as cache_file:
+        json.dump(cache, cache_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _download_file(http, url, output_path, cache_entry=None):
+    # Returns the new cache entry and whether the file on disk has been (re)written.
+    # Validators of the previous download are only sent if the file is still on disk, as a 304 would leave us without it.
+    headers = {}
+    if cache_entry and cache_entry.get('path') != output_path:
+        cache_entry = None  # the file on disk may be the one of another url
+    if cache_entry and os.path.exists(output_path):
+        if cache_entry.get('etag'):
+            headers['If-None-Match'] = cache_entry['etag']
+        if cache_entry.get('last_modified'):
+            headers['If-Modified-Since'] = cache_entry['last_modified']
+
+    response = http.request('GET', url, headers=headers)
+    if response.status == 304:
+        return cache_entry, False
+    if response.status != 200:
+        raise IOError('Unexpected HTTP status %d when downloading %s' % (response.status, url))
+
+    data = response.data
+    sha256 = hashlib.sha256(data).hexdigest()
+    new_cache_entry = {'etag': response.headers.get('ETag'),
+                       'last_modified': response.headers.get('Last-Modified'),
+                       'sha256': sha256,
+                       'path': output_path}
+
+    # server without validator support: compare content hash to avoid rewriting an unchanged file
+    if os.path.exists(output_path):
+        known_sha256 = cache_entry.get('sha256') if cache_entry else None
+        if known_sha256 is None:
+            known_sha256 = _file_sha256(output_path)
+        if known_sha256 == sha256:
+            return new_cache_entry, False
+
+    tmp_path = '%s.%d.part' % (output_path, threading.get_ident())
+    with open(tmp_path, 'wb') as output_file:
+        output_file.write(data)
+    os.replace(tmp_path, output_path)
+    return new_cache_entry, True
+
+
+def _download_paths(urls, download_dir):
+    # Files are named like the url, urls with the same file name get the hash of the url appended to the name
+    basename_counts = Counter(url.split('/')[-1] for url in urls)
+    download_paths = {}
+    for url in urls:
+        basename = url.split('/')[-1]
+        if basename_counts[basename] > 1:
+            name, extension = os.path.splitext(basename)
+            basename = '%s-%s%s' % (name, hashlib.sha256(url.encode('utf-8')).hexdigest()[:12], extension)
+        download_paths[url] = '%s/%s' % (download_dir, basename)
+    return download_paths
 
 
 def _fetch_emoticons(base_url, tokens):
@@ -49,6 +128,7 @@ def parse_arguments():
     global option_base_url
     global option_output_path
     global option_migrate_global_emoticons
+    global option_download_workers
 
     parser = OptionParser(usage='''
         usage: %prog [options]
@@ -76,6 +156,12 @@ Providing many tokens speeds up the the API calls, as Hipchat has a hardcoded 10
                       action='store_true',
                       default=False,
                       help='Migrate not only custom emoticons, but also Hipchat built-in emoticons.')
+    parser.add_option('-w', '--download-workers',
+                      type='int',
+                      action='store',
+                      dest='download_workers',
+                      default=option_download_workers,
+                      help='Number of emoticons downloaded in parallel (default: %default).')
 
     (options, args) = parser.parse_args()
 
@@ -95,11 +181,16 @@ Providing many tokens speeds up the the API calls, as Hipchat has a hardcoded 10
     option_tokens = options.token_list
     option_migrate_global_emoticons = options.migrate_global_emoticons
 
+    if options.download_workers < 1:
+        parser.error("Number of download workers must be at least 1")
+    option_download_workers = options.download_workers
+
     if options.output_path:
         option_output_path = options.output_path
 
 
-def migrate_emoticons(output_path, hipchat_base_url, hipchat_tokens, migrate_global_emoticons=False):
+def migrate_emoticons(output_path, hipchat_base_url, hipchat_tokens, migrate_global_emoticons=False,
+                      download_workers=option_download_workers):
     global emoji_mapping
 
     if not os.path.exists(output_path):
@@ -112,39 +203,73 @@ def migrate_emoticons(output_path, hipchat_base_url, hipchat_tokens, migrate_glo
     if not migrate_global_emoticons:
         hc_emoticons = [e for e in hc_emoticons if e[u'type'] != 'global']
     logger.info('Found %d emoticons' % len(hc_emoticons))
-    mm_emojis = []
-
-    for e in hc_emoticons:
-        name = 'hc_%s' % e[u'shortcut']  # ensure name is unique
-        url = e[u'url']
-        filename = url.split('/')[-1]
-        download_dir = os.path.abspath('%s/%s' % (output_path, 'emojis'))
-        download_path = '%s/%s' % (download_dir, filename)
-        if not os.path.exists(download_dir):
-            os.mkdir(download_dir)
-        logger.info('Downloading emoticon for (%s)' % name)
-        _download_file(url, download_path)
-
-        mm_emoji = {'type': 'emoji', 'emoji': {'name': name, 'image': download_path}}
-        mm_emojis.append(mm_emoji)
-
-        hc_emoji_text = '(%s)' % e[u'shortcut']
-        mm_emoji_text = ':%s:' % name
-        emoji_mapping[hc_emoji_text] = mm_emoji_text
 
-    mm_version = {"type": "version", "version": 1}
-    with open('%s/mm_emojis.jsonl' % output_path, 'w') as output_file:
-        output_file.write(json.dumps(mm_version) + '\n')
-        emoji_json = reduce((lambda a, b: a + json.dumps(b) + '\n'), mm_emojis, '')
-        output_file.write(emoji_json)
+    download_dir = os.path.abspath('%s/%s' % (output_path, EMOJI_DOWNLOAD_DIRNAME))
+    if not os.path.exists(download_dir):
+        os.mkdir(download_dir)
+    cache_path = '%s/%s' % (download_dir, EMOJI_CACHE_FILENAME)
+    cache = _load_download_cache(cache_path)
 
-    logger.info('Finished migrating emoticons')
+    downloaded_count = 0
+    unchanged_count = 0
+    failed_count = 0
+    http = urllib3.PoolManager(maxsize=download_workers, retries=urllib3.Retry(total=3, backoff_factor=1))
+    mm_version = {"type": "version", "version": 1}
+    try:
+        with open('%s/mm_emojis.jsonl' % output_path, 'w') as output_file, \
+                ThreadPoolExecutor(max_workers=download_workers) as executor:
+            output_file.write(json.dumps(mm_version) + '\n')
+
+            # each url is downloaded once, even if several emoticons use it
+            hc_emoticons_by_url = {}
+            for e in hc_emoticons:
+                hc_emoticons_by_url.setdefault(e[u'url'], []).append(e)
+            download_paths = _download_paths(list(hc_emoticons_by_url), download_dir)
+
+            futures = {}
+            for url, download_path in download_paths.items():
+                logger.debug('Downloading %s for %s' % (url, ', '.join(
+                    '(hc_%s)' % e[u'shortcut'] for e in hc_emoticons_by_url[url])))
+                future = executor.submit(_download_file, http, url, download_path, cache.get(url))
+                futures[future] = url
+
+            # emojis are written as soon as their download finished, the order in the output is not relevant
+            for future in as_completed(futures):
+                url = futures[future]
+                names = ['hc_%s' % e[u'shortcut'] for e in hc_emoticons_by_url[url]]  # ensure name is unique
+                try:
+                    cache_entry, written = future.result()
+                except (IOError, urllib3.exceptions.HTTPError) as ex:
+                    logger.warning('Failed to download emoticon for (%s), skipping it: %s' % (
+                        ', '.join(names), str(ex)))
+                    failed_count += 1
+                    continue
+
+                cache[url] = cache_entry
+                if written:
+                    downloaded_count += 1
+                else:
+                    unchanged_count += 1
+
+                for name in names:
+                    mm_emoji = {'type': 'emoji', 'emoji': {'name': name, 'image': download_paths[url]}}
+                    output_file.write(json.dumps(mm_emoji) + '\n')
+
+                    hc_emoji_text = '(%s)' % name[len('hc_'):]
+                    mm_emoji_text = ':%s:' % name
+                    emoji_mapping[hc_emoji_text] = mm_emoji_text
+    finally:
+        _store_download_cache(cache, cache_path)
+
+    logger.info('Finished migrating emoticons (%d downloaded, %d unchanged, %d failed)'
+                % (downloaded_count, unchanged_count, failed_count))
     return emoji_mapping
 
 
 def main():
     parse_arguments()
-    migrate_emoticons(option_output_path, option_base_url, option_tokens, option_migrate_global_emoticons)
+    migrate_emoticons(option_output_path, option_base_url, option_tokens, option_migrate_global_emoticons,
+                      option_download_workers)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import base64
 import datetime
 import glob
 import json
@@ -8,17 +7,31 @@ import logging
 import os
 import re
 import textwrap
+import threading
 import time
 import math
+import zlib
 from functools import reduce
-from io import BytesIO
 from PIL import Image
 
 from optparse import OptionParser, OptionGroup
 from unidecode import unidecode
 
+import activity_matrix
 import amend_hipchat_rooms
+import avatar_writer
+import create_at_allocator
+import export_census
+import export_source
+import external_sort
 import migrate_hipchat_emoticons
+import migration_metrics
+import migration_progress
+import migration_scope
+import parse_cache
+import partition_plan
+import stage_scheduler
+import staging_db
 
 # Constants
 # Arguments:
@@ -30,13 +43,24 @@ OUTPUT_FILENAME_PREFIX = 'mm_'
 OUTPUT_TEAM_FILENAME = OUTPUT_FILENAME_PREFIX + 'team'
 OUTPUT_DIRECT_CHANNELS_FILENAME = OUTPUT_FILENAME_PREFIX + 'direct_channels'
 OUTPUT_DIRECT_POSTS_FILENAME = OUTPUT_FILENAME_PREFIX + 'direct_posts'
+OUTPUT_DIRECT_POSTS_BUCKET_FILENAME = OUTPUT_DIRECT_POSTS_FILENAME + '_bucket'
+SORTED_DIRECT_POST_BUCKETS = 1  # default of --sort-posts, all conversations in one file sorted as a whole
 OUTPUT_CHANNELS_FILENAME = OUTPUT_FILENAME_PREFIX + 'channels'
 OUTPUT_CHANNEL_POSTS_FILENAME = OUTPUT_FILENAME_PREFIX + 'channel_posts'
 OUTPUT_USERS_FILENAME = OUTPUT_FILENAME_PREFIX + 'users'
 OUTPUT_EMOJI_FILENAME = OUTPUT_FILENAME_PREFIX + 'emojis'
 OUTPUT_ALL_IN_ONE_FILENAME = OUTPUT_FILENAME_PREFIX + 'all_data'
 OUTPUT_HC_ROOMS_AMENDED_FILENAME = 'hc_rooms_amended.json'
+OUTPUT_HC_EXTRACTED_DIRNAME = 'hc_export'  # members of an export archive needed on disk, e.g. attachments
+OUTPUT_HC_ARCHIVE_INDEX_FILENAME = 'hc_export_index.json'
+OUTPUT_CENSUS_FILENAME = 'census'
+OUTPUT_PARSE_CACHE_DIRNAME = 'parse_cache'
+OUTPUT_SORT_SPILL_DIRNAME = 'sort_spill'
+OUTPUT_PARTITION_PLAN_FILENAME = 'partition_plan'
+OUTPUT_PARTITION_RESULT_FILENAME = 'partition_%d_of_%d'
 INPUT_HC_REDIS_AUTOJOIN_FILENAME = 'autojoin.json'
+MIGRATION_STAGES = ['ingest', 'amend_rooms', 'emoticons', 'team', 'users', 'direct_posts', 'channels', 'channel_posts',
+                    'membership', 'sort_posts', 'write_users', 'concat', 'plan', 'partition_result']
 
 # Checks:
 # https://github.com/mattermost/mattermost-server/blob/cee1e3685968cbf84b8b655bf438fb6d34a612e5/app/file.go#L696
@@ -54,6 +78,7 @@ ALL_CAP_RE = re.compile('([a-z0-9])([A-Z])')
 CONSECUTIVE_DASHES_RE = re.compile('[-]{2,}')
 TRAILING_DASHES_OR_UNDERSCORES_RE = re.compile('[-,_]*$')
 LEADING_DASHES_OR_UNDERSCORES_RE = re.compile('^[-,_]*')
+MENTION_RE = re.compile(r'(?<![\w@])@(\w+)')  # not matching e-mail addresses
 
 # Other
 FORMATTED_JSON_OUTPUT = False  # Mattermost doesn't accept formatted (multiline) JSON, but it's handy for debugging
@@ -80,6 +105,8 @@ option_migrate_channel_posts = False
 option_join_public_channels = False
 option_public_membership_based_on_messages = False
 option_public_membership_based_on_redis = False
+option_public_membership_min_messages = 1
+option_public_membership_active_days = None
 option_skip_archived_rooms = False
 option_disable_tutorial = False
 option_use_hc_admin_role_as_mm_system_role = False
@@ -95,6 +122,40 @@ option_migrate_hipchat_builtin_emoticons = False
 option_shrink_image_to_limit = False
 option_generate_email_addresses = False
 option_email_domain = ''
+option_metrics_output_file = None
+option_profile_stage = None
+option_trace_memory = False
+option_progress_interval = migration_progress.DEFAULT_REPORT_INTERVAL_SECONDS
+option_census = False
+option_census_import_rate = export_census.DEFAULT_IMPORT_POSTS_PER_SECOND
+option_staging_db_path = None
+option_reingest = False
+option_since_timestamp = None  # milliseconds since the Unix epoch
+option_parse_cache = False
+option_stage_workers = stage_scheduler.DEFAULT_STAGE_WORKERS
+option_avatar_workers = avatar_writer.DEFAULT_WORKERS
+option_input_archive = None  # path of the tar archive of the export, '-' for stdin
+option_direct_post_buckets = None
+option_direct_post_bucket_size_mb = None
+option_sort_posts = False
+option_sort_memory_mb = external_sort.DEFAULT_MEMORY_BUDGET_MB
+option_plan_partitions = None  # number of partitions to plan
+option_partition = None  # (k, N) of the partition converted by this worker
+option_merge_partitions = False
+option_migration_scope = None  # migration_scope, rooms and users selected for a partial migration
+
+# settings of MigrationConfig: the globals above without the option_ prefix, e.g. migrate_channels
+SETTING_GLOBALS = dict((re.sub('^options?_', '', name), name) for name in list(globals())
+                       if re.match('^(default_|migration_(input|output)_path$|options?_)', name))
+SETTING_DEFAULTS = dict((setting, globals()[name]) for setting, name in SETTING_GLOBALS.items())
+
+staging_db_connection = None
+hc_parse_cache = None
+hc_export_source = None  # export_source, the export directory or archive
+EXPORT_GLOBALS = ['staging_db_connection', 'hc_parse_cache', 'hc_export_source']
+
+active_context = None  # the MigrationContext owning the module globals, at most one per process
+active_context_lock = threading.Lock()
 
 
 class Version(int):
@@ -119,6 +180,7 @@ class User:
     _hipchat_id = None
     _deleted = False
     _full_name = ''
+    _hipchat_mention_name = ''
     profile_image = ''  # path to image
     username = ''  # unique identifier of user
     email = ''
@@ -157,6 +219,7 @@ class User:
             mm_user.roles = 'system_user system_admin'
         mm_user._deleted = hc_user[u'is_deleted']
         mm_user._full_name = hc_user[u'name']
+        mm_user._hipchat_mention_name = hc_user[u'mention_name']
         full_name_parts = mm_user._full_name.rsplit(' ', 1)  # Guessing full name parts
         if len(full_name_parts) == 2:
             mm_user.first_name = full_name_parts[0]
@@ -172,6 +235,9 @@ class User:
             mm_user.auth_data = mm_user.email
         return mm_user
 
+    def get_hc_mention_name(self):
+        return self._hipchat_mention_name
+
     def has_hc_id(self, hc_id):
         return self._hipchat_id == hc_id
 
@@ -265,6 +331,9 @@ class Channel:
     def is_private(self):
         return self.type == 'P'
 
+    def is_archived(self):
+        return self._archived
+
     def get_hc_id(self):
         return self._hipchat_id
 
@@ -307,7 +376,7 @@ class Post:
         self.team = team
         self.channel = channel
         self.user = user
-        self.user_hc_id = user_hc_id
+        self._user_hc_id = user_hc_id
         self.message = message
         self.create_at = create_at
 
@@ -399,6 +468,57 @@ def write_mm_json(objects, filename):
             output_file.writelines(to_json(o) + "\n")
 
 
+class BucketedJsonWriter:
+    # Writes objects into a number of bucket files through long-lived buffered writers instead of one file per unit.
+    # Either a fixed number of buckets, chosen by hash of a key (e.g. the conversation), or buckets filled one after
+    # another up to a size target.
+    buffer_size = 1024 * 1024
+
+    def __init__(self, filename_prefix, bucket_count=None, bucket_size_bytes=None):
+        self.filename_prefix = filename_prefix
+        self.bucket_count = bucket_count
+        self.bucket_size_bytes = bucket_size_bytes
+        self.filenames = []  # of all bucket files written, in order of creation
+        self.objects_written = 0
+        self._files = {}  # bucket index -> [open file, bytes written]
+        self._current_bucket = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _bucket_file(self, bucket):
+        if bucket not in self._files:
+            filename = '%s_%d' % (self.filename_prefix, bucket)
+            output_file = open(full_output_path(filename), 'w', buffering=self.buffer_size)
+            version_line = to_json(Version(1)) + "\n"
+            output_file.write(version_line)
+            self._files[bucket] = [output_file, len(version_line)]
+            self.filenames.append(filename)
+        return self._files[bucket]
+
+    def write(self, obj, key=''):
+        if self.bucket_count:
+            bucket = zlib.crc32(key.encode('utf-8')) % self.bucket_count
+        else:
+            bucket = self._current_bucket
+            if bucket in self._files and self._files[bucket][1] >= self.bucket_size_bytes:
+                self._files.pop(bucket)[0].close()
+                bucket = self._current_bucket = bucket + 1
+        bucket_file = self._bucket_file(bucket)
+        line = to_json(obj) + "\n"
+        bucket_file[0].write(line)
+        bucket_file[1] += len(line.encode('utf-8'))  # the size target is in bytes, not characters
+        self.objects_written += 1
+
+    def close(self):
+        for output_file, _ in self._files.values():
+            output_file.close()
+        self._files = {}
+
+
 def write_space_separated_list(collection, filename):
     with open(full_output_path(filename, 'txt'), 'w') as output_file:
         output_file.write(' '.join(collection))
@@ -408,13 +528,20 @@ def timestamp_from_date(date):
     d = datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ %f")
     return d.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000  # date in milliseconds since the Unix epoch
 
-def sanitize_message(message, emoji_mapping):
+def sanitize_message(message, emoji_mapping, mm_username_by_mention_name=None):
     # Translate Hipchat formatting to Mattermost and split too long messages
     # List of slash commands in Hipchat:
     # https://confluence.atlassian.com/hipchatdc3/keyboard-shortcuts-and-slash-commands-966656108.html
 
-    def replace_emojis():
+    def replace_mention(match):
+        # mentions are case-insensitive in Hipchat, unknown names (e.g. @all, @here) are kept
+        mm_username = mm_username_by_mention_name.get(match.group(1).lower())
+        return '@%s' % mm_username if mm_username else match.group(0)
+
+    def replace_mentions_and_emojis():
         fixed_message = message
+        if mm_username_by_mention_name and '@' in fixed_message:
+            fixed_message = MENTION_RE.sub(replace_mention, fixed_message)
         for a, b in emoji_mapping.items():
             fixed_message = fixed_message.replace(a, b)
         return fixed_message
@@ -423,13 +550,13 @@ def sanitize_message(message, emoji_mapping):
     if message.startswith("/code"):
         message_parts = ["```\n%s\n```" % (message[6:],)]
     elif message.startswith("/quote"):
-        message = replace_emojis()
+        message = replace_mentions_and_emojis()
 
         sliced = textwrap.wrap(message[7:],
                                MM_MAX_MESSAGE_LENGTH - 3)  # shorten 3 to make room for formatting characters
         message_parts = ["> %s\n" % m for m in sliced]
     else:
-        message = replace_emojis()
+        message = replace_mentions_and_emojis()
         message_parts = textwrap.wrap(message, MM_MAX_MESSAGE_LENGTH)
 
     return message_parts if len(message_parts) > 0 else ['']
@@ -510,33 +637,55 @@ def sanitize_channel_display_name_or_header(name):
     return name
 
 
-def load_hipchat_users():
-    with open('%s/users.json' % migration_input_path, 'r') as hc_users_file:
-        users = json.load(hc_users_file)
-        flattened_users = [u[u'User'] for u in users]
-        return flattened_users
+def iter_hipchat_users():
+    # users.json is streamed, as the base64 encoded avatars make it huge
+    if staging_db_connection:
+        return staging_db.iter_users(staging_db_connection)
+    return (u[u'User'] for u in hc_export_source.iter_json_array('users.json'))
+
+
+def is_after_since_cutoff(hc_message):
+    return option_since_timestamp is None or timestamp_from_date(hc_message['timestamp']) >= option_since_timestamp
+
+
+def parse_hipchat_user_history(user_history_name):
+    with hc_export_source.open(user_history_name) as hc_history_file:
+        user_history = json.load(hc_history_file)
+        return [m for m in user_history if 'PrivateUserMessage' in m and is_after_since_cutoff(m['PrivateUserMessage'])]
 
 
 def load_hipchat_user_history(user_id):
-    user_history_path = '%s/users/%d/history.json' % (migration_input_path, user_id)
-    if not os.path.exists(user_history_path):
+    if staging_db_connection:
+        return staging_db.load_user_history(staging_db_connection, user_id, option_since_timestamp)
+    user_history_name = 'users/%d/history.json' % user_id
+    if not hc_export_source.exists(user_history_name):
         return []  # ignore missing history files, required for users that were deleted in Hipchat
-    with open(user_history_path, 'r') as hc_history_file:
-        return json.load(hc_history_file)
+    if hc_parse_cache:
+        return hc_parse_cache.load(hc_export_source.version(user_history_name), 'users_%d' % user_id,
+                                   lambda: parse_hipchat_user_history(user_history_name), option_since_timestamp)
+    return parse_hipchat_user_history(user_history_name)
 
 
 def load_hipchat_rooms():
-    input_file = '%s/%s' % (
-        migration_output_path, OUTPUT_HC_ROOMS_AMENDED_FILENAME) if option_hipchat_amend_rooms \
-        else '%s/rooms.json' % migration_input_path
-    with open(input_file, 'r') as hc_rooms_file:
-        rooms = json.load(hc_rooms_file)
-        flattened_rooms = list(map(lambda u: u[u'Room'], rooms))
-        return flattened_rooms
+    if staging_db_connection and not option_hipchat_amend_rooms:
+        return staging_db.load_rooms(staging_db_connection)
+    if option_hipchat_amend_rooms:
+        with open('%s/%s' % (migration_output_path, OUTPUT_HC_ROOMS_AMENDED_FILENAME), 'r') as hc_rooms_file:
+            rooms = json.load(hc_rooms_file)
+    else:
+        rooms = hc_export_source.load_json('rooms.json')
+    flattened_rooms = list(map(lambda u: u[u'Room'], rooms))
+    return flattened_rooms
 
 
-def load_hipchat_room_history(room_id):
-    with open('%s/rooms/%d/history.json' % (migration_input_path, room_id), 'r') as hc_history_file:
+def hipchat_history_size(history_type, hc_id):
+    if staging_db_connection:
+        return staging_db.history_size(staging_db_connection, history_type, hc_id)
+    return hc_export_source.size('%s/%d/history.json' % (history_type, hc_id)) or 0
+
+
+def parse_hipchat_room_history(room_history_name):
+    with hc_export_source.open(room_history_name) as hc_history_file:
         room_history = json.load(hc_history_file)
         # ignoring the following message types:
         # - "NotificationMessage"
@@ -544,16 +693,39 @@ def load_hipchat_room_history(room_id):
         # - "ArchiveRoomMessage"
         # - "TopicRoomMessage"
         user_messages = [m for m in room_history if 'UserMessage' in m]
-        flattened_messages = [m['UserMessage'] for m in user_messages]
+        flattened_messages = [m['UserMessage'] for m in user_messages if is_after_since_cutoff(m['UserMessage'])]
         return flattened_messages
 
 
+def load_hipchat_room_history(room_id):
+    if staging_db_connection:
+        return staging_db.load_room_messages(staging_db_connection, room_id, option_since_timestamp)
+    room_history_name = 'rooms/%d/history.json' % room_id
+    if hc_parse_cache:
+        return hc_parse_cache.load(hc_export_source.version(room_history_name), 'rooms_%d' % room_id,
+                                   lambda: parse_hipchat_room_history(room_history_name), option_since_timestamp)
+    return parse_hipchat_room_history(room_history_name)
+
+
+def load_hipchat_room_activity(activity):
+    # only available with a staging database, otherwise the activity is collected while migrating the channel posts
+    for sender_id, room_id, count, last_activity in staging_db.room_activity(
+            staging_db_connection, option_since_timestamp, by_day=activity.window_days is not None):
+        activity.add(sender_id, room_id, last_activity, count)
+
+
 def load_redis_autojoin():
     with open('%s/%s' % (migration_input_path, INPUT_HC_REDIS_AUTOJOIN_FILENAME), 'r') as hc_autojoin_file:
         autojoins = json.load(hc_autojoin_file)
         return autojoins['autojoins']
 
 
+def post_create_at(line):
+    # sort key of the lines of post files
+    data = json.loads(line)
+    return data[data['type']]['create_at']
+
+
 def concat_files(input_file_paths, output_file_name):
     with open(full_output_path(output_file_name), 'w') as output_file:
         mm_bulk_load_version = Version(1)
@@ -572,42 +744,64 @@ def migrate_team():
     return Team(default_team_name, default_team_display_name)
 
 
-def store_base64_image(data, path, filename):
-    try:
-        decoded = base64.b64decode(data)
-    except TypeError as e:
-        logger.error("Failed to decode base 64 data (%s): %s" % (str(e), data))
-        return ''
+def _iter_users_and_avatars():
+    for hc_user in iter_hipchat_users():
+        # the avatar is handed over right away (or dropped), only the migrated user is kept
+        hc_avatar = hc_user.pop('avatar', None)
+        if option_generate_email_addresses:
+            if hc_user['email'] in (None, ''):
+                hc_user['email'] = '@'.join([hc_user['mention_name'].lower(), option_email_domain])
+        if option_filter_hc_users and not re.match(option_filter_hc_users, hc_user['email'] or ''):
+            continue
+        yield User.from_hc_user(hc_user), hc_avatar
+
 
-    img = Image.open(BytesIO(decoded))
-    img_path = '%s/%s.%s' % (path, filename, img.format.lower())
-    with open(img_path, 'wb') as f:
-        img.save(f)
-    return img_path
+def iter_users():
+    # migrated users without avatars, streamed from the export
+    return (mm_user for mm_user, _ in _iter_users_and_avatars())
 
 
 def migrate_users():
-    hc_users = load_hipchat_users()
     mm_users = []
 
-    avatar_output_path = '%s/avatars' % migration_output_path
-    if option_migrate_avatars and not os.path.exists(avatar_output_path):
-        os.makedirs(avatar_output_path)
-
-    for hc_user in hc_users:
-        if option_generate_email_addresses:
-            if hc_user['email'] in (None, ''):
-                hc_user['email'] = '@'.join([hc_user['mention_name'].lower(), option_email_domain])
-        if option_filter_hc_users and not re.match(option_filter_hc_users, hc_user['email']):
-            continue
+    mm_avatar_writer = None
+    avatar_futures = []
+    # users are written by the merge of the partitions, a partial migration only knows its users after the posts
+    if option_migrate_avatars and not option_partition and not option_migration_scope:
+        mm_avatar_writer = avatar_writer.AvatarWriter('%s/avatars' % migration_output_path, option_avatar_workers)
 
-        mm_user = User.from_hc_user(hc_user)
-        if hc_user['avatar'] is not None and option_migrate_avatars:
-            avatar_path = store_base64_image(hc_user['avatar'], avatar_output_path,
-                                             'mm_user_%s_avatar' % mm_user.get_hc_id())
-            mm_user.profile_image = avatar_path
+    for mm_user, hc_avatar in _iter_users_and_avatars():
+        if hc_avatar is not None and mm_avatar_writer:
+            avatar_futures.append((mm_user, mm_avatar_writer.submit(hc_avatar, 'user %s' % mm_user.username)))
         mm_users.append(mm_user)
 
+    if mm_avatar_writer:
+        finish_avatars(mm_avatar_writer, avatar_futures)
+
+    return mm_users
+
+
+def finish_avatars(mm_avatar_writer, avatar_futures):
+    for mm_user, avatar_future in avatar_futures:
+        mm_user.profile_image = avatar_future.result()
+    mm_avatar_writer.close()
+    logger.info('\tAvatars: %d written, %d already written, %d converted to PNG, %d invalid' % (
+        mm_avatar_writer.written, mm_avatar_writer.existing, mm_avatar_writer.converted, mm_avatar_writer.failed))
+
+
+def migrate_avatars(mm_users):
+    # second pass over the Hipchat users, only writing the avatars of the given users
+    mm_user_by_hc_id = dict((u.get_hc_id(), u) for u in mm_users)
+    mm_avatar_writer = avatar_writer.AvatarWriter('%s/avatars' % migration_output_path, option_avatar_workers)
+    avatar_futures = []
+    for hc_user in iter_hipchat_users():
+        mm_user = mm_user_by_hc_id.get(hc_user['id'])
+        if mm_user and hc_user.get('avatar') is not None:
+            avatar_futures.append((mm_user, mm_avatar_writer.submit(hc_user['avatar'], 'user %s' % mm_user.username)))
+    finish_avatars(mm_avatar_writer, avatar_futures)
+
+
+def write_deleted_users(mm_users):
     deleted_users = list(filter(lambda u: u.is_deleted(), mm_users))
     deleted_users_usernames = set(map(lambda u: u.username, deleted_users))
 
@@ -617,40 +811,55 @@ def migrate_users():
                 len(deleted_users), OUTPUT_DELETED_USERS_FILENAME))
         write_space_separated_list(sorted(deleted_users_usernames), OUTPUT_DELETED_USERS_FILENAME)
 
-    return mm_users
+
+def scoped_users(mm_users, mm_direct_channel_user_pairs, activity_builder):
+    # users selected for a partial migration, and the users referenced by the migrated posts
+    referenced_usernames = set()
+    for user_pair in mm_direct_channel_user_pairs:
+        referenced_usernames.update(user_pair)
+    if activity_builder:
+        referenced_hc_ids = set(entry[0] for entry in activity_builder.entries())
+    else:
+        referenced_hc_ids = set()
+    return [u for u in mm_users if u.username in referenced_usernames or u.get_hc_id() in referenced_hc_ids or
+            option_migration_scope.includes_user(u.get_hc_id(), [u.get_hc_mention_name(), u.email])]
 
 
-def migrate_direct_posts(mm_username_by_hc_id, mm_user, emoji_mapping):
+def iter_direct_posts(mm_username_by_hc_id, mm_user, emoji_mapping, mm_username_by_mention_name, create_at=None,
+                      include_received_from=None):
+    # direct posts sent by the user, and the ones received from senders for which include_received_from(sender id)
+    # is true, e.g. senders outside the scope of a partial migration whose histories are not migrated
     hc_user_id = mm_user.get_hc_id()
     hc_user_history = load_hipchat_user_history(hc_user_id)
+    if create_at is None:
+        create_at = create_at_allocator.CreateAtAllocator()
 
-    mm_direct_posts = []
     invalid_post_count = 0
+    unknown_user_post_count = 0
     for hc_post in hc_user_history:
         hc_message = hc_post['PrivateUserMessage']
         sender_hc_id = hc_message['sender']['id']
         receiver_hc_id = hc_message['receiver']['id']
 
         # only consider messages where current was sender, otherwise messages will be duplicated
-        if sender_hc_id != hc_user_id:
+        if sender_hc_id != hc_user_id and not (include_received_from and include_received_from(sender_hc_id)):
             continue
 
-        try:
-            sender_mm_username = mm_username_by_hc_id[sender_hc_id]
-        except KeyError:
-            logger.error('Could not find sender with Hipchat ID %s of direct post' % sender_hc_id)
-            exit(1)
-        try:
-            receiver_mm_username = mm_username_by_hc_id[receiver_hc_id]
-        except KeyError:
-            logger.error('Could not find receiver with Hipchat ID %s of direct post' % receiver_hc_id)
-            exit(1)
+        # e.g. filtered users
+        sender_mm_username = mm_username_by_hc_id.get(sender_hc_id)
+        receiver_mm_username = mm_username_by_hc_id.get(receiver_hc_id)
+        if sender_mm_username is None or receiver_mm_username is None:
+            unknown_user_post_count += 1
+            continue
         timestamp = timestamp_from_date(hc_message['timestamp'])
-        message_parts = sanitize_message(hc_message['message'], emoji_mapping)
+        message_parts = sanitize_message(hc_message['message'], emoji_mapping, mm_username_by_mention_name)
 
         mm_current_posts = []
-        for i, part in enumerate(message_parts):
-            mm_post = DirectPost([sender_mm_username, receiver_mm_username], sender_mm_username, part, timestamp + i)
+        # the conversation is given by the other user
+        partner_mm_username = receiver_mm_username if sender_hc_id == hc_user_id else sender_mm_username
+        for part in message_parts:
+            mm_post = DirectPost([sender_mm_username, receiver_mm_username], sender_mm_username, part,
+                                 create_at.allocate(int(timestamp), partner_mm_username))
             mm_current_posts.append(mm_post)
 
         if hc_message['attachment'] is not None:
@@ -660,18 +869,25 @@ def migrate_direct_posts(mm_username_by_hc_id, mm_user, emoji_mapping):
         if not all([p.is_valid() for p in mm_current_posts]):
             invalid_post_count += 1
         else:
-            mm_direct_posts.extend(mm_current_posts)
+            yield from mm_current_posts
 
     if invalid_post_count > 0:
         logger.warning('\t\tSkipped %d invalid direct posts of user %s' % (invalid_post_count, mm_user.username))
+    if unknown_user_post_count > 0:
+        logger.warning('\t\tSkipped %d direct posts of user %s with a sender or receiver which is not migrated' % (
+            unknown_user_post_count, mm_user.username))
+
 
-    return mm_direct_posts
+def migrate_direct_posts(mm_username_by_hc_id, mm_user, emoji_mapping, mm_username_by_mention_name,
+                         create_at=None, include_received_from=None):
+    return list(iter_direct_posts(mm_username_by_hc_id, mm_user, emoji_mapping, mm_username_by_mention_name,
+                                  create_at, include_received_from))
 
 
 def migrate_attachment(hc_attachment, subpath):
     hc_attachment_path = u"%s" % hc_attachment['path']
     hc_attachment_name = u"%s" % hc_attachment['name']
-    full_attachment_path = "%s/%s/files/%s" % (migration_input_path, subpath, hc_attachment_path)
+    full_attachment_path = hc_export_source.file_path("%s/files/%s" % (subpath, hc_attachment_path))
     mm_attachment = Attachment(full_attachment_path, hc_attachment_name)
 
     if not is_valid_attachment(full_attachment_path):
@@ -695,15 +911,14 @@ def migrate_direct_channels(direct_channel_user_pairs):
     return mm_direct_channels
 
 
-def migrate_channels():
-    hc_rooms = load_hipchat_rooms()
-    mm_channels = []
-    mm_archived_channels = []
-    for hc_room in hc_rooms:
+def iter_channels():
+    for hc_room in load_hipchat_rooms():
         hc_room_archived = hc_room['is_archived']
         if option_skip_archived_rooms and hc_room_archived:
             logger.info('Skipping archived room %d' % int(hc_room['id']))
             continue
+        if option_migration_scope and not option_migration_scope.includes_room(hc_room['id'], hc_room['name']):
+            continue
 
         if options_map_room_to_town_square == hc_room['name']:
             name = 'town-square'
@@ -716,12 +931,13 @@ def migrate_channels():
             display_name = sanitize_channel_display_name_or_header(hc_room['name'])
 
         header = sanitize_channel_display_name_or_header(hc_room['topic'])
-        mm_channel = Channel.from_hc_room(name, display_name, header, hc_room)
-        mm_channels.append(mm_channel)
-        if hc_room_archived:
-            mm_archived_channels.append(mm_channel)
+        yield Channel.from_hc_room(name, display_name, header, hc_room)
+
 
-    if len(mm_archived_channels) > 0:
+def migrate_channels():
+    mm_channels = list(iter_channels())
+    mm_archived_channels = [c for c in mm_channels if c.is_archived()]
+    if len(mm_archived_channels) > 0 and not option_partition:
         mm_unique_cli_style_team_channels = set(map(lambda c: c.get_cli_id(), mm_archived_channels))
         logger.info(
             '\tFound %d archived channels. Writing file %s.txt to be used with Mattermost CLI to archive them.' % (
@@ -731,20 +947,29 @@ def migrate_channels():
     return mm_channels
 
 
-def migrate_channel_posts(mm_username_by_hc_id, mm_channel, emoji_mapping):
+def iter_channel_posts(mm_username_by_hc_id, mm_channel, emoji_mapping, mm_username_by_mention_name, activity=None,
+                       create_at=None):
     hc_room_history = load_hipchat_room_history(mm_channel.get_hc_id())
+    if create_at is None:
+        create_at = create_at_allocator.CreateAtAllocator()
 
     invalid_post_count = 0
-    mm_posts = []
+    unknown_user_post_count = 0
     for hc_message in hc_room_history:
         timestamp = timestamp_from_date(hc_message['timestamp'])
         sender_hc_id = hc_message['sender']['id']
-        sender_mm_username = mm_username_by_hc_id[sender_hc_id]
-        message_parts = sanitize_message(hc_message['message'], emoji_mapping)
+        sender_mm_username = mm_username_by_hc_id.get(sender_hc_id)
+        if sender_mm_username is None:
+            unknown_user_post_count += 1  # e.g. filtered users
+            continue
+        message_parts = sanitize_message(hc_message['message'], emoji_mapping, mm_username_by_mention_name)
+        if activity is not None:
+            activity.add(sender_hc_id, mm_channel.get_hc_id(), timestamp)
 
         mm_current_posts = []
-        for i, part in enumerate(message_parts):
-            mm_post = Post(default_team_name, mm_channel.name, sender_mm_username, sender_hc_id, part, timestamp + i)
+        for part in message_parts:
+            mm_post = Post(default_team_name, mm_channel.name, sender_mm_username, sender_hc_id, part,
+                           create_at.allocate(int(timestamp)))
             mm_current_posts.append(mm_post)
 
         if 'attachment' in hc_message and hc_message['attachment'] is not None:
@@ -754,12 +979,19 @@ def migrate_channel_posts(mm_username_by_hc_id, mm_channel, emoji_mapping):
         if not all([p.is_valid() for p in mm_current_posts]):
             invalid_post_count += 1
         else:
-            mm_posts.extend(mm_current_posts)
+            yield from mm_current_posts
 
     if invalid_post_count > 0:
         logger.warning("Skipped %d invalid channel posts of room %s" % (invalid_post_count, mm_channel.name))
+    if unknown_user_post_count > 0:
+        logger.warning("Skipped %d channel posts of room %s with a sender which is not migrated" % (
+            unknown_user_post_count, mm_channel.name))
 
-    return mm_posts
+
+def migrate_channel_posts(mm_username_by_hc_id, mm_channel, emoji_mapping, mm_username_by_mention_name, activity=None,
+                          create_at=None):
+    return list(iter_channel_posts(mm_username_by_hc_id, mm_channel, emoji_mapping, mm_username_by_mention_name,
+                                   activity, create_at))
 
 
 def migrate_user_channel_membership(mm_channels, mm_user):
@@ -801,7 +1033,7 @@ def _parse_comma_separated_argument(option, opt_str, value, parser):
     setattr(parser.values, option.dest, value.split(','))
 
 
-def parse_arguments():
+def parse_arguments(args=None):
     global default_team_name
     global default_team_display_name
     global default_auth_service
@@ -815,6 +1047,8 @@ def parse_arguments():
     global option_join_public_channels
     global option_public_membership_based_on_messages
     global option_public_membership_based_on_redis
+    global option_public_membership_min_messages
+    global option_public_membership_active_days
     global option_skip_archived_rooms
     global option_disable_tutorial
     global option_use_hc_admin_role_as_mm_team_role
@@ -830,6 +1064,27 @@ def parse_arguments():
     global option_shrink_image_to_limit
     global option_generate_email_addresses
     global option_email_domain
+    global option_metrics_output_file
+    global option_profile_stage
+    global option_trace_memory
+    global option_progress_interval
+    global option_census
+    global option_census_import_rate
+    global option_staging_db_path
+    global option_reingest
+    global option_since_timestamp
+    global option_parse_cache
+    global option_stage_workers
+    global option_input_archive
+    global option_avatar_workers
+    global option_direct_post_buckets
+    global option_direct_post_bucket_size_mb
+    global option_sort_posts
+    global option_sort_memory_mb
+    global option_plan_partitions
+    global option_partition
+    global option_merge_partitions
+    global option_migration_scope
 
     parser = OptionParser(usage=
                           '''usage: %prog [options]
@@ -849,7 +1104,7 @@ def parse_arguments():
                       dest="input_path",
                       action="store",
                       type="string",
-                      help="Path to Hipchat export (the 'data' directory of the extracted export. Defaults to current directory.)")
+                      help="Path to Hipchat export (the 'data' directory of the extracted export. Defaults to current directory.) Can also be the decrypted tar archive of the export, or '-' to read the archive from stdin.")
     parser.add_option("-v", "--verbose",
                       dest="verbose",
                       action="store_true",
@@ -860,6 +1115,80 @@ def parse_arguments():
                       action="store_true",
                       default=False,
                       help="Concatenate all output files into one after conversion is done. Mattermost bulk import seems to be much faster with one large files instead of many smaller ones.")
+    parser.add_option("--staging-db",
+                      dest="staging_db",
+                      action="store",
+                      type="string",
+                      help="Path to a SQLite staging database of the export. If it does not exist, the export is ingested into it first. Later runs read users, rooms and histories from the database instead of parsing the JSON files again.")
+    parser.add_option("--reingest",
+                      dest="reingest",
+                      action="store_true",
+                      default=False,
+                      help="Ingest the export into the staging database again, e.g. after the export has changed")
+    parser.add_option("--since",
+                      dest="since",
+                      action="store",
+                      type="string",
+                      help="Only migrate posts written at or after the given date (YYYY-MM-DD, UTC)")
+    parser.add_option("--parse-cache",
+                      dest="parse_cache",
+                      action="store_true",
+                      default=False,
+                      help="Cache the parsed history files in a binary format in the output path. Later runs only parse history files again which have changed (by size or modification time).")
+    parser.add_option("--stage-workers",
+                      dest="stage_workers",
+                      action="store",
+                      type="int",
+                      default=stage_scheduler.DEFAULT_STAGE_WORKERS,
+                      help="Number of migration stages run concurrently if they do not depend on each other, e.g. users are migrated while emoticons are downloaded. Use 1 to run the stages one after another. Defaults to %d." % stage_scheduler.DEFAULT_STAGE_WORKERS)
+    parser.add_option("--plan-partitions",
+                      dest="plan_partitions",
+                      action="store",
+                      type="int",
+                      help="Only plan a migration split into the given number of partitions and write the plan to %s.json in the output path. Rooms and users are assigned to partitions balanced by the size of their history. Runs the steps needed by all partitions (ingest, amending rooms, emoticons) once." % OUTPUT_PARTITION_PLAN_FILENAME)
+    parser.add_option("--partition",
+                      dest="partition",
+                      action="store",
+                      type="string",
+                      help="Only convert the rooms and users of partition k of N (given as k/N) of the plan in the output path. Partitions can run in parallel, on several machines sharing the output path.")
+    parser.add_option("--merge-partitions",
+                      dest="merge_partitions",
+                      action="store_true",
+                      default=False,
+                      help="Merge the results of all partitions of the plan in the output path into the final import files (users, memberships, direct channels and concatenation)")
+    parser.add_option("--census",
+                      dest="census",
+                      action="store_true",
+                      default=False,
+                      help="Only scan the export and write statistics for capacity planning (message counts, attachments, oversized images, emoticons, predicted output size and import time) to %s.json, nothing is migrated" % OUTPUT_CENSUS_FILENAME)
+    parser.add_option("--census-import-rate",
+                      dest="census_import_rate",
+                      action="store",
+                      type="int",
+                      default=option_census_import_rate,
+                      help="Posts per second the Mattermost bulk import is assumed to achieve, used by --census to predict the import time (default: %default)")
+    parser.add_option("--progress-interval",
+                      dest="progress_interval",
+                      action="store",
+                      type="int",
+                      default=option_progress_interval,
+                      help="Seconds between progress reports (throughput and ETA) while migrating posts, 0 to disable (default: %default)")
+    parser.add_option("--metrics-out",
+                      dest="metrics_output_file",
+                      action="store",
+                      type="string",
+                      help="Write wall time, CPU time, records, I/O and memory of every migration stage as JSON to this file")
+    parser.add_option("--trace-memory",
+                      dest="trace_memory",
+                      action="store_true",
+                      default=False,
+                      help="Measure the peak Python memory of every stage with tracemalloc for --metrics-out (slows down the migration considerably). Stages running at the same time share the peak, use --stage-workers=1 for exact numbers")
+    parser.add_option("--profile",
+                      dest="profile_stage",
+                      action="store",
+                      type="choice",
+                      choices=MIGRATION_STAGES,
+                      help="Profile the given stage with cProfile and write the stats to profile_<stage>.pstats in the output path. One of: %s" % ', '.join(MIGRATION_STAGES))
 
     parser_migration_group = OptionGroup(parser, "Migration Options",
                                          "These options control what data should be migrated")
@@ -873,6 +1202,27 @@ def parse_arguments():
                                       action="store_true",
                                       default=False,
                                       help="Use to migrate direct posts (1:1 in Hipchat)")
+    parser_migration_group.add_option("--direct-post-buckets",
+                                      dest="direct_post_buckets",
+                                      action="store",
+                                      type="int",
+                                      help="Write direct posts into the given number of bucket files (by hash of the conversation) instead of one file per user. Avoids thousands of small files for conversion and import.")
+    parser_migration_group.add_option("--direct-post-bucket-size",
+                                      dest="direct_post_bucket_size",
+                                      action="store",
+                                      type="int",
+                                      help="Write direct posts into bucket files of about the given size in MB instead of one file per user.")
+    parser_migration_group.add_option("--sort-posts",
+                                      dest="sort_posts",
+                                      action="store_true",
+                                      default=False,
+                                      help="Sort the posts of every post file by creation time, as Mattermost imports them in file order. Required if the room histories are not in time order, e.g. after merging partial exports. Direct posts are written to buckets by conversation (one bucket unless --direct-post-buckets is given), so the posts of a conversation are in one file and sorted as a whole.")
+    parser_migration_group.add_option("--sort-memory",
+                                      dest="sort_memory",
+                                      action="store",
+                                      type="int",
+                                      default=external_sort.DEFAULT_MEMORY_BUDGET_MB,
+                                      help="Memory in MB used by --sort-posts, larger files are sorted in runs spilled to disk. Defaults to %d." % external_sort.DEFAULT_MEMORY_BUDGET_MB)
     parser_migration_group.add_option("--migrate-channels",
                                       dest="migrate_channels",
                                       action="store_true",
@@ -888,6 +1238,12 @@ def parse_arguments():
                                       action="store_true",
                                       default=False,
                                       help="Use to migrate users avatars")
+    parser_migration_group.add_option("--avatar-workers",
+                                      dest="avatar_workers",
+                                      action="store",
+                                      type="int",
+                                      default=avatar_writer.DEFAULT_WORKERS,
+                                      help="Number of threads writing avatars. Defaults to %d." % avatar_writer.DEFAULT_WORKERS)
     parser_migration_group.add_option("--skip-archived-rooms",
                                       dest="skip_archived_rooms",
                                       action="store_true",
@@ -930,6 +1286,17 @@ def parse_arguments():
                                       default=False,
                                       help='%s Room membership is based on if a user has ever written a message in the room. %s' % (
                                           public_room_membership_intro, public_room_membership_disclaimer))
+    parser_migration_group.add_option("--public-channel-membership-min-messages",
+                                      dest="public_channel_membership_min_messages",
+                                      action="store",
+                                      type="int",
+                                      default=1,
+                                      help='Only relevant with "--public-channel-membership-based-on-messages". Minimum number of messages a user must have written in a room to become member of the channel. Defaults to 1.')
+    parser_migration_group.add_option("--public-channel-membership-active-days",
+                                      dest="public_channel_membership_active_days",
+                                      action="store",
+                                      type="int",
+                                      help='Only relevant with "--public-channel-membership-based-on-messages". Only the messages within the given number of days up to the latest message of the export count for the minimum number of messages.')
     parser_migration_group.add_option("--public-channel-membership-based-on-redis-export",
                                       dest="public_channel_membership_based_on_redis",
                                       action="store_true",
@@ -957,8 +1324,35 @@ def parse_arguments():
                                       dest="filter_users",
                                       action="store",
                                       type="string",
-                                      help="Filter Hipchat users by e-mail address using regex (important: filtered users must not occur in chat history)"
+                                      help="Filter Hipchat users by e-mail address using regex (posts of or to filtered users are skipped)"
                                       )
+    parser_migration_group.add_option("--select-room-ids",
+                                      dest="select_room_ids",
+                                      type="string",
+                                      action="callback",
+                                      callback=_parse_comma_separated_argument,
+                                      help="Partial migration: comma-separated list of Hipchat room IDs to migrate. Users which posted in the selected rooms are migrated as well.")
+    parser_migration_group.add_option("--select-rooms",
+                                      dest="select_rooms",
+                                      action="store",
+                                      type="string",
+                                      help="Partial migration: migrate the Hipchat rooms with a name matching the given regex")
+    parser_migration_group.add_option("--select-user-ids",
+                                      dest="select_user_ids",
+                                      type="string",
+                                      action="callback",
+                                      callback=_parse_comma_separated_argument,
+                                      help="Partial migration: comma-separated list of Hipchat user IDs whose direct posts are migrated. Their conversation partners are migrated as well.")
+    parser_migration_group.add_option("--select-users",
+                                      dest="select_users",
+                                      action="store",
+                                      type="string",
+                                      help="Partial migration: migrate the direct posts of Hipchat users with a mention name or e-mail address matching the given regex")
+    parser_migration_group.add_option("--sample",
+                                      dest="sample_ratio",
+                                      action="store",
+                                      type="float",
+                                      help="Partial migration: migrate a sample of the given ratio (e.g. 0.01) of the rooms and of the users' direct posts. The sample is the same for every run.")
 
     parser_hipchat_group = OptionGroup(parser, "Hipchat Export Options",
                                        "These options control data which will be fetched from Hipchat to amend the export")
@@ -1009,11 +1403,69 @@ Providing many option_tokens speeds up the the API calls, as Hipchat has a hardc
     parser.add_option_group(parser_authentication_group)
     parser.add_option_group(parser_hipchat_group)
 
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(args)
+
+    if options.staging_db:
+        option_staging_db_path = os.path.abspath(options.staging_db)
+    elif options.reingest:
+        parser.error("Option --reingest requires --staging-db")
+    option_reingest = options.reingest
+    option_parse_cache = options.parse_cache
+    if options.stage_workers < 1:
+        parser.error("Number of stage workers must be at least 1")
+    option_stage_workers = options.stage_workers
+    if options.avatar_workers < 1:
+        parser.error("Number of avatar workers must be at least 1")
+    option_avatar_workers = options.avatar_workers
+
+    if options.direct_post_buckets is not None and options.direct_post_buckets < 1:
+        parser.error("Number of direct post buckets must be at least 1")
+    if options.direct_post_bucket_size is not None and options.direct_post_bucket_size < 1:
+        parser.error("Direct post bucket size must be at least 1 MB")
+    if options.direct_post_buckets and options.direct_post_bucket_size:
+        parser.error("Options --direct-post-buckets and --direct-post-bucket-size are mutually exclusive")
+    if options.sort_posts and options.direct_post_bucket_size:
+        # buckets filled one after another split conversations, sorting them separately would not order those
+        parser.error("Option --sort-posts requires --direct-post-buckets instead of --direct-post-bucket-size")
+    option_direct_post_buckets = options.direct_post_buckets
+    option_direct_post_bucket_size_mb = options.direct_post_bucket_size
+    if options.sort_posts and not options.direct_post_buckets:
+        # the posts of a conversation are in the files of both users otherwise
+        option_direct_post_buckets = SORTED_DIRECT_POST_BUCKETS
+
+    if options.sort_memory < 1:
+        parser.error("Sort memory must be at least 1 MB")
+    option_sort_posts = options.sort_posts
+    option_sort_memory_mb = options.sort_memory
+
+    if len([o for o in [options.plan_partitions, options.partition, options.merge_partitions] if o]) > 1:
+        parser.error("Options --plan-partitions, --partition and --merge-partitions are mutually exclusive")
+    if options.plan_partitions is not None and options.plan_partitions < 1:
+        parser.error("Number of partitions must be at least 1")
+    if options.partition:
+        try:
+            option_partition = partition_plan.parse_partition(options.partition)
+        except ValueError as e:
+            parser.error(str(e))
+    if (options.partition or options.merge_partitions) and options.reingest:
+        parser.error("Options --partition and --merge-partitions use the staging database ingested by --plan-partitions, --reingest is not allowed")
+    option_plan_partitions = options.plan_partitions
+    option_merge_partitions = options.merge_partitions
+
+    if options.since:
+        try:
+            since = datetime.datetime.strptime(options.since, '%Y-%m-%d')
+        except ValueError:
+            parser.error("Illegal date for --since, expected YYYY-MM-DD")
+        option_since_timestamp = since.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000
+
+    option_census = options.census
+    option_census_import_rate = options.census_import_rate
 
     if options.default_team_display_name is None:
-        parser.print_help()
-        parser.error("Team name is mandatory")
+        if not option_census:
+            parser.print_help()
+            parser.error("Team name is mandatory")
     else:
         default_team_display_name = options.default_team_display_name
         default_team_name = sanitize_name(options.default_team_display_name)
@@ -1023,10 +1475,27 @@ Providing many option_tokens speeds up the the API calls, as Hipchat has a hardc
         if not os.path.exists(migration_output_path):
             parser.error("Provided output path does not exist.")
 
-    if not options.input_path is None:
+    if options.input_path == export_source.STDIN_ARCHIVE:
+        option_input_archive = export_source.STDIN_ARCHIVE
+        migration_input_path = os.path.abspath('.')
+    elif not options.input_path is None:
         migration_input_path = os.path.abspath(options.input_path)
         if not os.path.exists(migration_input_path):
             parser.error("Provided input path does not exist.")
+        if os.path.isfile(migration_input_path):
+            # tar archive of the export, files not contained in the export (e.g. Redis export) are next to it
+            option_input_archive = migration_input_path
+            migration_input_path = os.path.dirname(migration_input_path)
+
+    if option_input_archive:
+        if option_census:
+            parser.error("Option --census requires an extracted export")
+        if export_source.is_single_pass_archive(option_input_archive) and not option_staging_db_path:
+            parser.error("Compressed archives and archives read from stdin can only be read once, use --staging-db")
+
+    if options.partition or options.merge_partitions:
+        if not os.path.exists(full_output_path(OUTPUT_PARTITION_PLAN_FILENAME, 'json')):
+            parser.error("No partition plan found in the output path, run --plan-partitions first")
 
     if options.verbose:
         logger.setLevel(logging.DEBUG)
@@ -1036,6 +1505,16 @@ Providing many option_tokens speeds up the the API calls, as Hipchat has a hardc
     if options.concat_output_files:
         option_concat_import_files = True
 
+    if options.metrics_output_file:
+        option_metrics_output_file = os.path.abspath(options.metrics_output_file)
+
+    option_profile_stage = options.profile_stage
+
+    if options.progress_interval < 0:
+        parser.error("Progress interval must not be negative")
+    option_progress_interval = options.progress_interval
+    option_trace_memory = options.trace_memory
+
     if options.skip_archived_rooms:
         option_skip_archived_rooms = True
 
@@ -1073,6 +1552,17 @@ Providing many option_tokens speeds up the the API calls, as Hipchat has a hardc
     if options.filter_users:
         option_filter_hc_users = options.filter_users
 
+    if options.sample_ratio is not None and not 0 < options.sample_ratio <= 1:
+        parser.error("Sample ratio must be greater than 0 and at most 1")
+    if options.select_room_ids or options.select_rooms or options.select_user_ids or options.select_users or \
+            options.sample_ratio is not None:
+        try:
+            option_migration_scope = migration_scope.MigrationScope(
+                [int(i) for i in options.select_room_ids or []], options.select_rooms,
+                [int(i) for i in options.select_user_ids or []], options.select_users, options.sample_ratio)
+        except ValueError as e:  # re.error is a ValueError as well
+            parser.error("Illegal room or user selection: %s" % str(e))
+
     if options.amend_rooms or options.migrate_custom_emoticons or options.migrate_builtin_emoticons:
         if not options.hipchat_base_url or not options.hipchat_token_list:
             parser.error("Hipchat base url and tokens required to amend rooms or migrating emoticons.")
@@ -1087,6 +1577,8 @@ Providing many option_tokens speeds up the the API calls, as Hipchat has a hardc
 
     if options.public_channel_membership_based_on_messages:
         option_public_membership_based_on_messages = True
+    option_public_membership_min_messages = options.public_channel_membership_min_messages
+    option_public_membership_active_days = options.public_channel_membership_active_days
 
     if options.public_channel_membership_based_on_redis:
         redis_export_path = '%s/%s' % (migration_input_path, INPUT_HC_REDIS_AUTOJOIN_FILENAME)
@@ -1125,125 +1617,613 @@ Providing many option_tokens speeds up the the API calls, as Hipchat has a hardc
             option_email_domain = options.email_domain
 
 
+def username_mappings(mm_users):
+    mm_username_by_hc_id = dict([(u.get_hc_id(), u.username) for u in mm_users])
+    mm_username_by_mention_name = dict([(u.get_hc_mention_name().lower(), u.username) for u in mm_users])
+    return mm_username_by_hc_id, mm_username_by_mention_name
+
+
+def open_hipchat_export(metrics):
+    global staging_db_connection
+    global hc_parse_cache
+    global hc_export_source
+
+    hc_export_source = export_source.open_source(option_input_archive or migration_input_path,
+                                                 '%s/%s' % (migration_output_path, OUTPUT_HC_EXTRACTED_DIRNAME),
+                                                 '%s/%s' % (migration_output_path, OUTPUT_HC_ARCHIVE_INDEX_FILENAME))
+
+    if option_staging_db_path:
+        if option_reingest or not os.path.exists(option_staging_db_path):
+            logger.info('Ingesting export into staging database %s' % option_staging_db_path)
+            with metrics.stage('ingest'):
+                staging_db.ingest(hc_export_source, option_staging_db_path, timestamp_from_date)
+        staging_db_connection = staging_db.open_db(option_staging_db_path)
+        logger.info('Reading export from staging database %s (ingested from %s)' % (
+            option_staging_db_path, staging_db.ingested_input_path(staging_db_connection)))
+    elif option_parse_cache:
+        hc_parse_cache = parse_cache.ParseCache('%s/%s' % (migration_output_path, OUTPUT_PARSE_CACHE_DIRNAME))
+
+
+def close_hipchat_export():
+    global staging_db_connection
+    global hc_parse_cache
+    global hc_export_source
+
+    if staging_db_connection:
+        staging_db_connection.close()
+    staging_db_connection = None
+    hc_parse_cache = None
+    hc_export_source = None
+
+
+def module_globals():
+    return dict((name, globals()[name]) for name in list(SETTING_GLOBALS.values()) + EXPORT_GLOBALS)
+
+
+class MigrationConfig:
+    # The settings of a migration without the command line, e.g. for orchestration or notebooks:
+    #   MigrationConfig(migration_input_path='./data', default_team_display_name='MyTeam', migrate_channels=True)
+    # Settings are named like the module globals without the option_ prefix, see SETTING_DEFAULTS.
+    def __init__(self, **settings):
+        unknown_settings = set(settings) - set(SETTING_DEFAULTS)
+        if unknown_settings:
+            raise TypeError('Unknown migration settings: %s' % ', '.join(sorted(unknown_settings)))
+        self.settings = dict(SETTING_DEFAULTS)
+        self.settings.update(settings)
+        if self.settings['default_team_display_name'] and not self.settings['default_team_name']:
+            self.settings['default_team_name'] = sanitize_name(self.settings['default_team_display_name'])
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['settings'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @classmethod
+    def from_globals(cls):
+        return cls(**dict((setting, globals()[name]) for setting, name in SETTING_GLOBALS.items()))
+
+    @classmethod
+    def from_arguments(cls, args):
+        # same as the command line, e.g. ['-t', 'MyTeam', '-i', './data', '--migrate-all']
+        # the arguments are parsed into the module globals, which are restored afterwards
+        with active_context_lock:
+            if active_context is not None:
+                raise RuntimeError('Cannot parse arguments while a MigrationContext is active')
+            saved_globals = module_globals()
+            try:
+                parse_arguments(args)
+                return cls.from_globals()
+            finally:
+                globals().update(saved_globals)
+
+    def _apply(self):
+        for setting, value in self.settings.items():
+            globals()[SETTING_GLOBALS[setting]] = value
+
+
+class MigrationContext:
+    # Streams the migration of an export without writing import files:
+    #   with MigrationContext(config) as context:
+    #       for mm_channel in context.iter_channels():
+    #           posts = list(context.iter_channel_posts(mm_channel))
+    # The stages read the module globals, so a context applies its config to them until it is closed. Only one
+    # context can be active per process, the globals of before are restored when it is closed.
+    def __init__(self, config, emoji_mapping=None):
+        global active_context
+
+        self.config = config
+        self.emoji_mapping = emoji_mapping or {}
+        self._users = None
+        self._username_mappings = None
+        with active_context_lock:
+            if active_context is not None:
+                raise RuntimeError('Another MigrationContext is active in this process, close it first')
+            self._saved_globals = module_globals()
+            active_context = self
+        try:
+            config._apply()
+            open_hipchat_export(migration_metrics.MetricsRecorder(False, None, migration_output_path))
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        global active_context
+
+        with active_context_lock:
+            if active_context is not self:
+                return
+            try:
+                close_hipchat_export()
+            finally:
+                globals().update(self._saved_globals)
+                active_context = None
+
+    def _active(self, iterator):
+        # the generators of a stage read the globals while they are consumed, which must end with the context
+        while True:
+            if active_context is not self:
+                raise RuntimeError('MigrationContext is closed')
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+
+    def users(self):
+        # the users are needed to map the senders and mentions of posts, they are loaded once
+        if self._users is None:
+            self._users = list(self.iter_users())
+            self._username_mappings = username_mappings(self._users)
+        return self._users
+
+    def iter_users(self):
+        return self._active(iter_users())
+
+    def iter_channels(self):
+        return self._active(iter_channels())
+
+    def iter_channel_posts(self, mm_channel, create_at=None):
+        self.users()
+        mm_username_by_hc_id, mm_username_by_mention_name = self._username_mappings
+        return self._active(iter_channel_posts(mm_username_by_hc_id, mm_channel, self.emoji_mapping,
+                                               mm_username_by_mention_name, create_at=create_at))
+
+    def iter_direct_posts(self, mm_user, create_at=None):
+        self.users()
+        mm_username_by_hc_id, mm_username_by_mention_name = self._username_mappings
+        return self._active(iter_direct_posts(mm_username_by_hc_id, mm_user, self.emoji_mapping,
+                                              mm_username_by_mention_name, create_at=create_at))
+
+
 def main():
     parse_arguments()
 
-    stats_total_users = 0
-    stats_total_direct_posts = 0
-    stats_total_channels = 0
-    stats_total_channel_posts = 0
+    if option_census:
+        logger.info('Starting census of %s' % migration_input_path)
+        census_limits = export_census.CensusLimits(MM_MAX_MESSAGE_LENGTH, MM_MAX_FILE_ATTACHMENT_SIZE_BYTES,
+                                                   MM_MAX_IMAGE_PIXELS)
+        export_census.run_census(migration_input_path, full_output_path(OUTPUT_CENSUS_FILENAME, 'json'), census_limits,
+                                 import_posts_per_second=option_census_import_rate)
+        logger.info('Census written to %s' % full_output_path(OUTPUT_CENSUS_FILENAME, 'json'))
+        return
 
     start_time = time.time()
     logger.info('Starting migration')
-
-    if option_hipchat_amend_rooms:
+    metrics = migration_metrics.MetricsRecorder(option_trace_memory, option_profile_stage, migration_output_path)
+    open_hipchat_export(metrics)
+
+    plan = None
+    if option_partition or option_merge_partitions:
+        plan = partition_plan.PartitionPlan.load(full_output_path(OUTPUT_PARTITION_PLAN_FILENAME, 'json'))
+        if option_partition and option_partition[1] != plan.partitions:
+            logger.error('Partition %d/%d does not match the plan of %d partitions' % (
+                option_partition[0], option_partition[1], plan.partitions))
+            exit(1)
+        if option_merge_partitions:
+            missing_partitions = [p for p in range(1, plan.partitions + 1) if not os.path.exists(
+                full_output_path(OUTPUT_PARTITION_RESULT_FILENAME % (p, plan.partitions), 'json'))]
+            if missing_partitions:
+                logger.error('Partitions %s of %d have not finished yet' % (
+                    ', '.join(map(str, missing_partitions)), plan.partitions))
+                exit(1)
+
+    def in_partition(history_type, hc_id):
+        return not option_partition or plan.owns(option_partition[0], history_type, hc_id)
+
+    def amend_rooms_stage(results):
         logger.info('Amending Hipchat room export')
-        input_file = '%s/rooms.json' % migration_input_path
-        amend_hipchat_rooms.amend_rooms(input_file, migration_output_path, OUTPUT_HC_ROOMS_AMENDED_FILENAME,
-                                        option_hipchat_base_url, option_hipchat_tokens)
+        with metrics.stage('amend_rooms'):
+            input_file = hc_export_source.file_path('rooms.json')
+            amend_hipchat_rooms.amend_rooms(input_file, migration_output_path, OUTPUT_HC_ROOMS_AMENDED_FILENAME,
+                                            option_hipchat_base_url, option_hipchat_tokens)
         logger.info('Amending room export finished')
 
-    emoji_mapping = {}
-    if option_migrate_hipchat_custom_emoticons or option_migrate_hipchat_builtin_emoticons:
+    def emoticons_stage(results):
         logger.info('Emoticon migration started')
-        emoji_mapping = migrate_hipchat_emoticons.migrate_emoticons(migration_output_path, option_hipchat_base_url,
-                                                    option_hipchat_tokens, option_migrate_hipchat_builtin_emoticons)
+        with metrics.stage('emoticons') as stage:
+            emoji_mapping = migrate_hipchat_emoticons.migrate_emoticons(migration_output_path, option_hipchat_base_url,
+                                                        option_hipchat_tokens, option_migrate_hipchat_builtin_emoticons)
+            stage.records_out = len(emoji_mapping)
         logger.info('Emoticon migration finished')
-
-    logger.info('Team migration started')
-    mm_team = migrate_team()
-    write_mm_json([mm_team], OUTPUT_TEAM_FILENAME)
-    logger.info('Team migration finished')
-
-    logger.info('User migration started')
-    mm_users = migrate_users()
-    stats_total_users = len(mm_users)
-    mm_username_by_hc_id = dict([(u.get_hc_id(), u.username) for u in mm_users])
-    logger.info('User migration finished')
-
-    if option_migrate_direct_posts:
+        return emoji_mapping
+
+    def team_stage(results):
+        logger.info('Team migration started')
+        with metrics.stage('team') as stage:
+            mm_team = migrate_team()
+            write_mm_json([mm_team], OUTPUT_TEAM_FILENAME)
+            stage.records_out = 1
+        logger.info('Team migration finished')
+
+    def users_stage(results):
+        logger.info('User migration started')
+        with metrics.stage('users') as stage:
+            mm_users = migrate_users()
+            stage.records_in = stage.records_out = len(mm_users)
+        logger.info('User migration finished')
+        return mm_users
+
+    def direct_posts_stage(results):
         logger.info('Direct post migration started')
-
-        direct_channel_user_pairs = []
-        for i, mm_user in enumerate(mm_users):
-            logger.info('\tMigrating posts of user (username: %s) %d/%d' % (mm_user.username, i, len(mm_users)))
-            mm_direct_posts_of_user = migrate_direct_posts(mm_username_by_hc_id, mm_user, emoji_mapping)
-            stats_total_direct_posts += len(mm_direct_posts_of_user)
-            logger.debug('\t\t%d posts migrated' % len(mm_direct_posts_of_user))
-            write_mm_json(mm_direct_posts_of_user, '%s_%d' % (OUTPUT_DIRECT_POSTS_FILENAME, mm_user.get_hc_id()))
-            direct_channel_user_pairs.extend(list(map(lambda p: frozenset(p.channel_members), mm_direct_posts_of_user)))
-
-        mm_direct_channels = migrate_direct_channels(direct_channel_user_pairs)
-        logger.debug('\t%d direct channels migrated' % len(mm_direct_channels))
-        write_mm_json(mm_direct_channels, OUTPUT_DIRECT_CHANNELS_FILENAME)
+        mm_users = results['users']
+        emoji_mapping = results.get('emoticons', {})
+        mm_username_by_hc_id, mm_username_by_mention_name = username_mappings(mm_users)
+        total_direct_posts = 0
+        direct_post_filenames = []
+        bucket_writer = None
+        if option_direct_post_buckets or option_direct_post_bucket_size_mb:
+            bucket_size_bytes = option_direct_post_bucket_size_mb * 1024 * 1024 if option_direct_post_bucket_size_mb else None
+            bucket_filename = OUTPUT_DIRECT_POSTS_BUCKET_FILENAME
+            if option_partition:
+                bucket_filename = '%s_p%d' % (bucket_filename, option_partition[0])  # unique in the shared output path
+            bucket_writer = BucketedJsonWriter(bucket_filename, option_direct_post_buckets, bucket_size_bytes)
+
+        with metrics.stage('direct_posts') as stage:
+            direct_channel_user_pairs = []
+            adjusted_timestamps = 0
+            # all users are needed for the username mappings, but only the ones of the partition are converted
+            scope_hc_ids = set(u.get_hc_id() for u in mm_users if not option_migration_scope or
+                               option_migration_scope.includes_user(u.get_hc_id(), [u.get_hc_mention_name(), u.email]))
+            partition_users = [u for u in mm_users if in_partition('users', u.get_hc_id()) and
+                               u.get_hc_id() in scope_hc_ids]
+            # the messages of senders outside the scope are taken from the histories of their receivers
+            include_received_from = (lambda sender_hc_id: sender_hc_id not in scope_hc_ids) \
+                if option_migration_scope else None
+            history_sizes = [hipchat_history_size('users', u.get_hc_id()) for u in partition_users]
+            with migration_progress.ProgressReporter(logger, 'Direct posts', history_sizes,
+                                                     option_progress_interval) as progress:
+                for mm_user, history_size in zip(partition_users, history_sizes):
+                    create_at = create_at_allocator.CreateAtAllocator()
+                    mm_direct_posts_of_user = migrate_direct_posts(mm_username_by_hc_id, mm_user, emoji_mapping,
+                                                                   mm_username_by_mention_name, create_at,
+                                                                   include_received_from)
+                    adjusted_timestamps += create_at.adjusted
+                    total_direct_posts += len(mm_direct_posts_of_user)
+                    if bucket_writer:
+                        for p in mm_direct_posts_of_user:
+                            # all posts of a conversation end up in the same bucket
+                            bucket_writer.write(p, ' '.join(sorted(p.channel_members)))
+                    elif len(mm_direct_posts_of_user) > 0:
+                        filename = '%s_%d' % (OUTPUT_DIRECT_POSTS_FILENAME, mm_user.get_hc_id())
+                        write_mm_json(mm_direct_posts_of_user, filename)
+                        direct_post_filenames.append(filename)
+                    direct_channel_user_pairs.extend(list(map(lambda p: frozenset(p.channel_members), mm_direct_posts_of_user)))
+                    progress.unit_done(history_size, len(mm_direct_posts_of_user),
+                                       'Migrated posts of user (username: %s)' % mm_user.username)
+
+            if bucket_writer:
+                bucket_writer.close()
+                direct_post_filenames = bucket_writer.filenames
+                logger.debug('\t%d direct posts written to %d bucket files' % (
+                    bucket_writer.objects_written, len(bucket_writer.filenames)))
+
+            logger.info('\t%d direct post timestamps adjusted to be unique per conversation and sender' % (
+                adjusted_timestamps))
+            stage.records_in = len(partition_users)
+            stage.records_out = total_direct_posts
+            # the direct channels of all partitions are written by the merge
+            if not option_partition:
+                mm_direct_channels = migrate_direct_channels(direct_channel_user_pairs)
+                logger.debug('\t%d direct channels migrated' % len(mm_direct_channels))
+                write_mm_json(mm_direct_channels, OUTPUT_DIRECT_CHANNELS_FILENAME)
+                stage.records_out += len(mm_direct_channels)
 
         logger.info('Direct post migration finished')
+        return total_direct_posts, direct_post_filenames, direct_channel_user_pairs
 
-    if option_migrate_channels:
+    def channels_stage(results):
         logger.info('Channel migration started')
-        mm_channels = migrate_channels()
-        stats_total_channels = len(mm_channels)
-        logger.debug('\t%d channels migrated' % len(mm_channels))
-        write_mm_json(mm_channels, OUTPUT_CHANNELS_FILENAME)
-
-        if option_migrate_channel_posts:
-            for i in range(len(mm_channels)):
-                channel = mm_channels[i]
-                logger.info('\tMigrating posts of channel (name: %s) %d/%d' % (channel.name, i, len(mm_channels)))
-                mm_posts = migrate_channel_posts(mm_username_by_hc_id, channel, emoji_mapping)
-                stats_total_channel_posts += len(mm_posts)
-                logger.debug('\t\t%d posts migrated' % len(mm_posts))
-                write_mm_json(mm_posts, '%s_%d' % (OUTPUT_CHANNEL_POSTS_FILENAME, channel.get_hc_id()))
-
-                # Hipchat export does not include public room participants, Hipchat API only returns participant if user is online during the requests
-                # As an educated guess if a user should become member of a public channel, we check if the user ever wrote a message in the room
-                if option_public_membership_based_on_messages:
-                    unique_senders = set(map(lambda p: p.get_user_hc_id(), mm_posts))
-                    channel.add_channel_participants(unique_senders)
-
-        # Another option (probably the most reliable one) to get participants of public Hipchat rooms, is to use a Redis export
-        # redis_autojoin.sh produces the json file containing room memberships used here
-        if option_public_membership_based_on_redis:
-            participants_by_room_name = redis_participants_by_room_name()
-            for c in mm_channels:
-                c.add_channel_participants(participants_by_room_name.get(c.get_hc_name(), []))
-
-        for mm_user in mm_users:
-            channel_memberships = migrate_user_channel_membership(mm_channels, mm_user)
-            if len(channel_memberships) > MM_MAX_CHANNEL_MEMBERSHIPS_PER_USER:
-                logger.warning(
-                    "Encountered user (username: %s) with too many channel memberships (%d of %d allowed). Skipping channel memberships!"
-                    % (mm_user.username, len(channel_memberships), MM_MAX_CHANNEL_MEMBERSHIPS_PER_USER))
-            mm_user.teams[0].channels = channel_memberships[0:MM_MAX_CHANNEL_MEMBERSHIPS_PER_USER - 1]
+        with metrics.stage('channels') as stage:
+            mm_channels = migrate_channels()
+            logger.debug('\t%d channels migrated' % len(mm_channels))
+            if not option_partition:
+                write_mm_json(mm_channels, OUTPUT_CHANNELS_FILENAME)
+            stage.records_in = stage.records_out = len(mm_channels)
+        return mm_channels
+
+    def channel_posts_stage(results):
+        mm_channels = [c for c in results['channels'] if in_partition('rooms', c.get_hc_id())]
+        emoji_mapping = results.get('emoticons', {})
+        mm_username_by_hc_id, mm_username_by_mention_name = username_mappings(results['users'])
+        activity_builder = activity_matrix.ActivityMatrixBuilder(option_public_membership_active_days)
+        total_channel_posts = 0
+        channel_post_filenames = []
+        adjusted_timestamps = 0
+
+        with metrics.stage('channel_posts') as stage:
+            history_sizes = [hipchat_history_size('rooms', c.get_hc_id()) for c in mm_channels]
+            with migration_progress.ProgressReporter(logger, 'Channel posts', history_sizes,
+                                                     option_progress_interval) as progress:
+                for channel, history_size in zip(mm_channels, history_sizes):
+                    create_at = create_at_allocator.CreateAtAllocator()
+                    mm_posts = migrate_channel_posts(mm_username_by_hc_id, channel, emoji_mapping,
+                                                     mm_username_by_mention_name, activity_builder, create_at)
+                    adjusted_timestamps += create_at.adjusted
+                    total_channel_posts += len(mm_posts)
+                    filename = '%s_%d' % (OUTPUT_CHANNEL_POSTS_FILENAME, channel.get_hc_id())
+                    write_mm_json(mm_posts, filename)
+                    channel_post_filenames.append(filename)
+                    progress.unit_done(history_size, len(mm_posts),
+                                       'Migrated posts of channel (name: %s)' % channel.name)
+            logger.info('\t%d channel post timestamps adjusted to be unique per channel' % adjusted_timestamps)
+            stage.records_in = len(mm_channels)
+            stage.records_out = total_channel_posts
+        return total_channel_posts, activity_builder, channel_post_filenames
+
+    def membership_stage(results):
+        mm_users = results['users']
+        mm_channels = results['channels']
+
+        with metrics.stage('membership') as stage:
+            # with a staging database the activity is an indexed query, no need to have the posts migrated
+            if staging_db_connection:
+                activity_builder = activity_matrix.ActivityMatrixBuilder(option_public_membership_active_days)
+                load_hipchat_room_activity(activity_builder)
+            elif 'channel_posts' in results:
+                activity_builder = results['channel_posts'][1]
+            else:
+                activity_builder = activity_matrix.ActivityMatrixBuilder(option_public_membership_active_days)
+            activity = activity_builder.build()
+
+            # Hipchat export does not include public room participants, Hipchat API only returns participant if user is online during the requests
+            # As an educated guess if a user should become member of a public channel, we check if the user wrote (enough) messages in the room
+            if option_public_membership_based_on_messages:
+                members_by_room = activity.members_by_room(option_public_membership_min_messages,
+                                                           option_public_membership_active_days)
+                for c in mm_channels:
+                    c.add_channel_participants(members_by_room.get(c.get_hc_id(), set()))
+
+            # Another option (probably the most reliable one) to get participants of public Hipchat rooms, is to use a Redis export
+            # redis_autojoin.sh produces the json file containing room memberships used here
+            if option_public_membership_based_on_redis:
+                participants_by_room_name = redis_participants_by_room_name()
+                for c in mm_channels:
+                    c.add_channel_participants(participants_by_room_name.get(c.get_hc_name(), []))
+
+            hc_room_id_by_channel_name = dict((c.name, c.get_hc_id()) for c in mm_channels)
+            for mm_user in mm_users:
+                channel_memberships = migrate_user_channel_membership(mm_channels, mm_user)
+                if len(channel_memberships) > MM_MAX_CHANNEL_MEMBERSHIPS_PER_USER:
+                    logger.warning(
+                        "Encountered user (username: %s) with too many channel memberships (%d of %d allowed). Keeping the most active channel memberships!"
+                        % (mm_user.username, len(channel_memberships), MM_MAX_CHANNEL_MEMBERSHIPS_PER_USER))
+                    # by message count and last activity, channels without messages of the user last
+                    user_activity = activity.activity_of_user(mm_user.get_hc_id())
+                    channel_memberships.sort(
+                        key=lambda m: user_activity.get(hc_room_id_by_channel_name[m.name], (0, 0)), reverse=True)
+                mm_user.teams[0].channels = channel_memberships[0:MM_MAX_CHANNEL_MEMBERSHIPS_PER_USER - 1]
+                stage.records_out += len(mm_user.teams[0].channels)
+            stage.records_in = len(mm_users)
 
         logger.info('Channel migration finished')
 
-    # Users need to be written after all other migrations, as other migrations have an impact (e.g. channels for the membership)
-    write_mm_json(mm_users, OUTPUT_USERS_FILENAME)
-
-    if option_concat_import_files:
+    def sort_posts_stage(results):
+        logger.info('Sorting posts by creation time')
+        filenames = results.get('direct_posts', (0, []))[1] + results.get('channel_posts', (0, None, []))[2]
+        sorter = external_sort.ExternalSorter('%s/%s' % (migration_output_path, OUTPUT_SORT_SPILL_DIRNAME),
+                                              option_sort_memory_mb * 1024 * 1024)
+        with metrics.stage('sort_posts') as stage:
+            for filename in filenames:
+                sorter.sort_file(full_output_path(filename), post_create_at)
+            stage.records_in = len(filenames)
+            stage.records_out = sorter.files_sorted
+        logger.info('\t%d post files sorted (%d runs spilled to disk), %d already in order' % (
+            sorter.files_sorted, sorter.runs_spilled, sorter.files_in_order))
+
+    def write_users_stage(results):
+        mm_users = results['users']
+        with metrics.stage('write_users') as stage:
+            stage.records_in = len(mm_users)
+            if option_migration_scope:
+                mm_users = scoped_users(mm_users, results.get('direct_posts', (0, [], []))[2],
+                                        results.get('channel_posts', (0, None))[1])
+                logger.info('\tPartial migration: %d of %d users selected or referenced by the migrated posts' % (
+                    len(mm_users), stage.records_in))
+                if option_migrate_avatars:
+                    migrate_avatars(mm_users)
+            write_deleted_users(mm_users)
+            write_mm_json(mm_users, OUTPUT_USERS_FILENAME)
+            stage.records_out = len(mm_users)
+        return mm_users
+
+    def concat_stage(results):
         logger.info('Concat all migration files into %s.jsonl' % OUTPUT_ALL_IN_ONE_FILENAME)
 
-        input_files = [full_output_path(OUTPUT_TEAM_FILENAME)]
-
-        if option_migrate_hipchat_builtin_emoticons or option_migrate_hipchat_custom_emoticons:
-            input_files.append(full_output_path(OUTPUT_EMOJI_FILENAME))
-
-        if option_migrate_channels:
-            input_files.append(full_output_path(OUTPUT_CHANNELS_FILENAME))
-
-        input_files.append(full_output_path(OUTPUT_USERS_FILENAME))
+        with metrics.stage('concat') as stage:
+            # in the order of the line types expected by the bulk import: emoji, team, channel, user, post,
+            # direct_channel, direct_post
+            input_files = []
+
+            if option_migrate_hipchat_builtin_emoticons or option_migrate_hipchat_custom_emoticons:
+                input_files.append(full_output_path(OUTPUT_EMOJI_FILENAME))
+
+            input_files.append(full_output_path(OUTPUT_TEAM_FILENAME))
+
+            if option_migrate_channels:
+                input_files.append(full_output_path(OUTPUT_CHANNELS_FILENAME))
+
+            input_files.append(full_output_path(OUTPUT_USERS_FILENAME))
+
+            if option_migrate_channels:
+                channel_posts_files = glob.glob('%s/%s*.jsonl' % (migration_output_path, OUTPUT_CHANNEL_POSTS_FILENAME))
+                input_files.extend(channel_posts_files)
+
+            if option_migrate_direct_posts:
+                input_files.append(full_output_path(OUTPUT_DIRECT_CHANNELS_FILENAME))
+                # only the files written by this run, files of earlier runs with other bucket settings may remain
+                input_files.extend(full_output_path(f) for f in results['direct_posts'][1])
+
+            concat_files(input_files, OUTPUT_ALL_IN_ONE_FILENAME)
+            stage.records_in = stage.records_out = len(input_files)
+
+    def plan_stage(results):
+        logger.info('Planning %d partitions' % option_plan_partitions)
+        with metrics.stage('plan') as stage:
+            # only the histories which are going to be migrated count for the balance
+            history_sizes = {}
+            for hc_user in iter_hipchat_users():
+                history_sizes[('users', hc_user['id'])] = hipchat_history_size(
+                    'users', hc_user['id']) if option_migrate_direct_posts else 0
+            for hc_room in load_hipchat_rooms():
+                history_sizes[('rooms', hc_room['id'])] = hipchat_history_size(
+                    'rooms', hc_room['id']) if option_migrate_channel_posts else 0
+            plan = partition_plan.PartitionPlan.create(option_plan_partitions, history_sizes,
+                                                       results.get('emoticons', {}))
+            plan.store(full_output_path(OUTPUT_PARTITION_PLAN_FILENAME, 'json'))
+            stage.records_in = stage.records_out = len(history_sizes)
+        for partition, load in sorted(plan.loads.items()):
+            logger.info('\tPartition %d/%d: %d rooms and users, %.1f MB of history' % (
+                partition, option_plan_partitions, list(plan.owners.values()).count(partition), load / 1024 / 1024))
+        return plan
+
+    def partition_result_stage(results):
+        # everything the merge needs from the partition, the posts themselves are already in the output path
+        partition, partitions = option_partition
+        total_direct_posts, direct_post_filenames, direct_channel_user_pairs = results.get('direct_posts', (0, [], []))
+        total_channel_posts, activity_builder, _ = results.get('channel_posts', (0, None, []))
+        with metrics.stage('partition_result'):
+            partition_plan.write_json({
+                'partition': partition,
+                'direct_posts': total_direct_posts,
+                'direct_post_filenames': direct_post_filenames,
+                'direct_channels': sorted(sorted(p) for p in set(direct_channel_user_pairs)),
+                'channel_posts': total_channel_posts,
+                'activity': activity_builder.entries() if activity_builder else []
+            }, full_output_path(OUTPUT_PARTITION_RESULT_FILENAME % (partition, partitions), 'json'))
+
+    def partition_results_stage(results):
+        partition_results = []
+        for partition in range(1, plan.partitions + 1):
+            with open(full_output_path(OUTPUT_PARTITION_RESULT_FILENAME % (partition, plan.partitions), 'json'),
+                      'r') as result_file:
+                partition_results.append(json.load(result_file))
+        return partition_results
+
+    def merged_direct_posts_stage(results):
+        partition_results = results['partition_results']
+        with metrics.stage('direct_posts') as stage:
+            direct_channel_user_pairs = [frozenset(p) for r in partition_results for p in r['direct_channels']]
+            mm_direct_channels = migrate_direct_channels(direct_channel_user_pairs)
+            logger.debug('\t%d direct channels migrated' % len(mm_direct_channels))
+            write_mm_json(mm_direct_channels, OUTPUT_DIRECT_CHANNELS_FILENAME)
+            stage.records_in = len(direct_channel_user_pairs)
+            stage.records_out = len(mm_direct_channels)
+            direct_post_filenames = [f for r in partition_results for f in r['direct_post_filenames']]
+            if option_sort_posts:
+                # a conversation is in the bucket of the same index of both senders' partitions, sorted by each
+                filenames_by_bucket = {}
+                for filename in direct_post_filenames:
+                    filenames_by_bucket.setdefault(int(filename.rsplit('_', 1)[1]), []).append(filename)
+                sorter = external_sort.ExternalSorter('%s/%s' % (migration_output_path, OUTPUT_SORT_SPILL_DIRNAME))
+                direct_post_filenames = []
+                for bucket, filenames in sorted(filenames_by_bucket.items()):
+                    merged_filename = '%s_%d' % (OUTPUT_DIRECT_POSTS_BUCKET_FILENAME, bucket)
+                    sorter.merge_files([full_output_path(f) for f in filenames], full_output_path(merged_filename),
+                                       post_create_at)
+                    direct_post_filenames.append(merged_filename)
+                logger.info('\t%d sorted direct post buckets of the partitions merged' % len(direct_post_filenames))
+        return (sum(r['direct_posts'] for r in partition_results), direct_post_filenames, direct_channel_user_pairs)
+
+    def merged_channel_posts_stage(results):
+        partition_results = results['partition_results']
+        activity_builder = activity_matrix.ActivityMatrixBuilder(option_public_membership_active_days)
+        for r in partition_results:
+            for entry in r['activity']:
+                activity_builder.add_entry(*entry)
+        return sum(r['channel_posts'] for r in partition_results), activity_builder, []
+
+    # Stages only wait for the stages they depend on, e.g. users are migrated while emoticons are still downloaded.
+    # Dependencies on stages that are not enabled are ignored by the scheduler.
+    scheduler = stage_scheduler.StageScheduler(option_stage_workers)
+    if option_hipchat_amend_rooms and not plan:
+        scheduler.add('amend_rooms', amend_rooms_stage)
+    if option_migrate_hipchat_custom_emoticons or option_migrate_hipchat_builtin_emoticons:
+        if option_partition:
+            # downloaded once by the planning
+            scheduler.add('emoticons', lambda results: plan.emoji_mapping)
+        elif not plan:
+            # both go through hipchat_api, which keeps its token state in module globals, and share the rate limit
+            scheduler.add('emoticons', emoticons_stage, depends_on=['amend_rooms'])
+
+    if option_plan_partitions:
+        scheduler.add('plan', plan_stage, depends_on=['amend_rooms', 'emoticons'])
+        scheduler.run()
+        logger.info('Partition plan written to %s, run --partition k/%d for k = 1 to %d next' % (
+            full_output_path(OUTPUT_PARTITION_PLAN_FILENAME, 'json'), option_plan_partitions, option_plan_partitions))
+        return
 
+    if option_partition:
+        # a partition converts the posts of its rooms and users, everything else is left to the merge
+        scheduler.add('users', users_stage)
         if option_migrate_direct_posts:
-            input_files.append(full_output_path(OUTPUT_DIRECT_CHANNELS_FILENAME))
-            direct_post_files = glob.glob('%s/%s*.jsonl' % (migration_output_path, OUTPUT_DIRECT_POSTS_FILENAME))
-            input_files.extend(direct_post_files)
-
-        if option_migrate_channels:
-            channel_posts_files = glob.glob('%s/%s*.jsonl' % (migration_output_path, OUTPUT_CHANNEL_POSTS_FILENAME))
-            input_files.extend(channel_posts_files)
+            scheduler.add('direct_posts', direct_posts_stage, depends_on=['users', 'emoticons'])
+        if option_migrate_channel_posts:
+            scheduler.add('channels', channels_stage)
+            scheduler.add('channel_posts', channel_posts_stage, depends_on=['channels', 'users', 'emoticons'])
+        if option_sort_posts:
+            scheduler.add('sort_posts', sort_posts_stage, depends_on=['direct_posts', 'channel_posts'])
+        scheduler.add('partition_result', partition_result_stage,
+                      depends_on=['direct_posts', 'channel_posts', 'sort_posts'])
+        scheduler.run()
+        logger.info('Partition %d/%d finished in %d seconds, run --merge-partitions once all partitions finished' % (
+            option_partition[0], option_partition[1], time.time() - start_time))
+        return
 
-        concat_files(input_files, OUTPUT_ALL_IN_ONE_FILENAME)
+    scheduler.add('team', team_stage)
+    scheduler.add('users', users_stage)
+    if option_merge_partitions:
+        scheduler.add('partition_results', partition_results_stage)
+    if option_migrate_direct_posts:
+        if option_merge_partitions:
+            scheduler.add('direct_posts', merged_direct_posts_stage, depends_on=['partition_results'])
+        else:
+            # posts need the emoji mapping to replace emoticons
+            scheduler.add('direct_posts', direct_posts_stage, depends_on=['users', 'emoticons'])
+    if option_migrate_channels:
+        scheduler.add('channels', channels_stage, depends_on=['amend_rooms'])
+        if option_migrate_channel_posts:
+            if option_merge_partitions:
+                scheduler.add('channel_posts', merged_channel_posts_stage, depends_on=['partition_results'])
+            else:
+                scheduler.add('channel_posts', channel_posts_stage, depends_on=['channels', 'users', 'emoticons'])
+        scheduler.add('membership', membership_stage, depends_on=['channels', 'channel_posts', 'users'])
+    if option_sort_posts and not option_merge_partitions:  # sorted by the partitions
+        scheduler.add('sort_posts', sort_posts_stage, depends_on=['direct_posts', 'channel_posts'])
+    # Users need to be written after all other migrations, as other migrations have an impact (e.g. channels for the membership)
+    scheduler.add('write_users', write_users_stage,
+                  depends_on=['amend_rooms', 'emoticons', 'team', 'users', 'direct_posts', 'channels', 'channel_posts',
+                              'membership'])
+    if option_concat_import_files:
+        scheduler.add('concat', concat_stage, depends_on=['write_users', 'direct_posts', 'sort_posts'])
+    stage_results = scheduler.run()
+
+    stats_total_users = len(stage_results['write_users'])
+    stats_total_direct_posts = stage_results['direct_posts'][0] if 'direct_posts' in stage_results else 0
+    stats_total_channels = len(stage_results.get('channels', []))
+    stats_total_channel_posts = stage_results['channel_posts'][0] if 'channel_posts' in stage_results else 0
+
+    if hc_parse_cache:
+        logger.info('Parse cache: %d history files read from cache, %d parsed' % (
+            hc_parse_cache.hits, hc_parse_cache.misses))
+
+    if option_metrics_output_file:
+        metrics.write_report(option_metrics_output_file)
+        logger.info('Metrics report written to %s' % option_metrics_output_file)
+
+    if option_profile_stage:
+        if any(s.name == option_profile_stage for s in metrics.stages):
+            logger.info('Profile of stage %s written to %s (inspect with "python -m pstats")' % (
+                option_profile_stage, metrics.profile_file_path(option_profile_stage)))
+        else:
+            logger.warning('Stage %s to be profiled did not run' % option_profile_stage)
 
     logger.info("Migration finished")
     end_time = time.time()
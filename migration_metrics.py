@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Per-stage instrumentation of a migration run: time, records, I/O and memory of every stage,
+# written as a JSON report to compare runs and plan conversion windows.
+
+import cProfile
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PROC_SELF_IO_PATH = '/proc/self/io'
+
+
+def _io_counters():
+    # characters read and written by the process (incl. page cache hits), only available on Linux
+    if not os.path.exists(PROC_SELF_IO_PATH):
+        return None
+    counters = {}
+    with open(PROC_SELF_IO_PATH, 'r') as io_file:
+        for line in io_file:
+            key, _, value = line.partition(':')
+            counters[key] = int(value)
+    return counters['rchar'], counters['wchar']
+
+
+def _peak_rss_bytes():
+    # high-water mark of the process since it started, not of a single stage
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024  # kilobytes on Linux, bytes on macOS
+
+
+class StageMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.records_in = 0  # input entities, e.g. users, rooms or history files
+        self.records_out = 0  # migrated objects, e.g. users, channels or posts
+        self.bytes_read = None
+        self.bytes_written = None
+        self.peak_traced_bytes = None
+        self.peak_rss_bytes = 0
+        self.overlapped = False  # other stages ran at the same time, the process-wide numbers include them
+
+    def to_dict(self):
+        wall_seconds = max(self.wall_seconds, 1e-9)
+        return {'stage': self.name,
+                'wall_seconds': round(self.wall_seconds, 3),
+                'cpu_seconds': round(self.cpu_seconds, 3),
+                'records_in': self.records_in,
+                'records_out': self.records_out,
+                'records_out_per_second': round(self.records_out / wall_seconds, 1),
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'peak_traced_bytes': self.peak_traced_bytes,
+                'peak_rss_bytes': self.peak_rss_bytes,
+                'overlapped': self.overlapped}
+
+
+class MetricsRecorder:
+    def __init__(self, trace_memory=False, profile_stage=None, profile_output_path='.'):
+        self.stages = []
+        self.trace_memory = trace_memory
+        self.profile_stage = profile_stage
+        self.profile_output_path = profile_output_path
+        self.start_time = time.time()
+        self._active_stages = []
+        self._lock = threading.Lock()
+        if trace_memory:
+            tracemalloc.start()
+
+    def profile_file_path(self, stage_name):
+        return '%s/profile_%s.pstats' % (self.profile_output_path, stage_name)
+
+    @contextmanager
+    def stage(self, name):
+        # CPU time is the one of the thread running the stage, work handed to pools (e.g. avatars) is not included.
+        # I/O counters, traced memory and RSS are process-wide: they include the stages running at the same time
+        # (flagged as overlapped) and the peak RSS is the high-water mark of the whole run up to the end of the stage.
+        metrics = StageMetrics(name)
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        io_start = _io_counters()
+        with self._lock:
+            if self._active_stages:
+                metrics.overlapped = True
+                for active_metrics in self._active_stages:
+                    active_metrics.overlapped = True
+            elif self.trace_memory:
+                # resetting the peak while other stages run would lose theirs
+                tracemalloc.reset_peak()
+            self._active_stages.append(metrics)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield metrics
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.profile_file_path(name))
+            metrics.wall_seconds = time.perf_counter() - wall_start
+            metrics.cpu_seconds = time.thread_time() - cpu_start
+            io_end = _io_counters()
+            if io_start and io_end:
+                metrics.bytes_read = io_end[0] - io_start[0]
+                metrics.bytes_written = io_end[1] - io_start[1]
+            if self.trace_memory:
+                metrics.peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+            metrics.peak_rss_bytes = _peak_rss_bytes()
+            with self._lock:
+                self._active_stages.remove(metrics)
+                self.stages.append(metrics)
+
+    def to_dict(self):
+        return {'started_at': self.start_time,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'total_wall_seconds': round(time.time() - self.start_time, 3),  # stages may overlap
+                'total_cpu_seconds': round(sum(s.cpu_seconds for s in self.stages), 3),
+                'process_cpu_seconds': round(time.process_time(), 3),
+                'peak_rss_bytes': _peak_rss_bytes(),
+                'stages': [s.to_dict() for s in self.stages]}
+
+    def write_report(self, path):
+        with open(path, 'w') as report_file:
+            json.dump(self.to_dict(), report_file, indent=2)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Progress reporting for the post migration stages. Progress is weighted by the size of the history files,
+# as a few huge rooms usually hold most of the messages.
+
+import threading
+import time
+
+DEFAULT_REPORT_INTERVAL_SECONDS = 30
+UNIT_LOG_INTERVAL_SECONDS = 1.0
+MB = 1024.0 * 1024.0
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class ProgressReporter:
+    def __init__(self, logger, description, unit_sizes, interval=DEFAULT_REPORT_INTERVAL_SECONDS):
+        self._logger = logger
+        self._description = description
+        self._interval = interval
+        self._total_units = len(unit_sizes)
+        self._total_bytes = sum(unit_sizes)
+        self._done_units = 0
+        self._done_bytes = 0
+        self._done_messages = 0
+        self._start_time = None
+        self._last_unit_log_time = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._start_time = time.monotonic()
+        if self._interval > 0:
+            self._thread = threading.Thread(target=self._report_periodically, name='progress', daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self._logger.info(self.summary())
+
+    def _report_periodically(self):
+        while not self._stopped.wait(self._interval):
+            self._logger.info(self.summary())
+
+    def unit_done(self, size, messages, unit_message):
+        with self._lock:
+            self._done_units += 1
+            self._done_bytes += size
+            self._done_messages += messages
+            done_units = self._done_units
+            now = time.monotonic()
+            log_unit = now - self._last_unit_log_time >= UNIT_LOG_INTERVAL_SECONDS
+            if log_unit:
+                self._last_unit_log_time = now
+        if log_unit:
+            self._logger.debug('\t%s (%d messages) %d/%d' % (unit_message, messages, done_units, self._total_units))
+
+    def summary(self):
+        with self._lock:
+            done_units, done_bytes, done_messages = self._done_units, self._done_bytes, self._done_messages
+        elapsed = max(time.monotonic() - self._start_time, 1e-9)
+        bytes_per_second = done_bytes / elapsed
+        share = float(done_bytes) / self._total_bytes if self._total_bytes > 0 else 1.0
+        if done_bytes >= self._total_bytes:
+            eta = 'done'
+        elif bytes_per_second > 0:
+            eta = _format_duration((self._total_bytes - done_bytes) / bytes_per_second)
+        else:
+            eta = 'unknown'
+        return '%s: %.1f%% (%d/%d units, %.1f/%.1f MB), %.0f messages/s, %.2f MB/s, elapsed %s, ETA %s' % (
+            self._description, share * 100, done_units, self._total_units, done_bytes / MB, self._total_bytes / MB,
+            done_messages / elapsed, bytes_per_second / MB, _format_duration(elapsed), eta)
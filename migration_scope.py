@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+# Selection of the rooms and users of a partial migration, e.g. a few rooms or a sample for a test import.
+# Only the histories of selected rooms and users are migrated. The users referenced by these histories (senders and
+# receivers) are migrated as well, so the import files stay consistent.
+
+import re
+import zlib
+
+
+class MigrationScope:
+    def __init__(self, room_ids=None, room_name_regex=None, user_ids=None, user_regex=None, sample_ratio=None):
+        self.room_ids = set(room_ids or [])
+        self.room_name_re = re.compile(room_name_regex) if room_name_regex else None
+        self.user_ids = set(user_ids or [])
+        self.user_re = re.compile(user_regex) if user_regex else None
+        self.sample_ratio = sample_ratio
+
+    def _sampled(self, history_type, hc_id):
+        # deterministic, the same units are selected by every run (and every partition)
+        return self.sample_ratio is not None and \
+            zlib.crc32(('%s/%d' % (history_type, hc_id)).encode('utf-8')) < self.sample_ratio * 2 ** 32
+
+    def includes_room(self, hc_id, name):
+        return hc_id in self.room_ids or bool(self.room_name_re and self.room_name_re.search(name or '')) \
+            or self._sampled('rooms', hc_id)
+
+    def includes_user(self, hc_id, names):
+        # names: e.g. mention name and e-mail address, any of them may match
+        return hc_id in self.user_ids or bool(self.user_re and any(self.user_re.search(n or '') for n in names)) \
+            or self._sampled('users', hc_id)
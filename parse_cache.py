@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Cache of parsed (and already filtered) history files in marshal format, which loads several times faster than
+# the JSON it was parsed from. A cache file is only used while size and mtime of its source file are unchanged.
+
+import marshal
+import os
+import threading
+
+CACHE_FORMAT_VERSION = 1
+CACHE_FILE_EXTENSION = 'marshal'
+
+
+class ParseCache:
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # for the counters, as stages may run concurrently
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+
+    def _cache_file_path(self, key):
+        return '%s/%s.%s' % (self.cache_path, key, CACHE_FILE_EXTENSION)
+
+    def load(self, source_version, key, parse, variant=None):
+        # source_version is (size, mtime) of the source file,
+        # variant distinguishes different filters applied to the same source file, e.g. a time cutoff
+        header = (CACHE_FORMAT_VERSION, tuple(source_version), variant)
+        cache_file_path = self._cache_file_path(key)
+        try:
+            with open(cache_file_path, 'rb') as cache_file:
+                if marshal.load(cache_file) == header:
+                    records = marshal.load(cache_file)
+                    with self._lock:
+                        self.hits += 1
+                    return records
+        except (OSError, EOFError, ValueError, TypeError):
+            pass  # missing or unreadable cache file, parse again
+
+        records = parse()
+        with self._lock:
+            self.misses += 1
+        tmp_cache_file_path = cache_file_path + '.tmp'
+        with open(tmp_cache_file_path, 'wb') as cache_file:
+            marshal.dump(header, cache_file)
+            marshal.dump(records, cache_file)
+        os.replace(tmp_cache_file_path, cache_file_path)
+        return records
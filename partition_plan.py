@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Splits a migration into partitions that are converted by separate processes (or machines sharing the output
+# directory). Rooms and users are the units of work, each is owned by exactly one partition. Units are assigned
+# largest first to the least loaded partition, balanced by the size of their history files.
+
+import heapq
+import json
+import os
+
+PLAN_VERSION = 1
+
+
+def parse_partition(value):
+    # "k/N" -> (k, N), partitions are numbered from 1
+    try:
+        partition, partitions = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise ValueError('Partition must be given as k/N, e.g. 1/4: %s' % value)
+    if partitions < 1 or not 1 <= partition <= partitions:
+        raise ValueError('Partition %d/%d out of range' % (partition, partitions))
+    return partition, partitions
+
+
+def balance(sizes_by_unit, partitions):
+    # longest processing time first: good enough for many units of very different size, and deterministic
+    loads = [(0, p) for p in range(1, partitions + 1)]
+    owners = {}
+    for unit, size in sorted(sizes_by_unit.items(), key=lambda u: (-u[1], u[0])):
+        load, partition = heapq.heappop(loads)
+        owners[unit] = partition
+        heapq.heappush(loads, (load + size, partition))
+    return owners, dict((p, load) for load, p in loads)
+
+
+def write_json(obj, path):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as json_file:
+        json.dump(obj, json_file)
+    os.replace(tmp_path, path)
+
+
+class PartitionPlan:
+    def __init__(self, partitions, owners, loads, emoji_mapping=None):
+        self.partitions = partitions
+        self.owners = owners  # "rooms/<id>" or "users/<id>" -> partition
+        self.loads = loads  # partition -> bytes of history
+        self.emoji_mapping = emoji_mapping or {}
+
+    @classmethod
+    def create(cls, partitions, history_sizes, emoji_mapping=None):
+        # history_sizes: (history type, Hipchat id) -> size of the history in bytes
+        owners, loads = balance(dict(('%s/%d' % unit, size) for unit, size in history_sizes.items()), partitions)
+        return cls(partitions, owners, loads, emoji_mapping)
+
+    def owner(self, history_type, hc_id):
+        # units unknown when planning (e.g. added by amending rooms) are spread by id
+        return self.owners.get('%s/%d' % (history_type, hc_id), hc_id % self.partitions + 1)
+
+    def owns(self, partition, history_type, hc_id):
+        return self.owner(history_type, hc_id) == partition
+
+    def store(self, path):
+        write_json({'version': PLAN_VERSION,
+                    'partitions': self.partitions,
+                    'owners': self.owners,
+                    'loads': dict((str(p), load) for p, load in self.loads.items()),
+                    'emoji_mapping': self.emoji_mapping}, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as plan_file:
+            plan = json.load(plan_file)
+        if plan['version'] != PLAN_VERSION:
+            raise ValueError('Unsupported partition plan version %s in %s' % (plan['version'], path))
+        return cls(plan['partitions'], plan['owners'], dict((int(p), load) for p, load in plan['loads'].items()),
+                   plan['emoji_mapping'])
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Get autojoin configuration for Hipchat users from Redis. Script is best run on a Hipchat App node.
+# Replacement for redis_autojoin.sh: uses SCAN instead of KEYS, so Redis is not blocked, and fetches the values
+# in pipelined batches instead of starting one redis-cli process per key.
+
+import json
+import logging
+import os
+import subprocess
+from optparse import OptionParser
+
+import redis
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+AUTOJOIN_KEY_PREFIX = 'pref:autoJoin:'
+ROOM_JID_DOMAIN_PREFIX = 'conf.'  # rooms are on conf.<domain>, 1:1 chats on chat.<domain>
+
+option_site_config = '/hipchat/config/site.json'
+option_redis_host = None
+option_redis_port = None
+option_redis_password = None
+option_output_file = './autojoin.json'
+option_batch_size = 1000
+
+
+def _psql_configuration_value(site_config, key):
+    postgres = site_config['databases']['hipchat_postgres']
+    env = dict(os.environ, PGPASSWORD=postgres['pass'])
+    output = subprocess.check_output(['psql', '-h', postgres['servers'][0].split(':')[0], '-U', postgres['user'],
+                                      '-d', postgres['schema'], '-t', '-c',
+                                      "SELECT value FROM configurations WHERE key='%s';" % key], env=env)
+    return output.decode('utf-8').strip()
+
+
+def _redis_connection_settings(site_config_path):
+    # the redis configuration is either stored directly in the site config or in the Hipchat database
+    with open(site_config_path, 'r') as site_config_file:
+        site_config = json.load(site_config_file)
+
+    if site_config.get('redis') and site_config['redis'][0].get('host'):
+        redis_config = site_config['redis'][0]
+        return redis_config['host'], int(redis_config['port']), redis_config.get('auth')
+
+    host = _psql_configuration_value(site_config, 'redishostname')
+    port = int(_psql_configuration_value(site_config, 'redisport'))
+    password = _psql_configuration_value(site_config, 'redispass')
+    return host, port, password if password not in ('', 'null') else None
+
+
+def _scan_autojoin_values(client, batch_size):
+    # Each round trip sends the next SCAN together with the MGET of the keys returned by the previous SCAN
+    cursor = 0
+    pending_keys = []
+    while True:
+        pipeline = client.pipeline(transaction=False)
+        pipeline.scan(cursor, match=AUTOJOIN_KEY_PREFIX + '*', count=batch_size)
+        if pending_keys:
+            pipeline.mget(pending_keys)
+        results = pipeline.execute()
+        if pending_keys:
+            for key_value in zip(pending_keys, results[1]):
+                yield key_value
+        cursor, pending_keys = results[0]
+        if cursor == 0:
+            break
+
+    if pending_keys:
+        for key_value in zip(pending_keys, client.mget(pending_keys)):
+            yield key_value
+
+
+def _parse_autojoin_rooms(value):
+    if value is None or value == b'None':
+        return []
+    rooms = json.loads(value)
+    return [r for r in rooms if r['jid'].split('@', 1)[-1].startswith(ROOM_JID_DOMAIN_PREFIX)]
+
+
+def export_autojoins(client, output_file_path, batch_size=option_batch_size):
+    seen_user_ids = set()  # SCAN may return a key more than once
+    tmp_output_file_path = output_file_path + '.tmp'
+    with open(tmp_output_file_path, 'w') as output_file:
+        output_file.write('{"autojoins": [')
+        for key, value in _scan_autojoin_values(client, batch_size):
+            try:
+                user_id = int(key.decode('utf-8')[len(AUTOJOIN_KEY_PREFIX):])
+                if user_id in seen_user_ids:
+                    continue
+                rooms = _parse_autojoin_rooms(value)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning('Skipping invalid autojoin key %s: %s' % (key, str(e)))
+                continue
+            output_file.write(',\n' if seen_user_ids else '\n')
+            output_file.write(json.dumps({'user_id': user_id, 'rooms': rooms}))
+            seen_user_ids.add(user_id)
+        output_file.write('\n]}\n')
+    os.replace(tmp_output_file_path, output_file_path)  # never leave a truncated export behind
+    return len(seen_user_ids)
+
+
+def parse_arguments():
+    global option_site_config
+    global option_redis_host
+    global option_redis_port
+    global option_redis_password
+    global option_output_file
+    global option_batch_size
+
+    parser = OptionParser(usage='''
+        usage: %prog [options]
+        Exports the room autojoin configuration of all Hipchat users from Redis to be used with
+        --public-channel-membership-based-on-redis-export of migratemost.py.
+        The Redis connection is read from the Hipchat site config unless given explicitly.
+    ''')
+    parser.add_option('-s', '--site-config',
+                      type='string',
+                      action='store',
+                      dest='site_config',
+                      help='Path to the Hipchat site config (default: %s)' % option_site_config)
+    parser.add_option('--redis-host',
+                      type='string',
+                      action='store',
+                      dest='redis_host',
+                      help='Redis host, overrides the site config')
+    parser.add_option('--redis-port',
+                      type='int',
+                      action='store',
+                      dest='redis_port',
+                      default=6379,
+                      help='Redis port, only used together with --redis-host (default: %default)')
+    parser.add_option('--redis-password',
+                      type='string',
+                      action='store',
+                      dest='redis_password',
+                      help='Redis password, only used together with --redis-host')
+    parser.add_option('-o', '--output-file',
+                      type='string',
+                      action='store',
+                      dest='output_file',
+                      help='Path of the export file (default: %s)' % option_output_file)
+    parser.add_option('-b', '--batch-size',
+                      type='int',
+                      action='store',
+                      dest='batch_size',
+                      default=option_batch_size,
+                      help='Number of keys requested per SCAN and MGET (default: %default)')
+
+    (options, args) = parser.parse_args()
+
+    if options.batch_size < 1:
+        parser.error("Batch size must be at least 1")
+    option_batch_size = options.batch_size
+
+    if options.site_config:
+        option_site_config = options.site_config
+
+    if options.redis_host:
+        option_redis_host = options.redis_host
+        option_redis_port = options.redis_port
+        option_redis_password = options.redis_password
+    elif not os.path.exists(option_site_config):
+        parser.error("Cannot find site config %s, use --redis-host to connect to Redis directly" % option_site_config)
+
+    if options.output_file:
+        option_output_file = options.output_file
+
+
+def main():
+    parse_arguments()
+
+    if option_redis_host:
+        host, port, password = option_redis_host, option_redis_port, option_redis_password
+    else:
+        host, port, password = _redis_connection_settings(option_site_config)
+
+    logger.info('Exporting autojoin configuration from Redis at %s:%d' % (host, port))
+    client = redis.Redis(host=host, port=port, password=password)
+    user_count = export_autojoins(client, option_output_file, option_batch_size)
+    logger.info('Exported autojoin configuration of %d users to %s' % (user_count, option_output_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Runs migration stages as a dependency graph: a stage starts as soon as all stages it depends on have finished,
+# independent stages run concurrently in threads. Most overlap comes from stages waiting on the network (Hipchat API)
+# or on disk while other stages use the CPU.
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+DEFAULT_STAGE_WORKERS = 4
+
+
+class StageScheduler:
+    def __init__(self, max_workers=DEFAULT_STAGE_WORKERS):
+        self.max_workers = max(max_workers, 1)
+        self._stages = {}  # name -> (function, names of stages it depends on), in order of addition
+        self._lock = threading.Lock()
+
+    def add(self, name, function, depends_on=()):
+        # function is called with a dict holding the results of all finished stages by name.
+        # Dependencies on stages that were never added are ignored, e.g. disabled optional stages.
+        if name in self._stages:
+            raise ValueError('Stage %s added twice' % name)
+        self._stages[name] = (function, tuple(depends_on))
+
+    def _dependencies(self, name):
+        return [d for d in self._stages[name][1] if d in self._stages]
+
+    def _check_acyclic(self):
+        visited = set()
+        in_progress = set()
+
+        def visit(name):
+            if name in in_progress:
+                raise ValueError('Cyclic stage dependency involving %s' % name)
+            if name in visited:
+                return
+            in_progress.add(name)
+            for dependency in self._dependencies(name):
+                visit(dependency)
+            in_progress.remove(name)
+            visited.add(name)
+
+        for stage_name in self._stages:
+            visit(stage_name)
+
+    def run(self):
+        self._check_acyclic()
+        results = {}
+        pending = list(self._stages)
+        running = {}  # future -> stage name
+
+        def run_stage(name):
+            function = self._stages[name][0]
+            with self._lock:
+                stage_results = dict(results)
+            return function(stage_results)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='stage') as executor:
+            while pending or running:
+                # stages are started in order of addition, so with one worker they run like a plain sequence
+                for name in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    if all(d in results for d in self._dependencies(name)):
+                        pending.remove(name)
+                        logger.debug('Starting stage %s' % name)
+                        running[executor.submit(run_stage, name)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        logger.error('Stage %s failed, waiting for running stages to finish' % name)
+                        raise error
+                    with self._lock:
+                        results[name] = future.result()
+                    logger.debug('Finished stage %s' % name)
+
+        return results
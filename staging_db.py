@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Optional SQLite staging index of a Hipchat export. The export is parsed once and stored indexed by room, sender,
+# receiver and timestamp, so later runs, partial migrations and time cutoffs become queries instead of full scans.
+
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from export_source import HISTORY_FILE_RE
+from json_stream import iter_json_array
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+SCHEMA_VERSION = 1
+INSERT_BATCH_SIZE = 10000
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE users (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE rooms (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE messages (
+    history_type TEXT NOT NULL,     -- 'rooms' or 'users', the history file the message was read from
+    history_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,           -- position in the history file
+    message_type TEXT NOT NULL,     -- e.g. 'UserMessage' or 'PrivateUserMessage'
+    room_id INTEGER,
+    sender_id INTEGER,
+    receiver_id INTEGER,
+    timestamp_ms INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (history_type, history_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE attachments (
+    history_type TEXT NOT NULL,
+    history_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT,
+    size INTEGER,                   -- NULL if the file is missing
+    PRIMARY KEY (history_type, history_id, seq)
+) WITHOUT ROWID;
+'''
+
+INDEXES = '''
+CREATE INDEX messages_room ON messages (room_id, timestamp_ms);
+CREATE INDEX messages_sender ON messages (sender_id, timestamp_ms);
+CREATE INDEX messages_receiver ON messages (receiver_id, timestamp_ms);
+CREATE INDEX messages_timestamp ON messages (timestamp_ms);
+'''
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=OFF')
+    return connection
+
+
+def _message_row(history_type, history_id, seq, element, timestamp_from_date):
+    message_type, message = next(iter(element.items()))
+    sender = message.get('sender')
+    receiver = message.get('receiver')
+    return (history_type, history_id, seq, message_type,
+            history_id if history_type == 'rooms' else None,
+            sender.get('id') if isinstance(sender, dict) else None,
+            receiver.get('id') if isinstance(receiver, dict) else None,
+            int(timestamp_from_date(message['timestamp'])) if message.get('timestamp') else None,
+            json.dumps(message))
+
+
+def _attachment(history_type, history_id, seq, element):
+    message = next(iter(element.values()))
+    attachment = message.get('attachment') if isinstance(message, dict) else None
+    if not attachment:
+        return None
+    files_path = 'rooms/%d/files' % history_id if history_type == 'rooms' else 'users/files'
+    return history_type, history_id, seq, '%s/%s' % (files_path, attachment['path']), attachment['path'], \
+        attachment.get('name')
+
+
+def ingest(source, db_path, timestamp_from_date):
+    # source is an export_source, read in a single pass, as archive streams can not be read twice
+    start_time = time.time()
+    tmp_db_path = db_path + '.tmp'
+    if os.path.exists(tmp_db_path):
+        os.unlink(tmp_db_path)
+    connection = _connect(tmp_db_path)
+    connection.executescript(SCHEMA)
+
+    message_count = 0
+    history_counts = {'rooms': 0, 'users': 0}
+    attachments = []
+    for name, json_file in source.iter_json_members():
+        if name == 'users.json':
+            users = ((u['User']['id'], json.dumps(u['User'])) for u in iter_json_array(json_file))
+            connection.executemany('INSERT INTO users VALUES (?, ?)', users)
+            continue
+        if name == 'rooms.json':
+            rooms = ((r['Room']['id'], json.dumps(r['Room'])) for r in iter_json_array(json_file))
+            connection.executemany('INSERT INTO rooms VALUES (?, ?)', rooms)
+            continue
+        history_match = HISTORY_FILE_RE.match(name)
+        if not history_match:
+            continue
+        history_type, history_id = history_match.group(1), int(history_match.group(2))
+        history_counts[history_type] += 1
+        message_rows = []
+        for seq, element in enumerate(iter_json_array(json_file)):
+            message_rows.append(_message_row(history_type, history_id, seq, element, timestamp_from_date))
+            attachment = _attachment(history_type, history_id, seq, element)
+            if attachment:
+                attachments.append(attachment)
+            if len(message_rows) >= INSERT_BATCH_SIZE:
+                connection.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', message_rows)
+                message_count += len(message_rows)
+                message_rows = []
+        connection.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', message_rows)
+        message_count += len(message_rows)
+        if sum(history_counts.values()) % 1000 == 0:
+            logger.info('\tIngested %d room and %d user histories' % (history_counts['rooms'], history_counts['users']))
+
+    # sizes are known only after the pass, an archive may contain attachments before the history referencing them
+    attachment_rows = ((history_type, history_id, seq, path, name, source.size(member_name))
+                       for history_type, history_id, seq, member_name, path, name in attachments)
+    connection.executemany('INSERT INTO attachments VALUES (?, ?, ?, ?, ?, ?)', attachment_rows)
+
+    logger.info('Indexing %d messages of %d room and %d user histories' % (
+        message_count, history_counts['rooms'], history_counts['users']))
+    connection.executescript(INDEXES)
+    connection.executemany('INSERT INTO meta VALUES (?, ?)', [('schema_version', str(SCHEMA_VERSION)),
+                                                              ('input_path', source.description()),
+                                                              ('ingested_at', str(int(time.time())))])
+    connection.commit()
+    connection.close()
+    os.replace(tmp_db_path, db_path)
+    logger.info('Ingested export into %s in %d seconds' % (db_path, time.time() - start_time))
+
+
+def open_db(db_path):
+    connection = _connect(db_path)
+    (schema_version,) = connection.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+    if int(schema_version) != SCHEMA_VERSION:
+        raise ValueError('Staging database %s has schema version %s, expected %d. Ingest the export again.' % (
+            db_path, schema_version, SCHEMA_VERSION))
+    return connection
+
+
+def ingested_input_path(connection):
+    return connection.execute("SELECT value FROM meta WHERE key = 'input_path'").fetchone()[0]
+
+
+def iter_users(connection):
+    for (data,) in connection.execute('SELECT data FROM users ORDER BY rowid'):
+        yield json.loads(data)
+
+
+def load_rooms(connection):
+    return [json.loads(data) for (data,) in connection.execute('SELECT data FROM rooms ORDER BY rowid')]
+
+
+def load_room_messages(connection, room_id, since_ms=None):
+    query = "SELECT data FROM messages WHERE room_id = ? AND message_type = 'UserMessage'"
+    parameters = [room_id]
+    if since_ms is not None:
+        query += ' AND timestamp_ms >= ?'
+        parameters.append(since_ms)
+    return [json.loads(data) for (data,) in connection.execute(query + ' ORDER BY seq', parameters)]
+
+
+def load_user_history(connection, user_id, since_ms=None):
+    # returns the elements in the format of the history file, i.e. wrapped with their message type
+    query = "SELECT message_type, data FROM messages WHERE history_type = 'users' AND history_id = ?"
+    parameters = [user_id]
+    if since_ms is not None:
+        query += ' AND timestamp_ms >= ?'
+        parameters.append(since_ms)
+    return [{message_type: json.loads(data)}
+            for message_type, data in connection.execute(query + ' ORDER BY seq', parameters)]
+
+
+def room_activity(connection, since_ms=None, by_day=False):
+    # (sender id, room id, message count, last activity in ms) of all senders of all rooms, by_day: per day as well
+    query = ("SELECT sender_id, room_id, COUNT(*), MAX(timestamp_ms) FROM messages "
+             "WHERE history_type = 'rooms' AND message_type = 'UserMessage'")
+    parameters = []
+    if since_ms is not None:
+        query += ' AND timestamp_ms >= ?'
+        parameters.append(since_ms)
+    query += ' GROUP BY room_id, sender_id'
+    if by_day:
+        query += ', timestamp_ms / %d' % MS_PER_DAY
+    return connection.execute(query, parameters)
+
+
+def history_size(connection, history_type, history_id):
+    # length of the stored messages, used to weight progress like the size of the history file
+    (size,) = connection.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM messages '
+                                 'WHERE history_type = ? AND history_id = ?', (history_type, history_id)).fetchone()
+    return size
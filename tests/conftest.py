@@ -0,0 +1,19 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# the tools are scripts in the repository root
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+
+@pytest.fixture(scope='session')
+def export_path(tmp_path_factory):
+    # a small generated Hipchat export
+    path = str(tmp_path_factory.mktemp('export') / 'data')
+    subprocess.run([sys.executable, os.path.join(REPO_PATH, 'generate_hipchat_export.py'), '-o', path,
+                    '--users', '12', '--rooms', '2', '--room-messages', '50', '--direct-messages', '300',
+                    '--attachment-ratio', '0', '--long-message-ratio', '0'], check=True, capture_output=True)
+    return path
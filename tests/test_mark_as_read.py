@@ -0,0 +1,142 @@
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import mark_as_read
+
+TEAM_ID = 'team1'
+USER_IDS = ['user1', 'user2', 'user3']
+FAILING_USER_ID = 'user3'  # marking its channels as read is forbidden
+
+
+class StubMattermost(BaseHTTPRequestHandler):
+    # Mattermost API of a team with three users and two channels each, the second one already read.
+    # Faults are injected by self.server.faults: path -> list of faults for the next requests of the path.
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        if method == 'POST':
+            self.rfile.read(int(self.headers['Content-Length']))
+        path = self.path[len('/api/v4'):]
+        with self.server.lock:
+            self.server.requests.append((time.monotonic(), method, path))
+            faults = self.server.faults.get(path)
+            fault = faults.pop(0) if faults else None
+        if fault == 'drop':
+            self.close_connection = True
+            return
+        if fault is not None:
+            return self._reply(fault, {'message': 'fault'}, {'Retry-After': '0'})
+
+        parts = path.split('?')[0].strip('/').split('/')
+        if parts[:2] == ['teams', 'name']:
+            return self._reply(200, {'id': TEAM_ID})
+        if parts[:3] == ['teams', TEAM_ID, 'members']:
+            page = 0 if 'page=0' in path else 1
+            return self._reply(200, [{'user_id': u} for u in USER_IDS] if page == 0 else [])
+        if parts[0] == 'users' and parts[-1] == 'channels':
+            return self._reply(200, [{'id': 'c1', 'last_post_at': 10}, {'id': 'c2', 'last_post_at': 10}])
+        if parts[0] == 'users' and parts[-1] == 'members':
+            return self._reply(200, [{'channel_id': 'c1', 'last_viewed_at': 0},
+                                     {'channel_id': 'c2', 'last_viewed_at': 20}])
+        if parts[:2] == ['channels', 'members'] and parts[-1] == 'view':
+            if parts[2] == FAILING_USER_ID:
+                return self._reply(403, {'message': 'forbidden'})
+            with self.server.lock:
+                self.server.viewed.append(parts[2])
+            return self._reply(200, {'status': 'OK'})
+        self._reply(404, {'message': 'unknown path %s' % path})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+@pytest.fixture
+def server():
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubMattermost)
+    stub.lock = threading.Lock()
+    stub.requests = []
+    stub.viewed = []
+    stub.faults = {}
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+def run_main(server, tmp_path, monkeypatch, max_requests_per_second=0):
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    monkeypatch.setattr(sys, 'argv', ['mark_as_read.py', '-b', 'http://127.0.0.1:%d/' % server.server_port,
+                                      '-t', 'myteam', '-a', 'token', '-c', checkpoint_path,
+                                      '-r', str(max_requests_per_second)])
+    with pytest.raises(SystemExit) as exit_info:
+        mark_as_read.main()
+    with open(checkpoint_path) as checkpoint_file:
+        return exit_info.value.code, checkpoint_file.read().split()
+
+
+def test_retries_and_failed_users_reported(server, tmp_path, monkeypatch, capsys):
+    server.faults = {'/users/user1/teams/team1/channels': [429, 503],
+                     '/channels/members/user2/view': ['drop']}
+
+    exit_code, completed_users = run_main(server, tmp_path, monkeypatch)
+
+    # throttled, unavailable and dropped requests are retried, the forbidden user fails without retries
+    channel_requests = [r for r in server.requests if r[2] == '/users/user1/teams/team1/channels']
+    assert len(channel_requests) == 3
+    view_requests = [r for r in server.requests if r[2].startswith('/channels/members/')]
+    assert sorted(r[2].split('/')[3] for r in view_requests) == ['user1', 'user2', 'user2', 'user3']
+    assert sorted(server.viewed) == ['user1', 'user2']  # the channels already read are skipped
+
+    assert exit_code == 1
+    assert sorted(completed_users) == ['user1', 'user2']
+    assert 'Failed to mark channels as read for 1 users: %s' % FAILING_USER_ID in capsys.readouterr().out
+
+
+def test_completed_users_are_skipped_on_restart(server, tmp_path, monkeypatch):
+    run_main(server, tmp_path, monkeypatch)
+    server.requests = []
+
+    run_main(server, tmp_path, monkeypatch)
+
+    assert set(r[2].split('/')[2] for r in server.requests if r[2].startswith('/users/')) == {FAILING_USER_ID}
+
+
+def test_requests_are_rate_limited(server, tmp_path, monkeypatch):
+    run_main(server, tmp_path, monkeypatch, max_requests_per_second=20)
+
+    # requests of all workers together are spaced by the rate limiter
+    times = [r[0] for r in server.requests]
+    assert len(times) == 12  # team, two pages of members, two channel lists and a view per user
+    assert times[-1] - times[0] >= (len(times) - 1) / 20.0 * 0.9
+
+
+def test_rate_limiter_spaces_waits():
+    limiter = mark_as_read.RateLimiter(50)
+    start = time.monotonic()
+    for _ in range(11):
+        limiter.wait()
+    assert time.monotonic() - start >= 10 / 50.0 * 0.9
+    unlimited = mark_as_read.RateLimiter(0)
+    start = time.monotonic()
+    for _ in range(100):
+        unlimited.wait()
+    assert time.monotonic() - start < 0.1
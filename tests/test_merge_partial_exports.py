@@ -0,0 +1,61 @@
+import json
+import os
+
+import merge_partial_exports
+
+
+def message(message_id, timestamp):
+    return {'UserMessage': {'id': message_id, 'timestamp': timestamp, 'message': 'message %s' % message_id}}
+
+
+def write_history(export_path, room_id, messages):
+    history_path = os.path.join(export_path, 'rooms', str(room_id), merge_partial_exports.HISTORY_FILENAME)
+    os.makedirs(os.path.dirname(history_path), exist_ok=True)
+    with open(history_path, 'w') as history_file:
+        json.dump(messages, history_file)
+    return history_path
+
+
+def read_history(history_path):
+    with open(history_path) as history_file:
+        return [(m['UserMessage']['id'], m['UserMessage']['timestamp']) for m in json.load(history_file)]
+
+
+def test_overlapping_histories_are_merged_in_order(tmp_path):
+    first = write_history(str(tmp_path / '2017'), 1, [
+        message('a', '2017-12-30T10:00:00Z 5'),
+        message('b', '2017-12-31T10:00:00Z'),
+        message('c', '2018-01-01T10:00:00Z 100000'),
+    ])
+    # overlaps the first export, c was exported again with a later timestamp
+    second = write_history(str(tmp_path / '2018'), 1, [
+        message('c', '2018-01-01T10:00:01Z'),
+        message('d', '2018-01-01T10:00:00Z 200000'),  # out of order
+        message('e', '2017-12-30T10:00:00Z 4'),
+    ])
+    target = str(tmp_path / 'merged.json')
+
+    in_count, out_count = merge_partial_exports.merge_history([first, second], target, sort_memory_bytes=1)
+
+    # the unordered history is sorted in runs, the earliest copy of a duplicate is kept
+    assert (in_count, out_count) == (6, 5)
+    assert read_history(target) == [('e', '2017-12-30T10:00:00Z 4'), ('a', '2017-12-30T10:00:00Z 5'),
+                                    ('b', '2017-12-31T10:00:00Z'), ('c', '2018-01-01T10:00:00Z 100000'),
+                                    ('d', '2018-01-01T10:00:00Z 200000')]
+    assert sorted(os.listdir(str(tmp_path))) == ['2017', '2018', 'merged.json']  # no sort files left behind
+
+
+def test_merge_exports(tmp_path):
+    for year, messages in (('2017', [message('a', '2017-12-31T10:00:00Z')]),
+                           ('2018', [message('a', '2017-12-31T10:00:00Z'), message('b', '2018-01-01T10:00:00Z')])):
+        write_history(str(tmp_path / year), 1, messages)
+        with open(str(tmp_path / year / 'rooms.json'), 'w') as rooms_file:
+            json.dump([{'Room': {'id': 1, 'year': year}}], rooms_file)
+    target = str(tmp_path / 'merged')
+
+    merge_partial_exports.merge_exports([str(tmp_path / '2017'), str(tmp_path / '2018')], target, workers=1)
+
+    assert read_history(os.path.join(target, 'rooms', '1', 'history.json')) == [
+        ('a', '2017-12-31T10:00:00Z'), ('b', '2018-01-01T10:00:00Z')]
+    with open(os.path.join(target, 'rooms.json')) as rooms_file:
+        assert json.load(rooms_file)[0]['Room']['year'] == '2018'  # the newer export takes precedence
@@ -0,0 +1,63 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import migrate_hipchat_emoticons
+
+
+class StubFileServer(BaseHTTPRequestHandler):
+    # Serves the images of self.server.files by path, slowly, so that the downloads overlap
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        data = self.server.files[self.path]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        for i in range(0, len(data), 1024):
+            self.wfile.write(data[i:i + 1024])
+            self.server.barrier.wait(timeout=1)
+
+
+@pytest.fixture
+def server():
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubFileServer)
+    stub.lock = threading.Lock()
+    stub.requests = []
+    stub.files = {}
+    stub.barrier = threading.Barrier(2)
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.barrier.abort()
+    stub.shutdown()
+    stub.server_close()
+
+
+def test_emoticons_with_the_same_file_name(server, tmp_path, monkeypatch):
+    server.files = {'/a/smile.png': b'a' * 8192, '/b/smile.png': b'b' * 8192}
+    url = 'http://127.0.0.1:%d%%s' % server.server_port
+    hc_emoticons = [{'shortcut': 'smile', 'url': url % '/a/smile.png', 'type': 'group'},
+                    {'shortcut': 'smiley', 'url': url % '/a/smile.png', 'type': 'group'},
+                    {'shortcut': 'grin', 'url': url % '/b/smile.png', 'type': 'group'}]
+    monkeypatch.setattr(migrate_hipchat_emoticons, '_fetch_emoticons', lambda base_url, tokens: hc_emoticons)
+
+    migrate_hipchat_emoticons.migrate_emoticons(str(tmp_path), 'http://hipchat', ['token'], download_workers=2)
+
+    # each url is downloaded once into its own file
+    assert sorted(server.requests) == ['/a/smile.png', '/b/smile.png']
+    with open(str(tmp_path / 'mm_emojis.jsonl')) as emojis_file:
+        images = dict((e['emoji']['name'], e['emoji']['image'])
+                      for e in map(json.loads, emojis_file) if e['type'] == 'emoji')
+    assert images['hc_smile'] == images['hc_smiley'] != images['hc_grin']
+    for name, content in (('hc_smile', b'a'), ('hc_grin', b'b')):
+        with open(images[name], 'rb') as image_file:
+            assert image_file.read() == content * 8192
+    emoji_dir = str(tmp_path / migrate_hipchat_emoticons.EMOJI_DOWNLOAD_DIRNAME)
+    assert not [f for f in os.listdir(emoji_dir) if f.endswith('.part')]
@@ -0,0 +1,48 @@
+import pytest
+
+import migratemost
+
+
+@pytest.fixture
+def config(export_path, tmp_path):
+    return migratemost.MigrationConfig(migration_input_path=export_path, migration_output_path=str(tmp_path),
+                                       default_team_display_name='Team')
+
+
+def test_context_streams_the_migration_and_restores_the_globals(config):
+    with migratemost.MigrationContext(config) as context:
+        assert migratemost.migration_input_path == config.migration_input_path
+        channels = list(context.iter_channels())
+        assert len(channels) == 2
+        assert all(post.team == 'team' for post in context.iter_channel_posts(channels[0]))
+        assert len(context.users()) == 12
+
+    assert migratemost.migration_input_path == migratemost.SETTING_DEFAULTS['migration_input_path']
+    assert migratemost.default_team_name == migratemost.SETTING_DEFAULTS['default_team_name']
+    assert migratemost.hc_export_source is None
+
+
+def test_one_context_per_process(config):
+    with migratemost.MigrationContext(config) as context:
+        with pytest.raises(RuntimeError):
+            migratemost.MigrationContext(migratemost.MigrationConfig(migration_input_path='./other'))
+        with pytest.raises(RuntimeError):
+            migratemost.MigrationConfig.from_arguments(['-t', 'Other', '-i', './other'])
+        # the second context did not touch the globals of the first one
+        assert migratemost.migration_input_path == config.migration_input_path
+        channels = context.iter_channels()
+
+    # the stages read the globals while they are consumed, they end with the context
+    with pytest.raises(RuntimeError):
+        next(channels)
+    with migratemost.MigrationContext(config) as context:
+        assert len(list(context.iter_channels())) == 2
+
+
+def test_config_from_arguments_leaves_the_globals(export_path):
+    config = migratemost.MigrationConfig.from_arguments(['-t', 'Other Team', '-i', export_path, '--migrate-all'])
+
+    assert config.default_team_name == 'other-team'
+    assert config.migration_input_path == export_path
+    assert migratemost.default_team_name == migratemost.SETTING_DEFAULTS['default_team_name']
+    assert migratemost.migration_input_path == migratemost.SETTING_DEFAULTS['migration_input_path']
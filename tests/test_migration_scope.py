@@ -0,0 +1,61 @@
+import json
+import os
+import subprocess
+import sys
+from collections import Counter
+
+from conftest import REPO_PATH
+
+
+def user_history(export_path, hc_id):
+    with open(os.path.join(export_path, 'users', str(hc_id), 'history.json')) as history_file:
+        return [m['PrivateUserMessage'] for m in json.load(history_file)]
+
+
+def migrate_scoped(export_path, output_path, hc_ids):
+    os.makedirs(output_path)
+    subprocess.run([sys.executable, os.path.join(REPO_PATH, 'migratemost.py'), '-t', 'Team', '-i', export_path,
+                    '-o', output_path, '--migrate-direct-posts', '--concat-output',
+                    '--select-user-ids', ','.join(map(str, hc_ids))], check=True, capture_output=True)
+    with open(os.path.join(output_path, 'mm_all_data.jsonl')) as import_file:
+        lines = [json.loads(line) for line in import_file]
+    return [l['direct_post'] for l in lines if l['type'] == 'direct_post']
+
+
+def conversation_counts(history, hc_id):
+    # (sender id, receiver id) -> number of messages in the history of the user
+    return Counter((m['sender']['id'], m['receiver']['id']) for m in history if hc_id in (
+        m['sender']['id'], m['receiver']['id']))
+
+
+def test_scoped_user_gets_sent_and_received_messages(export_path, tmp_path):
+    hc_id = 5
+    history = user_history(export_path, hc_id)
+    sent = sum(1 for m in history if m['sender']['id'] == hc_id)
+    received = len(history) - sent
+    assert sent > 0 and received > 0
+
+    direct_posts = migrate_scoped(export_path, str(tmp_path / 'out'), [hc_id])
+
+    # the scoped user is the one member of all conversations
+    usernames = set.intersection(*[set(p['channel_members']) for p in direct_posts])
+    assert len(usernames) == 1
+    username = usernames.pop()
+    assert sum(1 for p in direct_posts if p['user'] == username) == sent
+    assert sum(1 for p in direct_posts if p['user'] != username) == received
+
+
+def test_conversation_within_scope_is_not_duplicated(export_path, tmp_path):
+    hc_id = 5
+    history = user_history(export_path, hc_id)
+    partner_id = Counter(m['sender']['id'] for m in history if m['sender']['id'] != hc_id).most_common(1)[0][0]
+    counts = conversation_counts(history, hc_id)
+    expected = counts[(hc_id, partner_id)] + counts[(partner_id, hc_id)]
+
+    direct_posts = migrate_scoped(export_path, str(tmp_path / 'out'), [hc_id, partner_id])
+
+    # both histories hold the conversation, its messages are migrated once in both directions
+    conversations = Counter(frozenset(p['channel_members']) for p in direct_posts)
+    create_ats = Counter((frozenset(p['channel_members']), p['user'], p['create_at']) for p in direct_posts)
+    assert expected in conversations.values()
+    assert max(create_ats.values()) == 1
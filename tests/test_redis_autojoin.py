@@ -0,0 +1,90 @@
+import json
+
+import redis_autojoin
+
+PREFIX = redis_autojoin.AUTOJOIN_KEY_PREFIX.encode('utf-8')
+
+
+def rooms_value(*jids):
+    return json.dumps([{'jid': jid, 'name': jid.split('@')[0]} for jid in jids]).encode('utf-8')
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def scan(self, cursor, match=None, count=None):
+        self.commands.append(lambda: self.client.scan(cursor, match, count))
+
+    def mget(self, keys):
+        self.commands.append(lambda: self.client.mget(keys))
+
+    def execute(self):
+        self.client.round_trips += 1
+        return [command() for command in self.commands]
+
+
+class FakeRedis:
+    # The commands of redis.Redis used by the export. SCAN returns the keys in batches of count keys and repeats
+    # the keys of self.repeated in the following batch, as Redis may do while it rehashes.
+    def __init__(self, values, repeated=()):
+        self.values = values
+        self.repeated = set(repeated)
+        self.scan_counts = []
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def scan(self, cursor, match=None, count=None):
+        assert match == redis_autojoin.AUTOJOIN_KEY_PREFIX + '*'
+        self.scan_counts.append(count)
+        keys = sorted(self.values)
+        batch = keys[cursor:cursor + count]
+        if cursor > 0:
+            batch = [k for k in keys[cursor - count:cursor] if k in self.repeated] + batch
+        next_cursor = cursor + count if cursor + count < len(keys) else 0
+        return next_cursor, batch
+
+    def mget(self, keys):
+        return [self.values.get(k) for k in keys]
+
+
+def export(client, tmp_path, batch_size):
+    output_path = str(tmp_path / 'autojoin.json')
+    user_count = redis_autojoin.export_autojoins(client, output_path, batch_size)
+    with open(output_path) as output_file:
+        export = json.load(output_file)  # valid JSON, also with skipped keys in between
+    assert not (tmp_path / 'autojoin.json.tmp').exists()
+    return user_count, dict((a['user_id'], [r['jid'] for r in a['rooms']]) for a in export['autojoins'])
+
+
+def test_export_over_several_scan_batches(tmp_path):
+    values = dict((PREFIX + str(user_id).encode('utf-8'), rooms_value('%d_room@conf.hipchat.example' % user_id))
+                  for user_id in range(1, 11))
+    client = FakeRedis(values, repeated=[PREFIX + b'2', PREFIX + b'5'])
+
+    user_count, autojoins = export(client, tmp_path, batch_size=3)
+
+    assert client.scan_counts == [3, 3, 3, 3]
+    assert user_count == 10
+    assert sorted(autojoins) == list(range(1, 11))  # the repeated keys are exported once
+    assert autojoins[7] == ['7_room@conf.hipchat.example']
+
+
+def test_rooms_are_filtered_and_invalid_keys_skipped(tmp_path):
+    values = {
+        PREFIX + b'1': rooms_value('1_room@conf.hipchat.example', '1_2@chat.hipchat.example'),
+        PREFIX + b'2': None,  # deleted between SCAN and MGET
+        PREFIX + b'3': b'None',
+        PREFIX + b'4': b'{not json',
+        PREFIX + b'5': json.dumps([{'name': 'no jid'}]).encode('utf-8'),
+        PREFIX + b'foo': rooms_value('foo_room@conf.hipchat.example'),
+        PREFIX + b'6': rooms_value('6_room@conf.hipchat.example'),
+    }
+
+    user_count, autojoins = export(FakeRedis(values), tmp_path, batch_size=2)
+
+    assert user_count == 4
+    assert autojoins == {1: ['1_room@conf.hipchat.example'], 2: [], 3: [], 6: ['6_room@conf.hipchat.example']}
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import upload_import
+
+CHUNK_SIZE = 1024 * 1024  # the smallest chunk size of upload_import, 1 MB
+
+
+class StubMattermost(BaseHTTPRequestHandler):
+    # Upload sessions and import jobs of the Mattermost API. The bytes received for an upload are kept by the server
+    # even if the request breaks off, like Mattermost does. Faults are injected by self.server.chunk_faults, a list
+    # of faults for the next chunk requests: 'partial' keeps half of the chunk and drops the connection.
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _session(self, upload):
+        return {'id': upload['id'], 'filename': upload['filename'], 'file_size': upload['file_size'],
+                'file_offset': len(upload['data'])}
+
+    def _handle(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        parts = self.path[len('/api/v4'):].strip('/').split('/')
+        server = self.server
+        with server.lock:
+            if parts == ['uploads'] and method == 'POST':
+                request = json.loads(body)
+                upload = {'id': 'upload%d' % (len(server.uploads) + 1), 'filename': request['filename'],
+                          'file_size': request['file_size'], 'data': bytearray()}
+                server.uploads[upload['id']] = upload
+                return self._reply(201, self._session(upload))
+            if parts[0] == 'uploads' and method == 'GET':
+                return self._reply(200, self._session(server.uploads[parts[1]]))
+            if parts[0] == 'uploads' and method == 'POST':
+                upload = server.uploads[parts[1]]
+                server.chunks.append((len(upload['data']), len(body)))  # where the chunk starts on the server
+                fault = server.chunk_faults.pop(0) if server.chunk_faults else None
+                if fault == 'partial':
+                    upload['data'].extend(body[:len(body) // 2])
+                    self.close_connection = True
+                    return
+                upload['data'].extend(body)
+                return self._reply(204)
+            if parts == ['jobs'] and method == 'POST':
+                server.jobs.append(json.loads(body))
+                return self._reply(201, {'id': 'job1', 'status': 'pending'})
+            if parts[0] == 'jobs' and method == 'GET':
+                server.job_polls += 1
+                status = 'success' if server.job_polls >= 3 else 'in_progress'
+                return self._reply(200, {'id': parts[1], 'status': status})
+        self._reply(404, {'message': 'unknown path %s' % self.path})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+@pytest.fixture
+def server(monkeypatch):
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubMattermost)
+    stub.lock = threading.Lock()
+    stub.uploads = {}
+    stub.chunks = []
+    stub.chunk_faults = []
+    stub.jobs = []
+    stub.job_polls = 0
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(upload_import, '_retry_delay', lambda response, attempt: 0)
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+@pytest.fixture
+def archive_path(tmp_path):
+    # a bit more than three chunks, stored so that its size does not depend on the compression
+    path = str(tmp_path / 'mm_all_data.zip')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('mm_all_data.jsonl', os.urandom(3 * CHUNK_SIZE + 1000))
+    return path
+
+
+def run_main(server, archive_path, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['upload_import.py', '-b', 'http://127.0.0.1:%d/' % server.server_port,
+                                      '-a', 'token', '-c', '1', '-p', '0.01', archive_path])
+    upload_import.main()
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_broken_chunk_resumes_at_server_offset(server, archive_path, monkeypatch):
+    server.chunk_faults = [None, 'partial']
+
+    run_main(server, archive_path, monkeypatch)
+
+    # the second chunk is sent again from where the server stopped, not from the chunk boundary
+    resumed_at = CHUNK_SIZE + CHUNK_SIZE // 2
+    assert [offset for offset, _ in server.chunks] == [0, CHUNK_SIZE, resumed_at, resumed_at + CHUNK_SIZE]
+    assert sum(size for _, size in server.chunks[2:]) == os.path.getsize(archive_path) - resumed_at
+    upload = server.uploads['upload1']
+    assert sha256(upload['data']) == upload_import.file_sha256(archive_path)
+
+    assert server.jobs == [{'type': 'import_process', 'data': {'import_file': 'upload1_mm_all_data.zip'}}]
+    assert server.job_polls == 3
+
+
+def test_interrupted_upload_resumes_at_server_offset(server, archive_path, monkeypatch):
+    server.chunk_faults = [None, 'partial']
+    monkeypatch.setattr(upload_import, 'MAX_RETRIES', 0)  # the broken chunk ends the first run
+    with pytest.raises(SystemExit):
+        run_main(server, archive_path, monkeypatch)
+    state_path = '%s.upload.json' % archive_path
+    with open(state_path) as state_file:
+        assert json.load(state_file)['uploaded'] is False
+    interrupted_at = len(server.uploads['upload1']['data'])
+    assert interrupted_at == CHUNK_SIZE + CHUNK_SIZE // 2
+    server.chunks = []
+
+    run_main(server, archive_path, monkeypatch)
+
+    # the session of the state file is resumed instead of starting a new upload
+    assert list(server.uploads) == ['upload1']
+    assert server.chunks[0][0] == interrupted_at
+    assert sum(size for _, size in server.chunks) == os.path.getsize(archive_path) - interrupted_at
+    assert sha256(server.uploads['upload1']['data']) == upload_import.file_sha256(archive_path)
+    with open(state_path) as state_file:
+        state = json.load(state_file)
+    assert state['uploaded'] is True and state['job_id'] == 'job1'
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+# Uploads an import archive to Mattermost and runs the import job, instead of copying the data to the Mattermost
+# host and running the bulk import there. The archive is sent in chunks through an upload session. The session and
+# the checksum of the archive are kept in a state file, so an interrupted upload continues where the server stopped
+# as long as the archive did not change.
+
+import getpass
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+import zipfile
+from optparse import OptionParser
+from urllib.parse import urljoin
+
+import urllib3
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+DEFAULT_CHUNK_SIZE_MB = 16  # below the default maximum file size of Mattermost, which limits the request size
+DEFAULT_POLL_INTERVAL_SECONDS = 10
+MAX_RETRIES = 6
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+HASH_BLOCK_SIZE = 1024 * 1024
+ARCHIVE_DATA_DIRNAME = 'data'  # attachments and images in the archive, paths in the import file are relative to it
+STATE_VERSION = 1
+JOB_FINISHED_STATUSES = ('success', 'error', 'canceled')
+
+option_base_url = None
+option_access_token = None
+option_import_file = None
+option_state_file = None
+option_chunk_size_mb = DEFAULT_CHUNK_SIZE_MB
+option_poll_interval = DEFAULT_POLL_INTERVAL_SECONDS
+option_start_import = True
+option_restart = False
+
+http = None
+
+
+class MattermostApiError(Exception):
+    pass
+
+
+def _headers(content_type='application/json'):
+    return {"Authorization": "Bearer %s" % option_access_token,
+            "Content-Type": content_type,
+            "Accept": "application/json"}
+
+
+def _retry_delay(response, attempt):
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return min(2 ** attempt, 60)
+
+
+def _request(method, path, body=None, content_type='application/json', retry=True):
+    url = '%s%s' % (option_base_url, path)
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        try:
+            response = http.request(method, url, body=body, headers=_headers(content_type), retries=False)
+        except urllib3.exceptions.HTTPError as e:
+            error = str(e)  # connection problems are retried as well
+        else:
+            if response.status < 300:
+                return json.loads(response.data) if response.data else None
+            error = 'HTTP %d: %s' % (response.status, response.data[:200])
+            if response.status not in RETRY_STATUS_CODES:
+                raise MattermostApiError('%s %s failed with %s' % (method, url, error))
+        if not retry:
+            raise MattermostApiError('%s %s failed with %s' % (method, url, error))
+        if attempt < MAX_RETRIES:
+            time.sleep(_retry_delay(response, attempt))
+    raise MattermostApiError('%s %s failed after %d retries with %s' % (method, url, MAX_RETRIES, error))
+
+
+def _archive_path(path):
+    # absolute paths of the migration become relative to the data directory of the archive
+    return os.path.abspath(path).lstrip('/')
+
+
+def _relocate_paths(line_obj, archive_files):
+    # collects the files referenced by an import line and rewrites their paths, returns whether the line changed
+    obj = line_obj.get(line_obj['type'])
+    if not isinstance(obj, dict):
+        return False
+    references = []
+    if line_obj['type'] in ('post', 'direct_post'):
+        for post in [obj] + (obj.get('replies') or []):
+            references.extend((a, 'path') for a in post.get('attachments') or [])
+    elif line_obj['type'] == 'user' and obj.get('profile_image'):
+        references.append((obj, 'profile_image'))
+    elif line_obj['type'] == 'emoji' and obj.get('image'):
+        references.append((obj, 'image'))
+    for holder, key in references:
+        archive_files[_archive_path(holder[key])] = holder[key]
+        holder[key] = _archive_path(holder[key])
+    return len(references) > 0
+
+
+def build_archive(jsonl_path, archive_path):
+    # Zips a bulk import file together with the files it references, as expected by the import job
+    archive_files = {}
+    tmp_path = '%s.%d.tmp' % (archive_path, os.getpid())
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        with open(jsonl_path, 'r') as jsonl_file, \
+                archive.open(os.path.basename(jsonl_path), 'w', force_zip64=True) as archive_jsonl:
+            for line in jsonl_file:
+                if '"path"' in line or 'image"' in line:
+                    line_obj = json.loads(line)
+                    if _relocate_paths(line_obj, archive_files):
+                        line = json.dumps(line_obj) + '\n'
+                archive_jsonl.write(line.encode('utf-8'))
+        for name, path in sorted(archive_files.items()):
+            # attachments are mostly compressed already
+            archive.write(path, '%s/%s' % (ARCHIVE_DATA_DIRNAME, name), compress_type=zipfile.ZIP_STORED)
+    os.replace(tmp_path, archive_path)
+    logger.info('Built import archive %s with %d files' % (archive_path, len(archive_files)))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as state_file:
+        state = json.load(state_file)
+    return state if state.get('version') == STATE_VERSION else None
+
+
+def save_state(state, path):
+    # replaced atomically, an interrupted write must not lose the upload session
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, path)
+
+
+def upload_session(archive_path, state):
+    # the session of the state if it belongs to the same archive and server, otherwise a new one
+    file_size = os.path.getsize(archive_path)
+    logger.info('Computing checksum of %s (%d bytes)' % (archive_path, file_size))
+    sha256 = file_sha256(archive_path)
+    if state and state['base_url'] == option_base_url and state['file_size'] == file_size:
+        if state['sha256'] != sha256:
+            logger.warning('Archive changed since the last upload (sha256 %s, was %s), starting over' % (
+                sha256, state['sha256']))
+        else:
+            try:
+                session = _request('GET', '/uploads/%s' % state['upload_id'])
+                logger.info('Resuming upload %s at %d of %d bytes' % (
+                    session['id'], session['file_offset'], file_size))
+                return session, state
+            except MattermostApiError as e:
+                logger.warning('Upload session %s cannot be resumed, starting over: %s' % (state['upload_id'], e))
+
+    session = _request('POST', '/uploads', json.dumps({'type': 'import',
+                                                       'filename': os.path.basename(archive_path),
+                                                       'file_size': file_size}))
+    state = {'version': STATE_VERSION,
+             'base_url': option_base_url,
+             'upload_id': session['id'],
+             'filename': session['filename'],
+             'file_size': file_size,
+             'sha256': sha256,
+             'uploaded': False,
+             'job_id': None}
+    save_state(state, option_state_file)
+    logger.info('Created upload session %s for %s (sha256 %s)' % (session['id'], archive_path, sha256))
+    return session, state
+
+
+def upload(archive_path, session, state):
+    chunk_size = option_chunk_size_mb * 1024 * 1024
+    offset = session['file_offset']
+    failures = 0
+    start_time = time.time()
+    start_offset = offset
+    with open(archive_path, 'rb') as archive:
+        while offset < state['file_size']:
+            archive.seek(offset)
+            chunk = archive.read(chunk_size)
+            try:
+                _request('POST', '/uploads/%s' % state['upload_id'], chunk, 'application/octet-stream', retry=False)
+                offset += len(chunk)
+                failures = 0
+            except MattermostApiError as e:
+                # the server may have stored part of the chunk, it tells where to continue
+                failures += 1
+                if failures > MAX_RETRIES:
+                    raise
+                logger.warning('Chunk at %d failed, resuming: %s' % (offset, e))
+                time.sleep(_retry_delay(None, failures - 1))
+                offset = _request('GET', '/uploads/%s' % state['upload_id'])['file_offset']
+                continue
+            elapsed = time.time() - start_time
+            logger.info('Uploaded %d of %d bytes (%.1f%%, %.1f MB/s)' % (
+                offset, state['file_size'], 100.0 * offset / state['file_size'],
+                (offset - start_offset) / 1024 / 1024 / elapsed if elapsed > 0 else 0))
+
+    session = _request('GET', '/uploads/%s' % state['upload_id'])
+    if session['file_offset'] != state['file_size']:
+        raise MattermostApiError('Upload %s incomplete on the server: %d of %d bytes' % (
+            state['upload_id'], session['file_offset'], state['file_size']))
+    state['uploaded'] = True
+    save_state(state, option_state_file)
+    logger.info('Upload of %s finished' % archive_path)
+
+
+def run_import_job(state):
+    if state['job_id']:
+        logger.info('Following import job %s started before' % state['job_id'])
+    else:
+        # completed import uploads are stored by the server as <upload id>_<filename>
+        import_file = '%s_%s' % (state['upload_id'], state['filename'])
+        job = _request('POST', '/jobs', json.dumps({'type': 'import_process', 'data': {'import_file': import_file}}))
+        state['job_id'] = job['id']
+        save_state(state, option_state_file)
+        logger.info('Started import job %s for %s' % (job['id'], import_file))
+
+    last_report = None
+    while True:
+        job = _request('GET', '/jobs/%s' % state['job_id'])
+        report = (job['status'], job.get('progress'))
+        if report != last_report:
+            logger.info('Import job %s: %s (progress %s)' % (state['job_id'], job['status'], job.get('progress')))
+            last_report = report
+        if job['status'] in JOB_FINISHED_STATUSES:
+            return job
+        time.sleep(option_poll_interval)
+
+
+def parse_arguments():
+    global option_base_url
+    global option_access_token
+    global option_import_file
+    global option_state_file
+    global option_chunk_size_mb
+    global option_poll_interval
+    global option_start_import
+    global option_restart
+    global http
+
+    parser = OptionParser(usage='''
+        usage: %prog [options] IMPORT_FILE
+        Uploads an import archive (zip) to Mattermost and runs the import job. Given a bulk import file
+        (e.g. mm_all_data.jsonl), the archive is built next to it first, including the referenced files.
+        Interrupted uploads are resumed when run again with the same archive.
+    ''')
+    parser.add_option("-b", "--base-url",
+                      dest="base_url",
+                      action="store",
+                      type="string",
+                      help="Base URL of Mattermost installation (mandatory), e.g. 'https://mattermost.mycompany.ch/'")
+    parser.add_option("-a", "--access-token",
+                      dest="token",
+                      action="store",
+                      type="string",
+                      help="A valid Mattermost API access token with admin rights (optional, can be entered interactively)")
+    parser.add_option("-c", "--chunk-size",
+                      dest="chunk_size",
+                      action="store",
+                      type="int",
+                      default=DEFAULT_CHUNK_SIZE_MB,
+                      help="Size of the uploaded chunks in MB, at most the maximum file size of Mattermost (default: %default)")
+    parser.add_option("-s", "--state-file",
+                      dest="state_file",
+                      action="store",
+                      type="string",
+                      help="File recording the upload session, checksum and import job (default: <archive>.upload.json)")
+    parser.add_option("-p", "--poll-interval",
+                      dest="poll_interval",
+                      action="store",
+                      type="float",
+                      default=DEFAULT_POLL_INTERVAL_SECONDS,
+                      help="Seconds between status requests of the import job (default: %default)")
+    parser.add_option("--upload-only",
+                      dest="upload_only",
+                      action="store_true",
+                      default=False,
+                      help="Only upload the archive, do not start the import job")
+    parser.add_option("--restart",
+                      dest="restart",
+                      action="store_true",
+                      default=False,
+                      help="Ignore the state file and upload the archive again")
+    (options, args) = parser.parse_args()
+
+    if options.base_url is None:
+        parser.print_help()
+        parser.error("Base URL parameter is mandatory")
+
+    if len(args) != 1:
+        parser.error("Exactly one import file is required")
+
+    if not os.path.isfile(args[0]):
+        parser.error("Import file does not exist: %s" % args[0])
+
+    if options.chunk_size < 1:
+        parser.error("Chunk size must be at least 1 MB")
+
+    if options.token is None:
+        option_access_token = getpass.getpass('Mattermost API access token:')
+    else:
+        option_access_token = options.token
+
+    option_base_url = urljoin(options.base_url, '/api/v4')
+    option_import_file = os.path.abspath(args[0])
+    option_state_file = options.state_file
+    option_chunk_size_mb = options.chunk_size
+    option_poll_interval = options.poll_interval
+    option_start_import = not options.upload_only
+    option_restart = options.restart
+    http = urllib3.PoolManager(timeout=urllib3.Timeout(connect=10, read=300))
+
+
+def main():
+    global option_state_file
+
+    parse_arguments()
+
+    archive_path = option_import_file
+    if not zipfile.is_zipfile(archive_path):
+        archive_path = '%s.zip' % os.path.splitext(option_import_file)[0]
+        # an archive built before is kept, rebuilding it would make a resumed upload start over
+        if option_restart or not os.path.exists(archive_path) or \
+                os.path.getmtime(archive_path) < os.path.getmtime(option_import_file):
+            build_archive(option_import_file, archive_path)
+    if not option_state_file:
+        option_state_file = '%s.upload.json' % archive_path
+
+    try:
+        state = None if option_restart else load_state(option_state_file)
+        if state and state['uploaded'] and state['base_url'] == option_base_url and \
+                state['sha256'] == file_sha256(archive_path):
+            logger.info('Archive %s was uploaded before as %s' % (archive_path, state['upload_id']))
+        else:
+            session, state = upload_session(archive_path, state)
+            upload(archive_path, session, state)
+        if not option_start_import:
+            return
+        job = run_import_job(state)
+    except MattermostApiError as e:
+        logger.error(e)
+        sys.exit(1)
+
+    if job['status'] != 'success':
+        data = job.get('data') or {}
+        logger.error('Import job %s finished with status %s: %s (line %s)' % (
+            job['id'], job['status'], data.get('error'), data.get('line_number')))
+        sys.exit(1)
+    logger.info('Import job %s finished successfully' % job['id'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+# Validates Mattermost bulk import files (as written by migratemost.py) before importing them. The files are read
+# in parallel chunks, all violations are collected and reported with counts, instead of stopping at the first one
+# like "mattermost import bulk --validate".
+
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+
+from migratemost import MM_MAX_MESSAGE_LENGTH, MM_MAX_FILE_ATTACHMENT_SIZE_BYTES, MM_MAX_CHANNEL_MEMBERSHIPS_PER_USER
+
+logger = logging.getLogger(__name__)
+logger_handler = logging.StreamHandler()
+logger_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger_handler.setFormatter(logger_formatter)
+logger.addHandler(logger_handler)
+logger.setLevel(logging.INFO)
+
+CHUNK_SIZE_BYTES = 64 * 1024 * 1024
+EXAMPLES_PER_VIOLATION = 20
+MIN_DIRECT_CHANNEL_MEMBERS = 2
+MAX_DIRECT_CHANNEL_MEMBERS = 8
+MAX_NAME_LENGTH = 64  # of team and channel names and display names
+LINE_TYPES = ['version', 'emoji', 'team', 'channel', 'user', 'post', 'direct_channel', 'direct_post']  # in order
+
+option_input_files = []
+option_report_file = None
+option_workers = os.cpu_count()
+
+
+class ChunkResult:
+    # findings of one chunk, positions are line numbers within the chunk until made global by validate()
+    def __init__(self, file_index, chunk_index):
+        self.file_index = file_index
+        self.chunk_index = chunk_index
+        self.lines = 0
+        self.types = Counter()
+        self.violations = Counter()
+        self.examples = {}  # violation -> [(line, detail)]
+        self.definitions = {}  # (kind, key) -> first line
+        self.references = {}  # (kind, key) -> first line
+        self.max_type_index = -1  # of LINE_TYPES, highest seen in the chunk
+        self.ordered_types = {}  # type index -> [first line, count] of the lines in order within the chunk
+
+    def violation(self, line, kind, detail):
+        self.violations[kind] += 1
+        examples = self.examples.setdefault(kind, [])
+        if len(examples) < EXAMPLES_PER_VIOLATION:
+            examples.append((line, detail))
+
+    def define(self, line, kind, key):
+        if (kind, key) in self.definitions:
+            self.violation(line, 'duplicate %s' % kind, repr(key))
+        else:
+            self.definitions[(kind, key)] = line
+
+    def reference(self, line, kind, key):
+        if (kind, key) not in self.references:
+            self.references[(kind, key)] = line
+
+    def type_order(self, line, line_type):
+        # lines in order within the chunk may still be out of order after the preceding chunks, see validate()
+        type_index = LINE_TYPES.index(line_type)
+        if type_index < self.max_type_index:
+            self.violation(line, 'line type out of order', '%s after %s' % (
+                line_type, LINE_TYPES[self.max_type_index]))
+            return
+        self.max_type_index = type_index
+        ordered_type = self.ordered_types.setdefault(type_index, [line, 0])
+        ordered_type[1] += 1
+
+
+def _check_message(result, line, message):
+    if len(message or '') > MM_MAX_MESSAGE_LENGTH:
+        result.violation(line, 'message too long', '%d characters' % len(message))
+
+
+def _check_file(result, line, path, kind, max_size=None):
+    try:
+        size = os.path.getsize(path)
+    except (OSError, TypeError):
+        result.violation(line, '%s file missing' % kind, path)
+        return
+    if max_size is not None and size >= max_size:
+        result.violation(line, '%s file too large' % kind, '%s (%d bytes)' % (path, size))
+
+
+def _check_direct_members(result, line, members):
+    if not MIN_DIRECT_CHANNEL_MEMBERS <= len(members or []) <= MAX_DIRECT_CHANNEL_MEMBERS:
+        result.violation(line, 'invalid direct channel member count', repr(members))
+        return None
+    for member in members:
+        result.reference(line, 'user', member)
+    return tuple(sorted(set(members)))
+
+
+def _check_post(result, line, post, direct):
+    _check_message(result, line, post.get('message'))
+    result.reference(line, 'user', post.get('user'))
+    if direct:
+        members = _check_direct_members(result, line, post.get('channel_members'))
+        if members:
+            result.reference(line, 'direct_channel', members)
+    else:
+        result.reference(line, 'team', post.get('team'))
+        result.reference(line, 'channel', (post.get('team'), post.get('channel')))
+    for attachment in post.get('attachments') or []:
+        _check_file(result, line, attachment.get('path'), 'attachment', MM_MAX_FILE_ATTACHMENT_SIZE_BYTES)
+    for reply in post.get('replies') or []:
+        result.reference(line, 'user', reply.get('user'))
+        _check_message(result, line, reply.get('message'))
+
+
+def _check_line(result, line, data):
+    line_type = data.get('type')
+    if line_type not in LINE_TYPES or line_type not in data:
+        result.violation(line, 'unknown line type', repr(line_type))
+        return
+    result.types[line_type] += 1
+    result.type_order(line, line_type)
+    obj = data[line_type]
+
+    if line_type == 'version':
+        if line != 1:
+            result.violation(line, 'version not on first line', '')
+    elif line_type == 'emoji':
+        result.define(line, 'emoji', obj.get('name'))
+        _check_file(result, line, obj.get('image'), 'emoji image')
+    elif line_type == 'team':
+        result.define(line, 'team', obj.get('name'))
+        if len(obj.get('display_name') or '') > MAX_NAME_LENGTH:
+            result.violation(line, 'team display name too long', obj.get('display_name'))
+    elif line_type == 'channel':
+        result.define(line, 'channel', (obj.get('team'), obj.get('name')))
+        result.reference(line, 'team', obj.get('team'))
+        if not obj.get('name') or len(obj['name']) > MAX_NAME_LENGTH:
+            result.violation(line, 'invalid channel name', repr(obj.get('name')))
+        if len(obj.get('display_name') or '') > MAX_NAME_LENGTH:
+            result.violation(line, 'channel display name too long', obj.get('display_name'))
+        if obj.get('type') not in ('O', 'P'):
+            result.violation(line, 'invalid channel type', repr(obj.get('type')))
+    elif line_type == 'user':
+        result.define(line, 'user', obj.get('username'))
+        memberships = 0
+        for team in obj.get('teams') or []:
+            result.reference(line, 'team', team.get('name'))
+            for channel in team.get('channels') or []:
+                result.reference(line, 'channel', (team.get('name'), channel.get('name')))
+                memberships += 1
+        if memberships > MM_MAX_CHANNEL_MEMBERSHIPS_PER_USER:
+            result.violation(line, 'too many channel memberships', '%s: %d' % (obj.get('username'), memberships))
+        if obj.get('profile_image'):
+            _check_file(result, line, obj['profile_image'], 'profile image')
+    elif line_type == 'post':
+        _check_post(result, line, obj, direct=False)
+    elif line_type == 'direct_channel':
+        members = _check_direct_members(result, line, obj.get('members'))
+        if members:
+            result.define(line, 'direct_channel', members)
+    elif line_type == 'direct_post':
+        _check_post(result, line, obj, direct=True)
+
+
+def validate_chunk(job):
+    file_index, chunk_index, path, start, end = job
+    result = ChunkResult(file_index, chunk_index)
+    with open(path, 'rb') as import_file:
+        if start > 0:
+            # the line crossing the chunk start belongs to the previous chunk
+            import_file.seek(start - 1)
+            import_file.readline()
+        while import_file.tell() < end:
+            raw_line = import_file.readline()
+            if not raw_line:
+                break
+            result.lines += 1
+            if not raw_line.strip():
+                result.violation(result.lines, 'empty line', '')
+                continue
+            try:
+                data = json.loads(raw_line)
+            except ValueError as e:
+                result.violation(result.lines, 'invalid JSON', str(e))
+                continue
+            if not isinstance(data, dict):
+                result.violation(result.lines, 'invalid JSON', 'not an object')
+                continue
+            _check_line(result, result.lines, data)
+    if start == 0 and result.types['version'] == 0:
+        result.violation(1, 'version line missing', '')
+    return result
+
+
+def _chunk_jobs(paths):
+    jobs = []
+    for file_index, path in enumerate(paths):
+        size = os.path.getsize(path)
+        offsets = list(range(0, size, CHUNK_SIZE_BYTES)) or [0]
+        for chunk_index, start in enumerate(offsets):
+            jobs.append((file_index, chunk_index, path, start, min(start + CHUNK_SIZE_BYTES, size)))
+    return jobs
+
+
+def validate(paths, workers=option_workers):
+    jobs = _chunk_jobs(paths)
+    logger.info('Validating %d files in %d chunks' % (len(paths), len(jobs)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(validate_chunk, jobs))
+
+    # line numbers of chunks are made global by the number of lines of the preceding chunks of the same file
+    first_lines = {}
+    lines_before = Counter()
+    for result in sorted(results, key=lambda r: (r.file_index, r.chunk_index)):
+        first_lines[(result.file_index, result.chunk_index)] = lines_before[result.file_index]
+        lines_before[result.file_index] += result.lines
+
+    def position(result, line):
+        return result.file_index, first_lines[(result.file_index, result.chunk_index)] + line
+
+    types = Counter()
+    violations = Counter()
+    examples = {}
+    definitions = {}
+    references = {}
+
+    def add_example(kind, pos, detail):
+        violations[kind] += 1
+        kind_examples = examples.setdefault(kind, [])
+        if len(kind_examples) < EXAMPLES_PER_VIOLATION:
+            kind_examples.append((pos, detail))
+
+    for result in results:
+        types.update(result.types)
+        violations.update(result.violations)
+        for kind, kind_examples in result.examples.items():
+            examples.setdefault(kind, []).extend((position(result, l), d) for l, d in kind_examples)
+        for key, line in result.definitions.items():
+            pos = position(result, line)
+            if key in definitions:
+                add_example('duplicate %s' % key[0], max(pos, definitions[key]), repr(key[1]))
+            definitions[key] = min(pos, definitions.get(key, pos))
+        for key, line in result.references.items():
+            pos = position(result, line)
+            references[key] = min(pos, references.get(key, pos))
+
+    # types must not go back to an earlier type of LINE_TYPES within a file, also across chunks
+    max_type_index_before = {}  # file index -> highest type index of the preceding chunks
+    for result in sorted(results, key=lambda r: (r.file_index, r.chunk_index)):
+        max_type_index = max_type_index_before.get(result.file_index, -1)
+        for type_index, (line, count) in result.ordered_types.items():
+            if type_index < max_type_index:
+                violations['line type out of order'] += count - 1
+                add_example('line type out of order', position(result, line), '%s after %s' % (
+                    LINE_TYPES[type_index], LINE_TYPES[max_type_index]))
+        max_type_index_before[result.file_index] = max(max_type_index, result.max_type_index)
+
+    # references must be defined on an earlier line, in the order the files are imported
+    for key, pos in references.items():
+        kind, name = key
+        if key not in definitions:
+            add_example('undefined %s' % kind, pos, repr(name))
+        elif definitions[key] > pos:
+            add_example('%s referenced before its definition' % kind, pos, repr(name))
+
+    report = {'files': paths,
+              'lines': sum(lines_before.values()),
+              'types': dict(types),
+              'violations': dict(violations),
+              'examples': dict((kind, [{'file': paths[pos[0]], 'line': pos[1], 'detail': detail}
+                                       for pos, detail in sorted(kind_examples)[:EXAMPLES_PER_VIOLATION]])
+                               for kind, kind_examples in examples.items())}
+    return report
+
+
+def log_report(report):
+    logger.info('Validated %d lines: %s' % (report['lines'], ', '.join(
+        '%d %s' % (report['types'][t], t) for t in LINE_TYPES if t in report['types'])))
+    if not report['violations']:
+        logger.info('No violations found')
+        return
+    for kind, count in sorted(report['violations'].items(), key=lambda v: -v[1]):
+        logger.error('%d x %s' % (count, kind))
+        for example in report['examples'].get(kind, []):
+            logger.error('\t%s:%d %s' % (example['file'], example['line'], example['detail']))
+
+
+def parse_arguments():
+    global option_input_files
+    global option_report_file
+    global option_workers
+
+    parser = OptionParser(usage='''
+        usage: %prog [options] IMPORT_FILE [IMPORT_FILE ...]
+        Validates Mattermost bulk import files, e.g. mm_all_data.jsonl or the single files in the order they will be
+        imported. Checks line types and order, references to teams, channels and users, message lengths, direct
+        channel members, channel memberships per user and attachment files.
+        Exits with status 1 if violations were found.
+    ''')
+    parser.add_option('-o', '--report-file',
+                      type='string',
+                      action='store',
+                      dest='report_file',
+                      help='Write the report as JSON to the given file')
+    parser.add_option('-w', '--workers',
+                      type='int',
+                      action='store',
+                      dest='workers',
+                      default=option_workers,
+                      help='Number of chunks validated in parallel (default: %default)')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0:
+        parser.error("At least one import file is required")
+
+    for input_file in args:
+        if not os.path.isfile(input_file):
+            parser.error("Import file does not exist: %s" % input_file)
+
+    if options.workers < 1:
+        parser.error("Number of workers must be at least 1")
+
+    option_input_files = [os.path.abspath(f) for f in args]
+    option_report_file = options.report_file
+    option_workers = options.workers
+
+
+def main():
+    parse_arguments()
+    report = validate(option_input_files, option_workers)
+    log_report(report)
+    if option_report_file:
+        with open(option_report_file, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    sys.exit(1 if report['violations'] else 0)
+
+
+if __name__ == "__main__":
+    main()